@@ -32,16 +32,2003 @@ be signaled when the processing is complete. The default mode is to run synchron
 """
 
 import collections
+import collections.abc
+import hashlib
 import librosa
+import itertools
+import json
 import math
-import random
+import multiprocessing
+import os
 import scipy
+import shutil
+import soundfile
+import tempfile
 import threading
+import time
 
 import numpy as np
 import sklearn.cluster
 import sklearn.metrics
 
+def extract_beat_features(y, sr, n_fft=2048, hop_length=512, trim=False, timings=None):
+
+    """ Computes the beat grid, MFCCs and RMS amplitudes of a mono signal from a
+        single shared STFT.
+
+        librosa's beat_track(y=...), mfcc(y=...) and rms(y=...) each run their own
+        spectral transform of the same samples. All three can be derived from one
+        magnitude spectrogram instead: the mel power spectrogram built from it is the
+        onset envelope input for the beat tracker and the input for the MFCCs, and the
+        magnitudes themselves give the RMS.
+
+        Args:
+
+                  y: the mono audio samples
+                 sr: the sample rate of y
+              n_fft: the FFT size of the shared STFT. Matches the librosa defaults.
+         hop_length: the hop size of the shared STFT. Matches the librosa defaults, so
+                     the frames line up with the CQT frames.
+               trim: passed on to the beat tracker. Set to True to trim leading and
+                     trailing beats with weak onsets.
+            timings: an optional dictionary. If passed, the time (in seconds) that each
+                     stage took is stored in it under the stage name.
+
+        Returns:
+
+            a tuple of (tempo, beat frames, mfcc, rms)
+    """
+
+    if timings is None:
+        timings = {}
+
+    stage_start = time.time()
+
+    S = np.abs(librosa.stft(y, n_fft=n_fft, hop_length=hop_length))
+
+    timings['stft'] = time.time() - stage_start
+    stage_start = time.time()
+
+    # the log-power mel spectrogram is exactly what onset_strength() and mfcc()
+    # would have computed internally from y
+
+    mel_db = librosa.power_to_db(librosa.feature.melspectrogram(S=S**2, sr=sr, n_fft=n_fft,
+                                                                hop_length=hop_length))
+
+    timings['mel spectrogram'] = time.time() - stage_start
+    stage_start = time.time()
+
+    onset_envelope = librosa.onset.onset_strength(S=mel_db, sr=sr, hop_length=hop_length,
+                                                  aggregate=np.median)
+
+    tempo, btz = librosa.beat.beat_track(onset_envelope=onset_envelope, sr=sr,
+                                         hop_length=hop_length, trim=trim)
+
+    timings['beat tracking'] = time.time() - stage_start
+    stage_start = time.time()
+
+    mfcc = librosa.feature.mfcc(S=mel_db, sr=sr)
+
+    timings['mfcc'] = time.time() - stage_start
+    stage_start = time.time()
+
+    # newer versions of librosa have renamed the rmse function. RMS computed from
+    # the spectrogram is scaled by the energy of the analysis window, so undo that
+    # to keep the amplitudes on the same scale as the time domain version.
+
+    if hasattr(librosa.feature,'rms'):
+        rms = librosa.feature.rms(S=S, frame_length=n_fft, hop_length=hop_length)
+    else:
+        rms = librosa.feature.rmse(S=S, frame_length=n_fft, hop_length=hop_length)
+
+    window = librosa.filters.get_window('hann', n_fft, fftbins=True)
+    rms /= np.sqrt(np.mean(window**2))
+
+    timings['rms'] = time.time() - stage_start
+
+    return tempo, btz, mfcc, rms
+
+def resample_poly(y, orig_sr, target_sr):
+
+    """ Resamples mono audio with a polyphase filter. This is much faster than the
+        default resampler in librosa.resample() and is more than good enough for
+        feature extraction.
+
+        Args:
+
+                    y: the mono audio samples
+              orig_sr: the sample rate of y
+            target_sr: the sample rate to resample y to
+    """
+
+    gcd = math.gcd(int(orig_sr), int(target_sr))
+
+    return scipy.signal.resample_poly(y, int(target_sr) // gcd, int(orig_sr) // gcd).astype(y.dtype)
+
+def allocate_pcm(shape, path=None):
+
+    """ Allocates an int16 PCM array -- in memory, or memory-mapped from a new .npy
+        file at path if one is given.
+    """
+
+    if path is None:
+        return np.empty(shape, dtype=np.int16)
+
+    return np.lib.format.open_memmap(path, mode='w+', dtype=np.int16, shape=shape)
+
+def float_to_pcm(y, path=None, chunk_size=1024 * 1024):
+
+    """ Converts float audio, as librosa loads it, to the int16 PCM layout of
+        InfiniteJukebox.raw_audio -- one row per sample, one column per channel.
+
+        The conversion is done a chunk at a time, straight into the result, so the
+        only full size array it allocates is the result itself.
+
+        Args:
+
+                     y: the audio, shaped (samples,) or (channels, samples)
+                  path: if given, the PCM is written to a .npy file at this path and
+                        returned memory-mapped from it. Otherwise it's returned in memory.
+            chunk_size: the number of samples to convert at once
+    """
+
+    shape = y.shape[::-1]
+
+    pcm = allocate_pcm(shape, path)
+
+    scale = np.iinfo(np.int16).max
+
+    for start in range(0, shape[0], chunk_size):
+        pcm[start:start + chunk_size] = (y[..., start:start + chunk_size] * scale).T
+
+    if path is not None:
+        pcm.flush()
+
+    return pcm
+
+def read_samples(sound_file, start, stop, lo=0, hi=None):
+
+    """ Reads samples [start, stop) of an open soundfile.SoundFile as a float32 array
+        of shape (samples, channels). Samples outside of [lo, hi) come back as zeros,
+        as if the audio had been cut down to [lo, hi) and then zero padded -- which is
+        how librosa pads the ends of a signal for its centered transforms.
+    """
+
+    if hi is None:
+        hi = sound_file.frames
+
+    block = np.zeros((stop - start, sound_file.channels), dtype=np.float32)
+
+    first, last = max(start, lo), min(stop, hi)
+
+    if first < last:
+        sound_file.seek(first)
+        data = sound_file.read(last - first, dtype='float32', always_2d=True)
+        block[first - start:first - start + len(data)] = data
+
+    return block
+
+def scan_audio(filename, n_fft=2048, hop_length=512, top_db=60, block_frames=4096):
+
+    """ The first pass of the streaming analysis. Reads the audio file a block at a time
+        and works out where the leading and trailing silences are (as
+        librosa.effects.trim() would) and the peak of the log-power mel spectrogram,
+        which the later passes scale their spectrograms against. Only one number per
+        STFT frame is kept.
+
+        Args:
+
+                filename: the path to the audio file. It must be a format soundfile reads.
+                   n_fft: the FFT size, as in extract_beat_features()
+              hop_length: the hop size, as in extract_beat_features()
+                  top_db: the threshold (in decibels) below the peak to consider as silence
+            block_frames: the number of STFT frames to read and process at once
+
+        Returns:
+
+            a tuple of (sample rate, start sample, end sample, peak mel dB)
+    """
+
+    with soundfile.SoundFile(filename) as sound_file:
+
+        sr = sound_file.samplerate
+        n = sound_file.frames
+        n_frames = 1 + n // hop_length
+
+        power = np.zeros(n_frames)
+        mel_peak = -np.inf
+
+        for f0 in range(0, n_frames, block_frames):
+            f1 = min(f0 + block_frames, n_frames)
+
+            block = read_samples(sound_file, f0 * hop_length - n_fft // 2,
+                                 (f1 - 1) * hop_length + n_fft - n_fft // 2)
+
+            # the mean square of each frame, in its loudest channel
+
+            squares = np.cumsum(block.astype(np.float64)**2, axis=0)
+            squares = np.vstack([np.zeros((1, block.shape[1])), squares])
+
+            offsets = np.arange(f1 - f0) * hop_length
+            power[f0:f1] = ((squares[offsets + n_fft] - squares[offsets]) / n_fft).max(axis=1)
+
+            S = np.abs(librosa.stft(block.mean(axis=1), n_fft=n_fft, hop_length=hop_length,
+                                    center=False))
+
+            mel = librosa.feature.melspectrogram(S=S**2, sr=sr, n_fft=n_fft, hop_length=hop_length)
+            mel_peak = max(mel_peak, librosa.power_to_db(mel.max(keepdims=True), top_db=None)[0, 0])
+
+    db = librosa.amplitude_to_db(np.sqrt(power), ref=np.max, top_db=None)
+    loud = np.flatnonzero(db > -top_db)
+
+    if loud.size > 0:
+        start = int(loud[0] * hop_length)
+        end = min(n, int((loud[-1] + 1) * hop_length))
+    else:
+        start, end = 0, 0
+
+    return sr, start, end, mel_peak
+
+def stream_mel_db(sound_file, start, end, f0, f1, mel_peak, n_fft=2048, hop_length=512):
+
+    """ Frames [f0, f1) of the log-power mel spectrogram that extract_beat_features()
+        computes for samples [start, end) of an open soundfile.SoundFile, clipped 80dB
+        below mel_peak.
+
+        Returns:
+
+            a tuple of (magnitude spectrogram, mel dB)
+    """
+
+    block = read_samples(sound_file, start + f0 * hop_length - n_fft // 2,
+                         start + (f1 - 1) * hop_length + n_fft - n_fft // 2, start, end)
+
+    S = np.abs(librosa.stft(block.mean(axis=1), n_fft=n_fft, hop_length=hop_length, center=False))
+
+    mel_db = librosa.power_to_db(librosa.feature.melspectrogram(S=S**2, sr=sound_file.samplerate,
+                                                                n_fft=n_fft, hop_length=hop_length),
+                                 top_db=None)
+
+    return S, np.maximum(mel_db, mel_peak - 80.0)
+
+def stream_onset_strength(filename, start, end, mel_peak, n_fft=2048, hop_length=512,
+                          block_frames=4096):
+
+    """ The onset strength envelope that extract_beat_features() gives the beat tracker,
+        for samples [start, end) of an audio file, computed a block at a time.
+
+        Args:
+
+                filename: the path to the audio file. It must be a format soundfile reads.
+              start, end: the range of samples, as scan_audio() returns it
+                mel_peak: the peak mel dB, as scan_audio() returns it
+                   n_fft: the FFT size, as in extract_beat_features()
+              hop_length: the hop size, as in extract_beat_features()
+            block_frames: the number of STFT frames to read and process at once
+    """
+
+    n_frames = 1 + (end - start) // hop_length
+
+    # onset_strength() pads the front of the envelope by the lag plus half a frame
+    pad = 1 + n_fft // (2 * hop_length)
+
+    onset_envelope = np.zeros(n_frames + pad)
+    previous = None
+
+    with soundfile.SoundFile(filename) as sound_file:
+
+        for f0 in range(0, n_frames, block_frames):
+            f1 = min(f0 + block_frames, n_frames)
+
+            _, mel_db = stream_mel_db(sound_file, start, end, f0, f1, mel_peak, n_fft, hop_length)
+
+            if previous is not None:
+                mel_db = np.hstack([previous, mel_db])
+
+            rises = np.median(np.maximum(0.0, np.diff(mel_db, axis=1)), axis=0)
+            onset_envelope[pad + f1 - 1 - len(rises):pad + f1 - 1] = rises
+
+            previous = mel_db[:, -1:]
+
+    return onset_envelope[:n_frames]
+
+def read_pcm(filename, start, end, path=None, chunk_size=1024 * 1024):
+
+    """ Reads samples [start, end) of an audio file straight into the int16 PCM layout
+        of InfiniteJukebox.raw_audio, a chunk at a time. See float_to_pcm().
+
+        Args:
+
+                filename: the path to the audio file. It must be a format soundfile reads.
+              start, end: the range of samples to read
+                    path: if given, the PCM is written to a .npy file at this path and
+                          returned memory-mapped from it. Otherwise it's returned in memory.
+              chunk_size: the number of samples to convert at once
+    """
+
+    with soundfile.SoundFile(filename) as sound_file:
+
+        if sound_file.channels == 1:
+            shape = (end - start,)
+        else:
+            shape = (end - start, sound_file.channels)
+
+        pcm = allocate_pcm(shape, path)
+
+        scale = np.iinfo(np.int16).max
+
+        for offset in range(0, end - start, chunk_size):
+            block = read_samples(sound_file, start + offset, min(start + offset + chunk_size, end))
+            pcm[offset:offset + len(block)] = (block * scale).reshape((len(block),) + shape[1:])
+
+    if path is not None:
+        pcm.flush()
+
+    return pcm
+
+def stream_tempo(onset_envelope, sr, hop_length=512, block_frames=4096, ac_size=8.0, start_bpm=120.0,
+                 std_bpm=1.0, max_tempo=320.0):
+
+    """ The tempo that librosa.feature.tempo() (and so librosa.beat.beat_track()) estimates
+        from an onset envelope, worked out without holding the whole tempogram in memory.
+        For long audio the tempogram is by far the biggest thing the beat tracker builds.
+        Its columns are only ever averaged, so they are summed a block at a time instead.
+
+        Args:
+
+            onset_envelope: the onset strength envelope
+                        sr: the sample rate of the audio
+                hop_length: the hop size of the onset envelope
+              block_frames: the number of tempogram columns to compute at once
+
+            The remaining args are as for librosa.feature.tempo().
+    """
+
+    win_length = int(librosa.time_to_frames(ac_size, sr=sr, hop_length=hop_length))
+    window = librosa.filters.get_window('hann', win_length, fftbins=True)[:, np.newaxis]
+
+    n = len(onset_envelope)
+    padded = np.pad(onset_envelope, win_length // 2, mode='linear_ramp', end_values=[0, 0])
+
+    tg = np.zeros(win_length)
+
+    for f0 in range(0, n, block_frames):
+        f1 = min(f0 + block_frames, n)
+
+        frames = librosa.util.frame(padded[f0:f1 + win_length - 1], frame_length=win_length, hop_length=1)
+        ac = librosa.autocorrelate(frames * window, axis=0)
+
+        tg += librosa.util.normalize(ac, norm=np.inf, axis=0).sum(axis=1)
+
+    tg /= n
+
+    bpms = librosa.tempo_frequencies(win_length, hop_length=hop_length, sr=sr)
+
+    logprior = -0.5 * ((np.log2(bpms) - np.log2(start_bpm)) / std_bpm)**2
+    logprior[:int(np.argmax(bpms < max_tempo))] = -np.inf
+
+    return float(bpms[np.argmax(np.log1p(1e6 * tg) + logprior)])
+
+class BeatSynchronizer(object):
+
+    """ librosa.util.sync() for features that arrive a block of frames at a time. Each
+        beat's frames are aggregated as soon as the beat is complete, so only the frames
+        of the beat in progress are held on to.
+
+        Args:
+
+            boundaries: the frame boundaries of the beats, as librosa.util.fix_frames()
+                        returns them
+             aggregate: the aggregation function, as for librosa.util.sync()
+    """
+
+    def __init__(self, boundaries, aggregate=np.mean):
+
+        self.__boundaries = boundaries
+        self.__aggregate = aggregate
+        self.__pending = None
+        self.__offset = boundaries[0]
+        self.__beat = 0
+        self.__columns = []
+
+    def add(self, frames):
+
+        """ Adds the next block of frames, shaped (features, frames). """
+
+        if self.__pending is not None:
+            frames = np.hstack([self.__pending, frames])
+
+        boundaries = self.__boundaries
+        end = self.__offset + frames.shape[1]
+
+        while self.__beat < len(boundaries) - 1 and boundaries[self.__beat + 1] <= end:
+            lo = boundaries[self.__beat] - self.__offset
+            hi = boundaries[self.__beat + 1] - self.__offset
+
+            self.__columns.append(self.__aggregate(frames[:, lo:hi], axis=-1))
+            self.__beat += 1
+
+        keep = min(boundaries[self.__beat] - self.__offset, frames.shape[1])
+
+        self.__pending = frames[:, keep:]
+        self.__offset += keep
+
+    def result(self):
+
+        """ The beat-synchronous features, shaped (features, beats). """
+
+        return np.stack(self.__columns, axis=-1)
+
+def stream_beat_features(filename, start, end, btz, mel_peak, n_fft=2048, hop_length=512,
+                         bins_per_octave=36, n_bins=252, block_frames=4096, timings=None):
+
+    """ The last pass of the streaming analysis. Reads samples [start, end) of the audio
+        file a block at a time and computes the beat-synchronous CQT, MFCCs and RMS
+        amplitudes that the non-streaming analysis gets from librosa.cqt(),
+        extract_beat_features() and librosa.util.sync(). Only the per-beat summaries
+        are kept.
+
+        The CQT of each block is taken with enough audio either side of it for the
+        longest CQT filter, so its frames match those of a CQT of the whole song.
+
+        Args:
+
+                filename: the path to the audio file. It must be a format soundfile reads.
+              start, end: the range of samples to analyse, as scan_audio() returns it
+                     btz: the beat frames
+                mel_peak: the peak mel dB, as scan_audio() returns it
+                   n_fft: the FFT size, as in extract_beat_features()
+              hop_length: the hop size, as in extract_beat_features()
+         bins_per_octave: the CQT bins per octave
+                  n_bins: the number of CQT bins
+            block_frames: the number of frames to process at once
+                 timings: an optional dictionary. If passed, the time (in seconds) that each
+                          stage took is added to it under the stage name.
+
+        Returns:
+
+            a tuple of (Csync, Msync, ampSync)
+    """
+
+    if timings is None:
+        timings = {}
+
+    for stage in ('cqt', 'mfcc', 'rms'):
+        timings.setdefault(stage, 0.0)
+
+    n_frames = 1 + (end - start) // hop_length
+    boundaries = librosa.util.fix_frames(btz, x_min=0, x_max=n_frames)
+
+    cqt_sync = BeatSynchronizer(boundaries, np.median)
+    mfcc_sync = BeatSynchronizer(boundaries)
+    rms_sync = BeatSynchronizer(boundaries)
+
+    window = librosa.filters.get_window('hann', n_fft, fftbins=True)
+    window_scale = np.sqrt(np.mean(window**2))
+
+    cqt_peak = 0.0
+
+    with soundfile.SoundFile(filename) as sound_file:
+
+        sr = sound_file.samplerate
+
+        # the audio either side of each block that the lowest (longest) CQT filter,
+        # and the resampling that librosa does between octaves, can reach
+
+        fmin = librosa.note_to_hz('C1')
+        filter_length = (1.0 / (2.0**(1.0 / bins_per_octave) - 1)) * sr / fmin
+        context = int(math.ceil(filter_length / hop_length)) * hop_length
+
+        for f0 in range(0, n_frames, block_frames):
+            stage_start = time.time()
+
+            f1 = min(f0 + block_frames, n_frames)
+
+            # the ends of the song aren't padded, so that the CQT treats them the way
+            # it treats the ends of the whole song
+
+            lo = max(start, start + f0 * hop_length - context)
+            hi = min(end, start + f1 * hop_length + context)
+
+            y = read_samples(sound_file, lo, hi).mean(axis=1)
+
+            first = (start + f0 * hop_length - lo) // hop_length
+
+            cqt = np.abs(librosa.cqt(y=y, sr=sr, hop_length=hop_length, fmin=fmin,
+                                     bins_per_octave=bins_per_octave, n_bins=n_bins))
+            cqt = cqt[:, first:first + f1 - f0]
+
+            # the dB scale is relative to the peak of the whole song. That isn't known
+            # until the end, so it is taken off the beat medians afterwards.
+
+            cqt_peak = max(cqt_peak, cqt.max())
+            cqt_sync.add(librosa.amplitude_to_db(cqt, ref=1.0, top_db=None))
+
+            timings['cqt'] += time.time() - stage_start
+            stage_start = time.time()
+
+            S, mel_db = stream_mel_db(sound_file, start, end, f0, f1, mel_peak, n_fft, hop_length)
+
+            mfcc_sync.add(librosa.feature.mfcc(S=mel_db, sr=sr))
+
+            timings['mfcc'] += time.time() - stage_start
+            stage_start = time.time()
+
+            rms_sync.add(librosa.feature.rms(S=S, frame_length=n_fft, hop_length=hop_length) / window_scale)
+
+            timings['rms'] += time.time() - stage_start
+
+    ref = librosa.amplitude_to_db(np.asarray([cqt_peak]), ref=1.0, top_db=None)[0]
+    Csync = np.maximum(cqt_sync.result() - ref, -80.0)
+
+    return Csync, mfcc_sync.result(), rms_sync.result()
+
+def fit_cluster_candidate(candidate):
+
+    """ Clusters the beats into one candidate number of clusters and scores the result.
+
+        This is the unit of work for the silhouette-based cluster sweep. It lives at
+        module level so that it can be shipped to a multiprocessing.Pool.
+
+        Args:
+
+            candidate: a tuple of (n_clusters, X) where X is the matrix of normalized
+                       eigenvectors for that cluster count
+
+        Returns:
+
+            a tuple of (cluster labels, average silhouette score)
+    """
+
+    n_clusters, X = candidate
+
+    clusterer = sklearn.cluster.KMeans(n_clusters=n_clusters, max_iter=300,
+                                       random_state=0, n_init=20)
+
+    cluster_labels = clusterer.fit_predict(X)
+
+    return cluster_labels, sklearn.metrics.silhouette_score(X, cluster_labels)
+
+def fit_cluster_labels(candidate):
+
+    """ Clusters the beats into one candidate number of clusters, without scoring the
+        result. Used instead of fit_cluster_candidate() when a SilhouetteSweep scores
+        the candidates.
+
+        Args:
+
+            candidate: a tuple of (n_clusters, X), as for fit_cluster_candidate()
+
+        Returns:
+
+            the cluster labels
+    """
+
+    n_clusters, X = candidate
+
+    clusterer = sklearn.cluster.KMeans(n_clusters=n_clusters, max_iter=300,
+                                       random_state=0, n_init=20)
+
+    return clusterer.fit_predict(X)
+
+def adaptive_kmeans(X, n_clusters, init=None, max_init=20, patience=5, max_iter=300, tol=1e-4, random_state=0):
+
+    """ KMeans that stops restarting once restarts stop paying off.
+
+        sklearn.cluster.KMeans(n_init=20) always runs all 20 of its restarts and keeps
+        the one with the lowest inertia (the sum of squared distances from each point
+        to its cluster center). Here the restarts are run one at a time, and stop once
+        patience of them in a row have failed to lower the best inertia by more than a
+        fraction tol. If init centers are given (see seed_centers()), the first run
+        starts from them, which usually makes it the best run there is.
+
+        Args:
+
+            X: the points to cluster, one per row
+            n_clusters: the number of clusters
+            init: initial centers for the first run, or None to start every run
+                  from k-means++
+            max_init: the most runs to make, as KMeans' n_init
+            patience: stop after this many runs in a row without a real improvement
+            max_iter: the most iterations of each run, as for KMeans
+            tol: the smallest fraction of the best inertia that counts as an improvement
+            random_state: seeds the k-means++ runs, so that the result is repeatable
+
+        Returns:
+
+            a tuple of (labels, cluster centers, inertia)
+    """
+
+    seeds = np.random.RandomState(random_state).randint(np.iinfo(np.int32).max, size=max_init)
+
+    best = None
+    stale = 0
+
+    for i in range(max_init):
+        if i == 0 and init is not None:
+            clusterer = sklearn.cluster.KMeans(n_clusters=n_clusters, init=init, n_init=1,
+                                               max_iter=max_iter)
+        else:
+            clusterer = sklearn.cluster.KMeans(n_clusters=n_clusters, n_init=1, max_iter=max_iter,
+                                               random_state=seeds[i])
+
+        clusterer.fit(X)
+
+        if best is not None and clusterer.inertia_ >= best.inertia_ * (1 - tol):
+            stale += 1
+        else:
+            stale = 0
+
+        if best is None or clusterer.inertia_ < best.inertia_:
+            best = clusterer
+
+        if stale >= patience:
+            break
+
+    return best.labels_, best.cluster_centers_, best.inertia_
+
+def seed_centers(X, labels, n_clusters):
+
+    """ Initial centers for clustering X into n_clusters, from a clustering of the same
+        points into a different number of clusters: the neighbouring candidate in a sweep
+        over cluster counts.
+
+        The old clusters' centers are found in X. Then the two clusters that are cheapest
+        to merge (by Ward's criterion) are merged, or the point furthest from every center
+        becomes a new one, until there are n_clusters centers.
+
+        Args:
+
+            X: the points to cluster, one per row
+            labels: the cluster of each point in the other clustering
+            n_clusters: the number of centers wanted
+    """
+
+    _, labels = np.unique(labels, return_inverse=True)
+
+    sizes = np.bincount(labels).astype(float)
+
+    centers = np.zeros((len(sizes), X.shape[1]))
+    np.add.at(centers, labels, X)
+    centers /= sizes[:, np.newaxis]
+
+    while len(centers) > n_clusters:
+        distances = sklearn.metrics.pairwise.euclidean_distances(centers, squared=True)
+        cost = distances * sizes[:, np.newaxis] * sizes / (sizes[:, np.newaxis] + sizes)
+
+        np.fill_diagonal(cost, np.inf)
+
+        i, j = np.unravel_index(np.argmin(cost), cost.shape)
+
+        centers[i] = (centers[i] * sizes[i] + centers[j] * sizes[j]) / (sizes[i] + sizes[j])
+        sizes[i] += sizes[j]
+
+        centers = np.delete(centers, j, axis=0)
+        sizes = np.delete(sizes, j)
+
+    while len(centers) < n_clusters:
+        furthest = sklearn.metrics.pairwise.euclidean_distances(X, centers, squared=True).min(axis=1).argmax()
+
+        centers = np.vstack([centers, X[furthest]])
+        sizes = np.append(sizes, 1)
+
+    return centers
+
+# the number of neighbouring candidate cluster counts that fit_cluster_run() fits one
+# after another. The sweep's runs are always this long, whatever the number of processes
+# they're spread over, so the results don't depend on it.
+
+WARM_START_RUN = 8
+
+def fit_cluster_run(run):
+
+    """ Clusters the beats into each of a run of neighbouring candidate cluster counts,
+        one after another, with adaptive_kmeans(). Each candidate after the first starts
+        from the clustering of the one before it (see seed_centers()).
+
+        This is the unit of work for the cluster sweep with fast_kmeans. It lives at
+        module level so that it can be shipped to a multiprocessing.Pool.
+
+        Args:
+
+            run: a tuple of (candidates, score). candidates is a list of (n_clusters, X)
+                 tuples, where X is the matrix of normalized eigenvectors for that cluster
+                 count. If score is False, the silhouette scores are left out.
+
+        Returns:
+
+            a list of the result for each candidate: as fit_cluster_candidate() returns
+            it if score is True, or as fit_cluster_labels() returns it if not
+    """
+
+    candidates, score = run
+
+    results = []
+    labels = None
+
+    for n_clusters, X in candidates:
+        init = None if labels is None else seed_centers(X, labels, n_clusters)
+
+        labels, _, _ = adaptive_kmeans(X, n_clusters, init=init)
+
+        if score:
+            results.append((labels, sklearn.metrics.silhouette_score(X, labels)))
+        else:
+            results.append(labels)
+
+    return results
+
+class SilhouetteSweep(object):
+
+    """ Estimates the average silhouette score of each candidate clustering in the
+        auto clustering sweep from a fixed random sample of the beats, reusing the work
+        from one candidate to the next.
+
+        Every candidate clusters the rows of X = evecs[:, :k] / Cnorm[:, k-1:k]. Those
+        rows are unit vectors, so the distance between beats i and j is
+
+            sqrt(2 - 2 * G[i, j] / (Cnorm[i, k-1] * Cnorm[j, k-1]))
+
+        where G is the Gram matrix of the first k eigenvectors. Moving from one candidate
+        to the next adds or removes eigenvectors, which is a low-rank update of G. Only
+        the rows of G for the sampled beats are kept, so each candidate costs
+        O(sample_size * N) instead of the O(N^2 * k) of sklearn.metrics.silhouette_score().
+
+        The silhouette of each sampled beat is exact, because it's measured against every
+        beat and not just the other sampled ones. So the estimate is unbiased. Each
+        silhouette lies in [-1, 1], and so by Hoeffding's inequality (in Serfling's form,
+        for sampling without replacement) the estimate is within
+
+            sqrt(2 * (1 - (sample_size - 1) / N) * ln(2 / delta) / sample_size)
+
+        of the true average with probability at least 1 - delta. For a sample of 1000 of
+        4000 beats and delta = 0.05, that's 0.074. That bound assumes the worst spread of
+        silhouettes; the standard errors in standard_errors are the practical measure,
+        and are typically a few thousandths.
+
+        Args:
+
+            evecs: the Laplacian eigenvectors the candidates are clustered from
+            Cnorm: the cumulative normalization of evecs
+            sample_size: the number of beats to sample. With N or more beats, every
+                         beat is used and the scores are exact.
+            seed: seeds the choice of sample, so that the estimates are repeatable
+    """
+
+    def __init__(self, evecs, Cnorm, sample_size, seed=0):
+
+        n = evecs.shape[0]
+
+        self.__evecs = evecs
+        self.__Cnorm = Cnorm
+        self.__rows = np.sort(np.random.RandomState(seed).choice(n, min(sample_size, n), replace=False))
+        self.__gram = np.zeros((len(self.__rows), n))
+        self.__dimensions = 0
+
+        self.standard_errors = {}
+
+    def __set_dimensions(self, k):
+
+        """ Updates the rows of the Gram matrix to cover the first k eigenvectors """
+
+        if k > self.__dimensions:
+            E = self.__evecs[:, self.__dimensions:k]
+            self.__gram += E[self.__rows].dot(E.T)
+
+        elif k < self.__dimensions:
+            E = self.__evecs[:, k:self.__dimensions]
+            self.__gram -= E[self.__rows].dot(E.T)
+
+        self.__dimensions = k
+
+    def score(self, n_clusters, labels):
+
+        """ Returns the estimated average silhouette score of a candidate clustering, and
+            records its standard error in standard_errors.
+
+            Args:
+
+                n_clusters: the candidate cluster count, and so the number of eigenvectors
+                            the beats were clustered by
+                labels: the cluster label of every beat
+        """
+
+        self.__set_dimensions(n_clusters)
+
+        rows = self.__rows
+        m, n = self.__gram.shape
+        sampled = np.arange(m)
+
+        # the distances from each sampled beat to every beat
+
+        scale = 1.0 / self.__Cnorm[:, n_clusters - 1]
+
+        D = self.__gram * scale[rows, np.newaxis]
+        D *= scale
+        D *= -2.0
+        D += 2.0
+
+        np.maximum(D, 0, out=D)
+        np.sqrt(D, out=D)
+
+        # a beat is no distance from itself, whatever the rounding says
+
+        D[sampled, rows] = 0
+
+        # the total distance from each sampled beat to the beats of each cluster. Labels
+        # are renumbered in case KMeans left a cluster empty.
+
+        _, labels = np.unique(labels, return_inverse=True)
+
+        sizes = np.bincount(labels)
+
+        members = np.zeros((n, len(sizes)))
+        members[np.arange(n), labels] = 1
+
+        totals = D.dot(members)
+
+        # a: the mean distance to the rest of the beat's own cluster.
+        # b: the mean distance to the nearest other cluster.
+
+        own = labels[rows]
+
+        a = totals[sampled, own] / np.maximum(sizes[own] - 1, 1)
+
+        totals /= sizes
+        totals[sampled, own] = np.inf
+
+        b = totals.min(axis=1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            s = np.nan_to_num((b - a) / np.maximum(a, b))
+
+        # as for sklearn, a beat alone in its cluster scores 0
+
+        s[sizes[own] == 1] = 0
+
+        if m < n and m > 1:
+            self.standard_errors[n_clusters] = s.std(ddof=1) / math.sqrt(m) * math.sqrt((n - m) / (n - 1.0))
+        else:
+            self.standard_errors[n_clusters] = 0.0
+
+        return s.mean()
+
+def timelag_median_filter(R, size=7, chunk_size=2**16):
+
+    """ Sparse version of librosa.segment.timelag_filter(scipy.ndimage.median_filter)
+        applied with size=(1, size).
+
+        The dense filter shears the N x N recurrence matrix into a 2N x N lag matrix and
+        median filters every row of it, which costs O(N^2) memory. Since the median of a
+        window can only be non-zero when some of its values are, only the stored entries
+        of R and their neighbours along the same diagonal are visited here. The edges
+        are treated the way the dense filter treats them: 'reflect' along the time axis
+        and zeros past the end of each diagonal.
+
+        Args:
+
+                 R: a square scipy.sparse recurrence matrix
+              size: the length of the median window along each diagonal
+        chunk_size: the number of output candidates filtered at once. Bounds the
+                    temporary memory used.
+
+        Returns:
+
+            the filtered recurrence matrix, as a scipy.sparse.csr_matrix
+    """
+
+    R = scipy.sparse.csr_matrix(R)
+    R.sum_duplicates()
+    R.sort_indices()
+
+    n = R.shape[0]
+
+    rec = R.tocoo()
+
+    # the stored entries, keyed by their position in row-major order so they can
+    # be looked up with a binary search
+
+    keys = rec.row.astype(np.int64) * n + rec.col
+    values = rec.data
+
+    lags = rec.row.astype(np.int64) - rec.col
+    offsets = np.arange(size) - size // 2
+
+    # every position that could end up non-zero: the stored entries, slid up and
+    # down their own diagonal by up to half a window
+
+    cols = (rec.col[:, np.newaxis] + offsets).ravel()
+    lags = np.repeat(lags, size)
+    rows = cols + lags
+
+    valid = (cols >= 0) & (cols < n) & (rows >= 0) & (rows < n)
+    candidates = np.unique(rows[valid] * n + cols[valid])
+
+    out_rows = []
+    out_cols = []
+    out_values = []
+
+    for chunk in range(0, len(candidates), chunk_size):
+
+        cand = candidates[chunk:chunk+chunk_size]
+        cand_rows = cand // n
+        cand_cols = cand % n
+
+        # gather each candidate's window along its diagonal, reflecting at the
+        # first and last columns
+
+        win_cols = cand_cols[:, np.newaxis] + offsets
+        win_cols = np.where(win_cols < 0, -win_cols - 1, win_cols)
+        win_cols = np.where(win_cols >= n, 2 * n - win_cols - 1, win_cols)
+        win_rows = win_cols + (cand_rows - cand_cols)[:, np.newaxis]
+
+        in_bounds = (win_rows >= 0) & (win_rows < n)
+        win_keys = np.where(in_bounds, win_rows * n + win_cols, 0)
+
+        pos = np.minimum(np.searchsorted(keys, win_keys), len(keys) - 1)
+        found = in_bounds & (keys[pos] == win_keys)
+
+        medians = np.median(np.where(found, values[pos], 0), axis=1)
+
+        keep = medians != 0
+
+        out_rows.append(cand_rows[keep])
+        out_cols.append(cand_cols[keep])
+        out_values.append(medians[keep])
+
+    if len(out_values) == 0:
+        return scipy.sparse.csr_matrix(R.shape, dtype=R.dtype)
+
+    return scipy.sparse.csr_matrix((np.concatenate(out_values),
+                                    (np.concatenate(out_rows), np.concatenate(out_cols))),
+                                   shape=R.shape)
+
+def laplacian_eigenvectors(L, k):
+
+    """ Computes the eigenvectors for the k smallest eigenvalues of a sparse,
+        normalized graph Laplacian, in ascending order of eigenvalue.
+
+        The eigenvalues of a normalized Laplacian lie in [0, 2], so the smallest ones
+        are found as the largest ones of (I - L) with the Lanczos solver in
+        scipy.sparse.linalg.eigsh. That converges far faster than asking eigsh for the
+        smallest eigenvalues of L directly. The starting vector is fixed so the result
+        is repeatable.
+
+        The diagonal median filter can leave L slightly asymmetric. scipy.linalg.eigh
+        only reads the lower triangle, so L is mirrored from its lower triangle here
+        too, which makes the result match the dense decomposition.
+
+        Args:
+
+            L: the normalized Laplacian, as a scipy.sparse matrix
+            k: the number of eigenvectors to compute
+
+        Returns:
+
+            an N x k matrix whose columns are the eigenvectors
+    """
+
+    n = L.shape[0]
+
+    # Lanczos needs k < N. A matrix that small is cheap to decompose densely anyway.
+
+    if k >= n - 1:
+        _, evecs = scipy.linalg.eigh(L.toarray())
+        return evecs[:, :k]
+
+    L = scipy.sparse.tril(L, format='csr')
+    L = L + scipy.sparse.tril(L, k=-1, format='csr').T
+
+    M = scipy.sparse.identity(n, format='csr') - L
+
+    v0 = np.random.RandomState(0).uniform(-1, 1, n)
+
+    _, evecs = scipy.sparse.linalg.eigsh(M, k=k, which='LA', v0=v0)
+
+    # eigsh returns the eigenvalues of (I - L) in ascending order, which is
+    # descending order for L
+
+    return evecs[:, ::-1]
+
+def warm_up(sr=22050, seconds=10.0):
+
+    """ Runs a tiny analysis of a synthetic click track, so that the one-off costs
+        of the analysis (numba compiling librosa's kernels, building the CQT filters,
+        loading the BLAS and sklearn internals) are paid before a real song arrives.
+        A long-lived worker process calls this once when it starts.
+
+        Args:
+
+            sr: the sample rate to warm up at. The CQT filters depend on it.
+            seconds: the length of the synthetic audio
+
+        Returns:
+
+            the time the warm-up took, in seconds
+    """
+
+    start = time.time()
+
+    # a click every half second over a few slowly changing tones, so that there
+    # are beats to track and more than one kind of beat to cluster
+
+    t = np.arange(int(sr * seconds)) / float(sr)
+
+    y = 0.1 * np.sin(2 * np.pi * 220.0 * (1 + (t // 2) % 3) * t)
+    y[(np.arange(len(t)) % (sr // 2)) < 64] += 0.5
+
+    y = y.astype(np.float32)
+
+    BINS_PER_OCTAVE = 12 * 3
+    N_OCTAVES = 7
+
+    cqt = librosa.cqt(y=y, sr=sr, bins_per_octave=BINS_PER_OCTAVE, n_bins=N_OCTAVES * BINS_PER_OCTAVE)
+    C = librosa.amplitude_to_db(np.abs(cqt), ref=np.max)
+
+    tempo, btz, mfcc, amplitudes = extract_beat_features(y, sr, trim=True)
+
+    Csync = librosa.util.sync(C, btz, aggregate=np.median)
+
+    R = librosa.segment.recurrence_matrix(Csync, width=3, mode='affinity', sym=True)
+    L = scipy.sparse.csgraph.laplacian(R, normed=True)
+
+    _, evecs = scipy.linalg.eigh(L)
+
+    X = evecs[:, :3] / (np.cumsum(evecs**2, axis=1)**0.5)[:, 2:3]
+
+    fit_cluster_candidate((3, X))
+
+    return time.time() - start
+
+class JumpCandidateIndex(object):
+
+    """ Finds the jump candidates for beats by lookup instead of by scanning the
+        whole song for every beat.
+
+        A beat's jump candidates are the beats that sit in the same cluster, at the same
+        position in their segment and (optionally) at the same position in the bar as
+        the beat that would otherwise play next. This index groups the beats by that
+        (cluster, is, id % 4) key once, with each group kept as a sorted NumPy array of
+        beat ids. A beat's candidates then come from one lookup and a vectorized filter
+        of a single group.
+
+        Beat ids are the beats' positions in the arrays that are passed in.
+    """
+
+    def __init__(self, cluster, position, segment, first=0, match_bar_position=True):
+
+        """ Builds the index.
+
+            Args:
+
+                           cluster: the cluster of each beat
+                          position: the position of each beat in its segment (its 'is')
+                           segment: the segment of each beat
+                             first: beats before this position are never jump candidates
+                match_bar_position: set to False to ignore where in the bar (id % 4) a
+                                    beat falls when matching candidates
+        """
+
+        ids = np.arange(len(segment), dtype=np.int64)
+
+        keys = [np.asarray(cluster, dtype=np.int64), np.asarray(position, dtype=np.int64)]
+
+        if match_bar_position:
+            keys.append(ids % 4)
+
+        self.__keys = np.stack(keys, axis=1)
+        self.__segments = np.asarray(segment, dtype=np.int64)
+        self.__empty = np.array([], dtype=np.int64)
+        self.__groups = {}
+
+        # sort the jumpable beats by key, and by id within each key, then cut the
+        # sorted ids wherever the key changes
+
+        ids = ids[first:]
+
+        if len(ids) == 0:
+            return
+
+        order = ids[np.lexsort([ids] + [k[first:] for k in reversed(keys)])]
+        sorted_keys = self.__keys[order]
+
+        bounds = np.flatnonzero(np.any(np.diff(sorted_keys, axis=0) != 0, axis=1)) + 1
+        bounds = [0] + bounds.tolist() + [len(order)]
+
+        for begin, end in zip(bounds[:-1], bounds[1:]):
+            self.__groups[tuple(sorted_keys[begin].tolist())] = order[begin:end]
+
+    def candidates(self, beat_id, next_id, before=None):
+
+        """ Returns the ids of the beats to which it is reasonable to jump instead of
+            playing beat next_id after beat beat_id. Those are the beats that match
+            next_id's group, but that AREN'T next_id itself and AREN'T in beat_id's
+            segment.
+
+            Args:
+
+                beat_id: the id of the beat that is playing
+                next_id: the id of the beat that would play next if there were no jump
+                 before: if set, only beats with a lower id are considered
+
+            Returns:
+
+                a list of beat ids, in ascending order
+        """
+
+        ids = self.__groups.get(tuple(self.__keys[next_id].tolist()), self.__empty)
+
+        if before is not None:
+            ids = ids[:np.searchsorted(ids, before)]
+
+        keep = (self.__segments[ids] != self.__segments[beat_id]) & (ids != next_id)
+
+        return ids[keep].tolist()
+
+class BeatView(collections.abc.MutableMapping):
+
+    """ A dictionary-like view of one beat in a BeatTable.
+
+        Reading a key returns a plain Python value, so a view can stand in anywhere a
+        beat dictionary used to. 'jump_candidates' comes back as a list and 'buffer'
+        as a slice of the table's raw audio. Assigning a key writes through to the
+        table. Keys can't be added or removed.
+    """
+
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __getitem__(self, key):
+
+        if key in self.table.columns.dtype.names:
+            return self.table.columns[key][self.index].item()
+
+        if key == 'jump_candidates' and self.table.jump_offsets is not None:
+            return self.table.jump_candidates(self.index).tolist()
+
+        if key == 'buffer' and self.table.raw_audio is not None:
+            return self.table.buffer(self.index)
+
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+
+        if key in self.table.columns.dtype.names:
+            self.table.columns[key][self.index] = value
+        elif key == 'jump_candidates':
+            self.table.set_jump_candidates(self.index, value)
+        elif key == 'buffer':
+            raise TypeError("a beat's buffer is always raw_audio[start_index:stop_index]")
+        else:
+            raise KeyError(key)
+
+    def __delitem__(self, key):
+        raise TypeError('keys cannot be removed from a beat')
+
+    def __iter__(self):
+        return iter(self.table.keys())
+
+    def __len__(self):
+        return len(self.table.keys())
+
+    def __eq__(self, other):
+
+        if isinstance(other, BeatView):
+            return self.table is other.table and self.index == other.index
+
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'BeatView(%r)' % {k: v for k, v in self.items() if k != 'buffer'}
+
+class BeatTable(collections.abc.Sequence):
+
+    """ The beats of a song, stored column by column.
+
+        Every per-beat scalar (start, duration, cluster, segment, ...) is a field of one
+        NumPy structured array, and the jump candidates of all the beats are packed
+        into two flat arrays in CSR (compressed sparse row) form: the candidates of
+        beat i are jump_targets[jump_offsets[i]:jump_offsets[i+1]]. A beat's audio
+        isn't copied at all. Its buffer is sliced out of raw_audio when asked for.
+
+        That costs a few dozen bytes per beat, against a dictionary, a list and an
+        array view per beat for a list of beat dictionaries. Indexing the table still
+        gives a dictionary-like BeatView, so code written against the old list of
+        dictionaries keeps working. Code that touches every beat should read the
+        columns directly.
+
+        Attributes:
+
+                 columns: the structured array of per-beat values. Which fields it has
+                          depends on how the table was built. See FIELDS.
+            jump_offsets: int64 array of len(table) + 1 offsets into jump_targets, or
+                          None if the table has no jump candidates
+            jump_targets: int32 array of the packed jump candidate ids
+               raw_audio: the audio the start_index/stop_index fields point into, or None
+    """
+
+    # the per-beat fields a table can hold, in the order they are kept
+
+    FIELDS = (('start', np.float64),
+              ('cluster', np.int32),
+              ('amplitude', np.float64),
+              ('segment', np.int32),
+              ('is', np.int32),
+              ('duration', np.float64),
+              ('start_index', np.int64),
+              ('stop_index', np.int64),
+              ('id', np.int32),
+              ('quartile', np.float64),
+              ('next', np.int32))
+
+    def __init__(self, columns, jump_offsets=None, jump_targets=None, raw_audio=None):
+        self.columns = columns
+        self.jump_offsets = jump_offsets
+        self.jump_targets = jump_targets
+        self.raw_audio = raw_audio
+
+    @classmethod
+    def dtype(cls, names):
+
+        """ The structured dtype for a table holding the given fields, in FIELDS order. """
+
+        return np.dtype([(name, kind) for name, kind in cls.FIELDS if name in names])
+
+    @classmethod
+    def from_dicts(cls, beats, raw_audio=None):
+
+        """ Builds a table from a list of beat dictionaries.
+
+            The fields are the ones in FIELDS that the first beat has. 'jump_candidates'
+            is packed if the first beat has it, and 'buffer' is never copied; pass the
+            audio it was sliced from as raw_audio instead. Other keys are ignored. Every
+            beat must have the same fields (and 'jump_candidates', or not) as the first,
+            or a ValueError is raised.
+
+            Args:
+
+                    beats: a list of beat dictionaries
+                raw_audio: the audio the beats' start_index/stop_index point into
+        """
+
+        first = beats[0] if len(beats) > 0 else {}
+
+        # a table has one set of fields, so a beat that has more or fewer of them than
+        # the first can't be stored in it
+
+        keys = [name for name, _ in cls.FIELDS] + ['jump_candidates']
+
+        for i, beat in enumerate(beats):
+            differing = [name for name in keys if (name in beat) != (name in first)]
+
+            if len(differing) > 0:
+                raise ValueError('beat %d and the first beat differ in the fields %s' % (i, ', '.join(differing)))
+
+        dtype = cls.dtype(first.keys())
+        columns = np.array([tuple(b[name] for name in dtype.names) for b in beats], dtype=dtype)
+
+        jump_offsets, jump_targets = None, None
+
+        if 'jump_candidates' in first:
+            jump_offsets, jump_targets = cls.pack_jump_candidates([b['jump_candidates'] for b in beats])
+
+        return cls(columns, jump_offsets, jump_targets, raw_audio)
+
+    @staticmethod
+    def pack_jump_candidates(candidates):
+
+        """ Packs a list of per-beat jump candidate lists into CSR form.
+
+            Returns:
+
+                a tuple of (jump_offsets, jump_targets)
+        """
+
+        jump_offsets = np.zeros(len(candidates) + 1, dtype=np.int64)
+        jump_offsets[1:] = np.cumsum([len(c) for c in candidates])
+
+        jump_targets = np.fromiter(itertools.chain.from_iterable(candidates), dtype=np.int32,
+                                   count=int(jump_offsets[-1]))
+
+        return jump_offsets, jump_targets
+
+    def to_dicts(self, include_buffer=False):
+
+        """ Exports the table as a list of plain beat dictionaries, e.g. for JSON.
+
+            Args:
+
+                include_buffer: set to True to include each beat's 'buffer' slice
+        """
+
+        names = self.columns.dtype.names
+
+        beats = [dict(zip(names, row)) for row in self.columns.tolist()]
+
+        if self.jump_offsets is not None:
+            targets = self.jump_targets.tolist()
+            offsets = self.jump_offsets.tolist()
+
+            for i, beat in enumerate(beats):
+                beat['jump_candidates'] = targets[offsets[i]:offsets[i+1]]
+
+        if include_buffer and self.raw_audio is not None:
+            for i, beat in enumerate(beats):
+                beat['buffer'] = self.buffer(i)
+
+        return beats
+
+    def to_arrays(self, prefix=''):
+
+        """ Exports the table as a dictionary of plain arrays, e.g. for np.savez. The
+            audio is left out. See from_arrays().
+
+            Args:
+
+                prefix: prepended to every key, so several tables can share a dictionary
+        """
+
+        arrays = {prefix + 'columns': self.columns}
+
+        if self.jump_offsets is not None:
+            arrays[prefix + 'jump_offsets'] = self.jump_offsets
+            arrays[prefix + 'jump_targets'] = self.jump_targets
+
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, raw_audio=None, prefix=''):
+
+        """ Rebuilds a table exported by to_arrays().
+
+            Args:
+
+                   arrays: the dictionary of arrays
+                raw_audio: the audio the beats' start_index/stop_index point into
+                   prefix: the prefix the table was exported with
+        """
+
+        return cls(arrays[prefix + 'columns'],
+                   arrays.get(prefix + 'jump_offsets'),
+                   arrays.get(prefix + 'jump_targets'),
+                   raw_audio)
+
+    def keys(self):
+
+        """ The keys every BeatView of this table has. """
+
+        keys = list(self.columns.dtype.names)
+
+        if self.jump_offsets is not None:
+            keys.append('jump_candidates')
+
+        if self.raw_audio is not None:
+            keys.append('buffer')
+
+        return keys
+
+    def jump_candidates(self, i):
+
+        """ The jump candidates of beat i, as a read-only slice of jump_targets. """
+
+        return self.jump_targets[self.jump_offsets[i]:self.jump_offsets[i+1]]
+
+    def jump_counts(self):
+
+        """ The number of jump candidates of every beat, as an array. """
+
+        return np.diff(self.jump_offsets)
+
+    def set_jump_candidates(self, i, candidates):
+
+        """ Replaces the jump candidates of beat i. This repacks the whole CSR array,
+            so it is meant for occasional edits rather than for building a table.
+        """
+
+        i = self.__position(i)
+
+        lists = [self.jump_candidates(b).tolist() for b in range(len(self))]
+        lists[i] = list(candidates)
+
+        self.jump_offsets, self.jump_targets = self.pack_jump_candidates(lists)
+
+    def buffer(self, i):
+
+        """ The audio of beat i: raw_audio[start_index:stop_index]. """
+
+        row = self.columns[i]
+
+        return self.raw_audio[row['start_index']:row['stop_index']]
+
+    def __position(self, i):
+
+        if i < 0:
+            i += len(self)
+
+        if i < 0 or i >= len(self):
+            raise IndexError('beat index out of range')
+
+        return i
+
+    def __len__(self):
+        return len(self.columns)
+
+    def __getitem__(self, i):
+
+        if isinstance(i, slice):
+            return [BeatView(self, b) for b in range(*i.indices(len(self)))]
+
+        return BeatView(self, self.__position(int(i)))
+
+    def __iter__(self):
+        return (BeatView(self, b) for b in range(len(self)))
+
+class AnalysisCache(object):
+
+    """ A cache of finished analyses, on disk, shared by every front end.
+
+        Entries are keyed by a hash of the audio file's content plus the analysis
+        parameters (see key()), so two songs with the same file name never collide
+        and the same audio is never analysed twice with the same settings, whatever
+        it is called. Each entry is a directory holding meta.json (the schema version
+        and the plain values) and one .npy file per NumPy array, so that big arrays
+        (like audio) can be memory-mapped straight out of the cache rather than read.
+
+        Entries are written into a staging directory and renamed into place, so a
+        reader sees a whole entry or none at all. Reading an entry marks it as used,
+        and once the cache grows past max_bytes the least recently used entries are
+        evicted. Bump SCHEMA_VERSION whenever what is stored changes; entries written
+        with another version are never read.
+
+        Attributes:
+
+            cache_dir: the directory the entries live in
+            max_bytes: evict entries once the cache is larger than this. None means
+                       the cache is never trimmed.
+    """
+
+    SCHEMA_VERSION = 2
+
+    def __init__(self, cache_dir, max_bytes=1024 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def content_hash(filename, chunk_size=1024 * 1024):
+
+        """ The SHA-256 of a file's content, as a hex string. """
+
+        sha = hashlib.sha256()
+
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                sha.update(chunk)
+
+        return sha.hexdigest()
+
+    def key(self, content_hash, **params):
+
+        """ The key of the entry for some audio analysed with some parameters.
+
+            Args:
+
+                content_hash: the content_hash() of the audio file
+                      params: the analysis parameters. They must be JSON serializable.
+        """
+
+        description = json.dumps({'schema': self.SCHEMA_VERSION,
+                                  'content': content_hash,
+                                  'params': params}, sort_keys=True)
+
+        return hashlib.sha256(description.encode('utf-8')).hexdigest()
+
+    def load(self, key, mmap=()):
+
+        """ Reads an entry and marks it as recently used.
+
+            Args:
+
+                 key: the key() of the entry
+                mmap: the names of the arrays to memory-map (read only) instead of read
+
+            Returns:
+
+                a tuple of (values, arrays) -- the dictionaries passed to store() -- or
+                None if there's no usable entry for key
+        """
+
+        entry = os.path.join(self.cache_dir, key)
+
+        try:
+            with open(os.path.join(entry, 'meta.json'), 'r') as f:
+                meta = json.load(f)
+
+            if meta.get('schema') != self.SCHEMA_VERSION:
+                return None
+
+            arrays = {}
+
+            for name in meta['arrays']:
+                arrays[name] = np.load(os.path.join(entry, name + '.npy'), allow_pickle=False,
+                                       mmap_mode='r' if name in mmap else None)
+
+            os.utime(entry)
+
+        except (OSError, ValueError, KeyError):
+            return None
+
+        return meta['values'], arrays
+
+    def store(self, key, values, arrays):
+
+        """ Writes an entry, replacing any entry already stored under key, then evicts
+            the least recently used entries if the cache has grown too large.
+
+            Args:
+
+                     key: the key() of the entry
+                values: a dictionary of JSON serializable values
+                arrays: a dictionary of NumPy arrays, named like variables. Object arrays
+                        aren't allowed.
+        """
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        entry = os.path.join(self.cache_dir, key)
+        staging = tempfile.mkdtemp(prefix='.staging-', dir=self.cache_dir)
+
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(staging, name + '.npy'), array, allow_pickle=False)
+
+            with open(os.path.join(staging, 'meta.json'), 'w') as f:
+                json.dump({'schema': self.SCHEMA_VERSION, 'values': values, 'arrays': sorted(arrays)}, f)
+
+            # an existing entry is moved aside rather than overwritten in place, so
+            # that nobody ever reads half of one
+
+            self.remove(key)
+
+            try:
+                os.rename(staging, entry)
+            except OSError:
+                # another process stored the same entry first. Keep theirs.
+                pass
+
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+        self.evict(keep=key)
+
+    def remove(self, key):
+
+        """ Removes the entry for key, if there is one. """
+
+        entry = os.path.join(self.cache_dir, key)
+
+        if not os.path.isdir(entry):
+            return
+
+        retired = tempfile.mkdtemp(prefix='.retired-', dir=self.cache_dir)
+
+        try:
+            os.rename(entry, os.path.join(retired, key))
+        except OSError:
+            pass
+
+        shutil.rmtree(retired, ignore_errors=True)
+
+    def remove_arrays(self, key, names):
+
+        """ Removes some of the arrays from the entry for key, if there is one. The rest
+            of the entry is kept.
+        """
+
+        entry = os.path.join(self.cache_dir, key)
+
+        try:
+            with open(os.path.join(entry, 'meta.json'), 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        meta['arrays'] = [name for name in meta.get('arrays', []) if name not in names]
+
+        # rewrite meta.json first, so the entry never lists an array that's gone
+
+        staging = os.path.join(entry, '.meta.json')
+
+        with open(staging, 'w') as f:
+            json.dump(meta, f)
+
+        os.replace(staging, os.path.join(entry, 'meta.json'))
+
+        for name in names:
+            try:
+                os.remove(os.path.join(entry, name + '.npy'))
+            except OSError:
+                pass
+
+    def evict(self, keep=None):
+
+        """ Removes the least recently used entries until the cache is no larger than
+            max_bytes. The entry for keep is never removed.
+        """
+
+        if self.max_bytes is None or not os.path.isdir(self.cache_dir):
+            return
+
+        entries = []
+
+        for name in os.listdir(self.cache_dir):
+
+            entry = os.path.join(self.cache_dir, name)
+
+            # skip anything that's still being written or removed
+
+            if name.startswith('.') or not os.path.isdir(entry):
+                continue
+
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, name))
+            except OSError:
+                continue
+
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, name in sorted(entries):
+
+            if total <= self.max_bytes:
+                break
+
+            if name != keep:
+                self.remove(name)
+                total -= size
+
+# the number of entries in InfiniteJukebox.play_vector: the first beat plus 1024 * 1024 more
+
+PLAY_VECTOR_LENGTH = 1024 * 1024 + 1
+
+class PlayVectorState(object):
+
+    """ Where a play vector generator (see PlayVectorEngine) is up to.
+
+        The generator updates this as it yields each entry. Hand it back to the
+        generator to carry on with the same remix from the next entry. It holds nothing
+        but plain values, a NumPy RandomState and a few small buffers, so it can be copied
+        or pickled to save a remix's place.
+
+        Attributes:
+
+                    rng: the numpy.random.RandomState behind the remix's choices
+                  draws: a block of uniform random numbers drawn from rng ahead of time
+             draw_index: the next unused number in draws
+               position: the number of entries generated so far
+                   beat: the id of the beat the last entry played
+           min_sequence: the length of the current sequence (an entry's seq_len)
+       current_sequence: the position in the current sequence (an entry's seq_pos)
+       beats_since_jump: the number of beats played since the last jump
+           failed_jumps: the number of jumps in a row that found no good candidate
+          recent_bitmap: a bytearray with a 1 for every recently played segment
+            recent_ring: the recently played segments, oldest first from recent_head
+            recent_head: where in recent_ring the next recent segment goes
+           recent_count: how many of the recent_ring slots are in use
+    """
+
+    def __init__(self, seed=None):
+        self.rng = np.random.RandomState(seed)
+        self.draws = []
+        self.draw_index = 0
+        self.position = 0
+        self.beat = 0
+        self.min_sequence = 0
+        self.current_sequence = 0
+        self.beats_since_jump = 0
+        self.failed_jumps = 0
+        self.recent_bitmap = None
+        self.recent_ring = None
+        self.recent_head = 0
+        self.recent_count = 0
+
+class PlayVectorEngine(object):
+
+    """ Computes the play vector -- a never ending, random(ish) play path through a
+        song -- from a BeatTable.
+
+        Everything about the beats that the jump logic needs is worked out once, up
+        front: the next beat and the segment of every beat, every beat's jump
+        candidates along with their segments, and each beat's fallback jump (the
+        candidate furthest away in another quartile of the song). The set of recently
+        played segments is a bitmap plus a ring buffer of fixed size instead of a deque
+        that has to be searched. All of the random choices come from a seedable
+        numpy.random.RandomState, drawn DRAW_BLOCK at a time, so the same seed always
+        gives the same remix.
+    """
+
+    # how many random numbers to draw from the RandomState at once
+
+    DRAW_BLOCK = 4096
+
+    def __init__(self, beats, tempo, start_beat, restart_after=.2):
+
+        """ Args:
+
+                    beats: the BeatTable to play. It must have its 'next', 'segment' and
+                           'quartile' columns and its jump candidates.
+                    tempo: the tempo of the song, in beats per minute
+               start_beat: the beat to start over from if the remix gets stuck
+            restart_after: give up and start over from start_beat after failing to jump
+                           for this fraction of the song's beats
+        """
+
+        columns = beats.columns
+
+        self.__beat_count = len(beats)
+        self.__start_beat = start_beat
+        self.__restart_after = restart_after
+
+        self.__next = columns['next'].tolist()
+        self.__segments = columns['segment'].tolist()
+        self.__segment_count = max(self.__segments) + 1
+
+        # every beat's jump candidates, and the segment each of them is in
+
+        offsets = beats.jump_offsets
+        targets = beats.jump_targets.astype(np.intp)
+
+        candidate_segments = columns['segment'][targets].tolist()
+        targets = targets.tolist()
+
+        self.__candidates = [targets[offsets[b]:offsets[b + 1]] for b in range(self.__beat_count)]
+        self.__candidate_segments = [candidate_segments[offsets[b]:offsets[b + 1]] for b in range(self.__beat_count)]
+
+        # how long should our longest contiguous playback blocks be? One way to
+        # consider it is that higher bpm songs need longer blocks because
+        # each beat takes less time. A simple way to estimate a good value
+        # is to scale it by it's distance from 120bpm -- the canonical bpm
+        # for popular music. Find that value and round down to the nearest
+        # multiple of 4. (There almost always are 4 beats per measure in Western music).
+
+        max_sequence_len = int(round((tempo / 120.0) * 48.0))
+        max_sequence_len = max_sequence_len - (max_sequence_len % 4)
+
+        # sequence lengths are drawn from [16, max_sequence_len) in steps of 4
+
+        self.__sequence_choices = len(range(16, max_sequence_len, 4))
+
+        # we want to keep a list of recently played segments so we don't accidentally wind up in a local loop
+        #
+        # the number of segments in a song will vary so we want to set the number of recents to keep
+        # at 25% of the total number of segments. Eg: if there are 34 segments, then the depth will
+        # be set at round(8.5) == 9.
+        #
+        # On the off chance that the (# of segments) *.25 < 1 we set a floor queue depth of 1
+
+        recent_depth = int(round(self.__segment_count * .25))
+        self.__recent_depth = max( recent_depth, 1 )
+
+        # keep track of the time since the last successful jump. If we go more than
+        # 10% of the song length since our last jump, then we will prioritize an
+        # immediate jump to a not recently played segment. Otherwise playback will
+        # be boring for the listener. This also has the advantage of busting out of
+        # local loops.
+
+        self.__max_beats_between_jumps = int(round(self.__beat_count * .1))
+
+        self.__furthest = self.__furthest_other_quartile_candidates(beats)
+
+    def __furthest_other_quartile_candidates(self, beats):
+
+        """ For every beat, finds the jump candidate that's furthest from it while being
+            in a different quartile of the song (the first one, if there's a tie). That
+            is where the remix goes when it has failed to find a good jump for too long.
+            Beats without such a candidate get -1.
+        """
+
+        counts = beats.jump_counts()
+        owners = np.repeat(np.arange(self.__beat_count), counts)
+        targets = beats.jump_targets.astype(np.intp)
+
+        quartile = beats.columns['quartile']
+
+        distance = np.where(quartile[targets] != quartile[owners], np.abs(targets - owners), -1)
+
+        furthest = np.full(self.__beat_count, -1, dtype=np.intp)
+
+        if len(targets) == 0:
+            return furthest.tolist()
+
+        # the largest distance per beat, then the first candidate at that distance
+
+        has_candidates = counts > 0
+        best = np.full(self.__beat_count, -1, dtype=distance.dtype)
+        best[has_candidates] = np.maximum.reduceat(distance, beats.jump_offsets[:-1][has_candidates])
+
+        hits = np.flatnonzero((distance == best[owners]) & (distance >= 0))
+        hit_owners, first = np.unique(owners[hits], return_index=True)
+
+        furthest[hit_owners] = targets[hits[first]]
+
+        return furthest.tolist()
+
+    def __draw(self, state):
+
+        """ The next uniform random number in [0, 1) for the remix in state. """
+
+        if state.draw_index == len(state.draws):
+            state.draws = state.rng.random_sample(self.DRAW_BLOCK).tolist()
+            state.draw_index = 0
+
+        state.draw_index += 1
+
+        return state.draws[state.draw_index - 1]
+
+    def iter_entries(self, state):
+
+        """ Generates the play vector, one {'beat', 'seq_len', 'seq_pos'} entry at a time,
+            starting after the last entry recorded in state. state is kept up to date as
+            each entry is yielded.
+        """
+
+        nxt = self.__next
+        segments = self.__segments
+        furthest = self.__furthest
+        candidates = self.__candidates
+        candidate_segments = self.__candidate_segments
+        sequence_choices = self.__sequence_choices
+
+        beat_count = self.__beat_count
+        recent_depth = self.__recent_depth
+        max_beats_between_jumps = self.__max_beats_between_jumps
+
+        draw = self.__draw
+
+        if state.position == 0:
+
+            # pick a random sequence length between 16 and max_sequence_len, evenly
+            # divisible by 4
+
+            state.min_sequence = max(16 + 4 * int(draw(state) * sequence_choices), self.__start_beat)
+            state.current_sequence = 0
+            state.beat = 0
+            state.recent_bitmap = bytearray(self.__segment_count)
+            state.recent_ring = [0] * recent_depth
+            state.recent_head = 0
+            state.recent_count = 0
+            state.position = 1
+
+            yield {'beat':0, 'seq_len':state.min_sequence, 'seq_pos':state.current_sequence}
+
+        beat = state.beat
+        min_sequence = state.min_sequence
+        current_sequence = state.current_sequence
+        beats_since_jump = state.beats_since_jump
+        failed_jumps = state.failed_jumps
+
+        recent = state.recent_bitmap
+        ring = state.recent_ring
+        head = state.recent_head
+        count = state.recent_count
+
+        while True:
+
+            # remember this segment as recently played, forgetting the oldest one if
+            # the ring is full
+
+            segment = segments[beat]
+
+            if not recent[segment]:
+
+                if count == recent_depth:
+                    recent[ring[head]] = 0
+                else:
+                    count += 1
+
+                ring[head] = segment
+                recent[segment] = 1
+                head = (head + 1) % recent_depth
+
+            current_sequence += 1
+
+            # it's time to attempt a jump if we've played all the beats we wanted in the
+            # current sequence. Also, if we've gone more than 10% of the length of the song
+            # without jumping we need to immediately prioritze jumping to a non-recent segment.
+
+            if (current_sequence == min_sequence) or (beats_since_jump >= max_beats_between_jumps):
+
+                # find the jump candidates that haven't been recently played
+
+                non_recent_candidates = [c for c, s in zip(candidates[beat], candidate_segments[beat])
+                                         if not recent[s]]
+
+                # if there aren't any good jump candidates, then we need to fall back
+                # to another selection scheme.
+
+                if len(non_recent_candidates) == 0:
+
+                    beats_since_jump += 1
+                    failed_jumps += 1
+
+                    # suppose we've been trying to jump but couldn't find a good non-recent candidate. If
+                    # the length of time we've been trying (and failing) is >= 10% of the song length
+                    # then it's time to relax our criteria and go to the precomputed furthest
+                    # candidate in another quartile of the song (irrespective if it's been played
+                    # recently). That way we maximize our chances of avoiding a long local loop -- such as
+                    # might be found in the section preceeding the outro of a song.
+
+                    if (failed_jumps >= (.1 * beat_count)) and (furthest[beat] >= 0):
+                        beat = furthest[beat]
+                        beats_since_jump = 0
+                        failed_jumps = 0
+
+                    # uh oh! That fallback hasn't worked for yet ANOTHER stretch
+                    # of the song length. Something is seriously broken. Time
+                    # to punt and just start again from the first beat.
+
+                    elif failed_jumps >= (self.__restart_after * beat_count):
+                        beats_since_jump = 0
+                        failed_jumps = 0
+                        beat = self.__start_beat
+
+                    # asuuming we're not in one of the failure modes but haven't found a good
+                    # candidate that hasn't been recently played, just play the next beat in the
+                    # sequence
+
+                    else:
+                        beat = nxt[beat]
+
+                else:
+
+                    # if it's time to jump and we have at least one good non-recent
+                    # candidate, let's just pick randomly from the list and go there
+
+                    beats_since_jump = 0
+                    failed_jumps = 0
+                    beat = non_recent_candidates[int(draw(state) * len(non_recent_candidates))]
+
+                # reset our sequence position counter and pick a new target length
+                # between 16 and max_sequence_len, making sure it's evenly divisible by
+                # 4 beats
+
+                current_sequence = 0
+                min_sequence = 16 + 4 * int(draw(state) * sequence_choices)
+
+                # if we're in the place where we want to jump but can't because
+                # we haven't found any good candidates, then set current_sequence equal to
+                # min_sequence. During playback this will show up as having 00 beats remaining
+                # until we next jump. That's the signal that we'll jump as soon as we possibly can.
+                #
+                # Code that reads play_vector and sees this value can choose to visualize this in some
+                # interesting way.
+
+                if beats_since_jump >= max_beats_between_jumps:
+                    current_sequence = min_sequence
+
+            else:
+
+                # if we're not trying to jump then just play the next beat
+                beat = nxt[beat]
+                beats_since_jump += 1
+
+            # remember where we are, so that the remix can be resumed after this entry
+
+            state.beat = beat
+            state.min_sequence = min_sequence
+            state.current_sequence = current_sequence
+            state.beats_since_jump = beats_since_jump
+            state.failed_jumps = failed_jumps
+            state.recent_head = head
+            state.recent_count = count
+            state.position += 1
+
+            yield {'beat':beat, 'seq_len':min_sequence, 'seq_pos':current_sequence}
+
 class InfiniteJukebox(object):
 
     """ Class to "infinitely" remix a song.
@@ -76,8 +2063,8 @@ class InfiniteJukebox(object):
                  this will be reflected here. If you let the algorithm decide, then auto-generated
                  value will be reflected here.
 
-          beats: a dictionary containing the individual beats of the song in normal order. Each
-                 beat will have the following keys:
+          beats: a BeatTable containing the individual beats of the song in normal order. Each
+                 beat reads like a dictionary with the following keys:
 
                          id: the ordinal position of the beat in the song
                       start: the time (in seconds) in the song where this beat occurs
@@ -115,6 +2102,8 @@ class InfiniteJukebox(object):
                  remix of this song that will last beat['duration'] * 1024 * 1024
                  seconds long. A song that is 120bpm will have a beat duration of .5 sec,
                  so this playlist will last .5 * 1024 * 1024 seconds -- or 145.67 hours.
+                 It is only built when first read. iter_play_vector() yields the same kind
+                 of remix one entry at a time, without building the list.
 
                  Each item contains:
 
@@ -124,10 +2113,18 @@ class InfiniteJukebox(object):
                  seq_pos: this beat's position in seq_len. When
                           seq_len - seq_pos == 0 the song will "jump"
 
+        timings: a dictionary of how long (in seconds) each stage of the processing took,
+                 in the order the stages ran. See timing_report() for a printable version.
+
+      cache_key: the key of this song's entry in the AnalysisCache passed to the
+                 constructor, or None if no cache was passed.
+
     """
 
     def __init__(self, filename, start_beat=1, clusters=0, progress_callback=None,
-                 do_async=False, use_v1=False):
+                 do_async=False, use_v1=False, n_jobs=None, sparse_eigen=False, cache=None,
+                 content_hash=None, pcm_path=None, streaming=False, analysis_sr=None,
+                 silhouette_sample=None, fast_kmeans=False):
 
         """ The constructor for the class. Also starts the processing thread.
 
@@ -149,6 +2146,46 @@ class InfiniteJukebox(object):
                                       message: STRING with the progress message
                   use_v1: set to True if you want to use the original auto clustering algorithm.
                           Otherwise, it will use the newer silhouette-based scheme.
+                  n_jobs: the number of processes used to test candidate cluster counts in
+                          parallel. The DEFAULT of None uses every core. Pass 1 to do all
+                          the work in the calling process.
+            sparse_eigen: set to True to keep the recurrence matrices sparse and compute
+                          only the eigenvectors the clustering needs. Memory then grows
+                          roughly linearly with the number of beats instead of
+                          quadratically, which matters for very long tracks.
+                   cache: an AnalysisCache. If it already holds an analysis of this audio
+                          with these settings, that is used instead of analysing the audio
+                          again. Otherwise the new analysis is stored in it.
+            content_hash: the AnalysisCache.content_hash() of the audio, if the caller has
+                          already worked it out (or if filename was converted from another
+                          file, and that file is the one to key the cache by)
+                pcm_path: write the trimmed audio, as int16 PCM, to a .npy file at this path
+                          and memory-map raw_audio (and so every beat's buffer) from it,
+                          instead of holding it in memory. The DEFAULT of None keeps it in
+                          memory.
+               streaming: set to True to analyse the audio a block at a time, keeping only
+                          per-beat summaries, instead of decoding the whole file into memory
+                          first. Use it for very long audio (hours of it), together with
+                          pcm_path. The file must be a format that soundfile can read. It
+                          implies sparse_eigen.
+             analysis_sr: the highest sample rate to analyse the audio at. Audio at a higher
+                          rate is resampled down to it before its features are extracted,
+                          which makes the analysis much quicker for 48kHz or 96kHz audio.
+                          raw_audio, and so playback, keeps the file's own rate. The DEFAULT
+                          of None analyses the audio at the file's own rate. It isn't used
+                          when streaming.
+       silhouette_sample: when auto clustering a song with more beats than this, estimate
+                          each candidate's silhouette score from this many of its beats
+                          instead of all of them. See SilhouetteSweep for how close the
+                          estimates are. Around 1000 makes the scoring of long tracks
+                          several times quicker. The DEFAULT of None always scores every
+                          beat.
+             fast_kmeans: set to True to cluster with adaptive_kmeans(), which stops
+                          restarting KMeans once the restarts stop paying off, and to start
+                          each candidate of the auto clustering sweep from the clustering of
+                          its neighbour. That's several times quicker than the fixed
+                          n_init=20 (or 1000) of the DEFAULT of False, and finds clusterings
+                          that are as tight on average, but not the same ones.
         """
         self.__progress_callback = progress_callback
         self.__filename = filename
@@ -156,6 +2193,28 @@ class InfiniteJukebox(object):
         self.clusters = clusters
         self._extra_diag = ""
         self._use_v1 = use_v1
+        self._n_jobs = n_jobs
+        self._sparse_eigen = sparse_eigen or streaming
+        self._pcm_path = pcm_path
+        self._streaming = streaming
+        self._analysis_sr = analysis_sr
+        self._silhouette_sample = silhouette_sample
+        self._fast_kmeans = fast_kmeans
+        self.__play_vector = None
+        self.__play_engine = None
+        self.__cache = cache
+        self.cache_key = None
+        self.timings = collections.OrderedDict()
+
+        if cache is not None:
+            if content_hash is None:
+                content_hash = AnalysisCache.content_hash(filename)
+
+            self.cache_key = InfiniteJukebox.analysis_cache_key(cache, content_hash, clusters=clusters,
+                                                                use_v1=use_v1, start_beat=start_beat,
+                                                                streaming=streaming, analysis_sr=analysis_sr,
+                                                                silhouette_sample=silhouette_sample,
+                                                                fast_kmeans=fast_kmeans)
 
         if do_async == True:
             self.play_ready = threading.Event()
@@ -181,50 +2240,137 @@ class InfiniteJukebox(object):
 
         self.__report_progress( .1, "loading file and extracting raw audio")
 
+        stage_start = time.time()
+
         #
         # load the file as stereo with a high sample rate and
         # trim the silences from each end
         #
 
-        y, sr = librosa.core.load(self.__filename, mono=False, sr=None)
-        y, index = librosa.effects.trim(y)
+        if self._streaming:
+
+            # read the file a block at a time. The first pass finds the silences;
+            # the raw audio is then copied out of the file.
+
+            sr, start, end, mel_peak = scan_audio(self.__filename)
 
-        self.start_index = index[0]
+            self.start_index = start
 
-        self.duration = librosa.core.get_duration(y,sr)
-        self.raw_audio = (y * np.iinfo(np.int16).max).astype(np.int16).T.copy(order='C')
-        self.sample_rate = sr
+            self.duration = (end - start) / float(sr)
+            self.raw_audio = read_pcm(self.__filename, start, end, self._pcm_path)
+            self.sample_rate = sr
 
-        # after the raw audio bytes are saved, convert the samples to mono
-        # because the beat detection algorithm in librosa requires it.
+        else:
+            y, sr = librosa.core.load(self.__filename, mono=False, sr=None)
+            y, index = librosa.effects.trim(y)
+
+            self.start_index = index[0]
+
+            self.duration = librosa.core.get_duration(y,sr)
+            self.raw_audio = float_to_pcm(y, self._pcm_path)
+            self.sample_rate = sr
+
+            # after the raw audio bytes are saved, convert the samples to mono
+            # because the beat detection algorithm in librosa requires it.
+
+            y = librosa.core.to_mono(y)
+
+            # only playback needs the full sample rate. The beats are timed in seconds,
+            # so they still line up with raw_audio.
+
+            if self._analysis_sr is not None and sr > self._analysis_sr:
+                y = resample_poly(y, sr, self._analysis_sr)
+                sr = self._analysis_sr
+
+        stage_start = self.__record_timing('load', stage_start)
 
-        y = librosa.core.to_mono(y)
+        # if this song has been analysed with these settings before, then there's
+        # nothing left to do
 
-        self.__report_progress( .2, "computing pitch data..." )
+        cached = None
 
-        # Compute the constant-q chromagram for the samples.
+        if self.__cache is not None:
+            cached = self.__cache.load(self.cache_key)
+
+        if cached is not None:
+            self.__report_progress( .8, "loading analysis from cache..." )
+
+            self.__restore_analysis(*cached)
+
+            self.__record_timing('cache', stage_start)
+
+            self.__report_progress(1.0, "finished processing")
+
+            if self.play_ready:
+                self.play_ready.set()
+
+            return
 
         BINS_PER_OCTAVE = 12 * 3
         N_OCTAVES = 7
 
-        cqt = librosa.cqt(y=y, sr=sr, bins_per_octave=BINS_PER_OCTAVE, n_bins=N_OCTAVES * BINS_PER_OCTAVE)
-        C = librosa.amplitude_to_db( np.abs(cqt), ref=np.max)
+        if self._streaming:
+            self.__report_progress( .2, "Finding beats..." )
 
-        self.__report_progress( .3, "Finding beats..." )
+            onset_envelope = stream_onset_strength(self.__filename, start, end, mel_peak)
 
-        ##########################################################
-        # To reduce dimensionality, we'll beat-synchronous the CQT
-        tempo, btz = librosa.beat.beat_track(y=y, sr=sr, trim=False)
-        # tempo, btz = librosa.beat.beat_track(y=y, sr=sr)
-        Csync = librosa.util.sync(C, btz, aggregate=np.median)
+            # the tempo is estimated separately, because the beat tracker's own
+            # estimate needs a lot of memory for long audio
+
+            tempo, btz = librosa.beat.beat_track(onset_envelope=onset_envelope, sr=sr, trim=False,
+                                                 bpm=stream_tempo(onset_envelope, sr))
+
+            n_frames = len(onset_envelope)
+
+            stage_start = self.__record_timing('beat tracking', stage_start)
+
+            self.__report_progress( .3, "computing pitch data..." )
+
+            # the last pass over the file. It keeps only the beat-synchronous
+            # CQT, MFCCs and amplitudes.
+
+            Csync, Msync, ampSync = stream_beat_features(self.__filename, start, end, btz, mel_peak,
+                                                         bins_per_octave=BINS_PER_OCTAVE,
+                                                         n_bins=N_OCTAVES * BINS_PER_OCTAVE,
+                                                         timings=self.timings)
+
+            stage_start = time.time()
+
+        else:
+            self.__report_progress( .2, "computing pitch data..." )
+
+            # Compute the constant-q chromagram for the samples.
+
+            cqt = librosa.cqt(y=y, sr=sr, bins_per_octave=BINS_PER_OCTAVE, n_bins=N_OCTAVES * BINS_PER_OCTAVE)
+            C = librosa.amplitude_to_db( np.abs(cqt), ref=np.max)
+
+            stage_start = self.__record_timing('cqt', stage_start)
+
+            self.__report_progress( .3, "Finding beats..." )
+
+            # the beat tracker input, the MFCCs and the amplitudes all come from
+            # one shared STFT of the mono signal
+
+            tempo, btz, mfcc, amplitudes = extract_beat_features(y, sr, timings=self.timings)
+
+            stage_start = time.time()
+
+            ##########################################################
+            # To reduce dimensionality, we'll beat-synchronous the CQT,
+            # the MFCCs and the amplitudes
+            Csync = librosa.util.sync(C, btz, aggregate=np.median)
+            Msync = librosa.util.sync(mfcc, btz)
+            ampSync = librosa.util.sync(amplitudes, btz)
+
+            n_frames = C.shape[1]
 
         self.tempo = tempo
 
         # For alignment purposes, we'll need the timing of the beats
-        # we fix_frames to include non-beat frames 0 and C.shape[1] (final frame)
+        # we fix_frames to include non-beat frames 0 and n_frames (final frame)
         beat_times = librosa.frames_to_time(librosa.util.fix_frames(btz,
                                                                     x_min=0,
-                                                                    x_max=C.shape[1]),
+                                                                    x_max=n_frames),
                                             sr=sr)
 
         self.__report_progress( .4, "building recurrence matrix..." )
@@ -234,11 +2380,14 @@ class InfiniteJukebox(object):
         # width=3 prevents links within the same bar
         # mode='affinity' here implements S_rep (after Eq. 8)
         R = librosa.segment.recurrence_matrix(Csync, width=3, mode='affinity',
-                                              sym=True)
+                                              sym=True, sparse=self._sparse_eigen)
 
         # Enhance diagonals with a median filter (Equation 2)
-        df = librosa.segment.timelag_filter(scipy.ndimage.median_filter)
-        Rf = df(R, size=(1, 7))
+        if self._sparse_eigen:
+            Rf = timelag_median_filter(R, size=7)
+        else:
+            df = librosa.segment.timelag_filter(scipy.ndimage.median_filter)
+            Rf = df(R, size=(1, 7))
 
 
         ###################################################################
@@ -248,21 +2397,25 @@ class InfiniteJukebox(object):
         #
         # Here, we take :math:`\sigma` to be the median distance between successive beats.
         #
-        mfcc = librosa.feature.mfcc(y=y, sr=sr)
-        Msync = librosa.util.sync(mfcc, btz)
-
         path_distance = np.sum(np.diff(Msync, axis=1)**2, axis=0)
         sigma = np.median(path_distance)
         path_sim = np.exp(-path_distance / sigma)
 
-        R_path = np.diag(path_sim, k=1) + np.diag(path_sim, k=-1)
+        if self._sparse_eigen:
+            R_path = scipy.sparse.diags([path_sim, path_sim], [1, -1], format='csr')
+        else:
+            R_path = np.diag(path_sim, k=1) + np.diag(path_sim, k=-1)
 
 
         ##########################################################
         # And compute the balanced combination (Equations 6, 7, 9)
 
-        deg_path = np.sum(R_path, axis=1)
-        deg_rec = np.sum(Rf, axis=1)
+        if self._sparse_eigen:
+            deg_path = np.asarray(R_path.sum(axis=1)).ravel()
+            deg_rec = np.asarray(Rf.sum(axis=1)).ravel()
+        else:
+            deg_path = np.sum(R_path, axis=1)
+            deg_rec = np.sum(Rf, axis=1)
 
         mu = deg_path.dot(deg_path + deg_rec) / np.sum((deg_path + deg_rec)**2)
 
@@ -273,8 +2426,13 @@ class InfiniteJukebox(object):
         L = scipy.sparse.csgraph.laplacian(A, normed=True)
 
 
+        stage_start = self.__record_timing('recurrence matrix', stage_start)
+
         # and its spectral decomposition
-        _, evecs = scipy.linalg.eigh(L)
+        if self._sparse_eigen:
+            evecs = laplacian_eigenvectors(L, self.__eigenvector_count())
+        else:
+            _, evecs = scipy.linalg.eigh(L)
 
 
         # We can clean this up further with a median filter.
@@ -285,6 +2443,8 @@ class InfiniteJukebox(object):
         # cumulative normalization is needed for symmetric normalize laplacian eigenvectors
         Cnorm = np.cumsum(evecs**2, axis=1)**0.5
 
+        stage_start = self.__record_timing('eigen decomposition', stage_start)
+
         # If we want k clusters, use the first k normalized eigenvectors.
         # Fun exercise: see how the segmentation changes as you vary k
 
@@ -308,20 +2468,16 @@ class InfiniteJukebox(object):
             self.__report_progress( .51, "using %d clusters" % self.clusters )
 
             X = evecs[:, :k] / Cnorm[:, k-1:k]
-            seg_ids = sklearn.cluster.KMeans(n_clusters=k, max_iter=1000,
-                                             random_state=0, n_init=1000).fit_predict(X)
 
-        # Get the amplitudes and beat-align them
-        self.__report_progress( .6, "getting amplitudes" )
-
-        # newer versions of librosa have renamed the rmse function
+            if self._fast_kmeans:
+                seg_ids, _, _ = adaptive_kmeans(X, k, max_init=1000, patience=100, max_iter=1000)
+            else:
+                seg_ids = sklearn.cluster.KMeans(n_clusters=k, max_iter=1000,
+                                                 random_state=0, n_init=1000).fit_predict(X)
 
-        if hasattr(librosa.feature,'rms'):
-            amplitudes = librosa.feature.rms(y=y)
-        else:
-            amplitudes = librosa.feature.rmse(y=y)
+        stage_start = self.__record_timing('clustering', stage_start)
 
-        ampSync = librosa.util.sync(amplitudes, btz)
+        self.__report_progress( .6, "getting amplitudes" )
 
         # create a list of tuples that include the ordinal position, the start time of the beat,
         # the cluster to which the beat belongs and the mean amplitude of the beat
@@ -397,15 +2553,21 @@ class InfiniteJukebox(object):
         self.__report_progress( .8, "computing final beat array..." )
 
         # assign final beat ids
-        for beat in beats:
-            beat['id'] = beats.index(beat)
+        for i, beat in enumerate(beats):
+            beat['id'] = i
             beat['quartile'] = beat['id'] // (len(beats) / 4.0)
 
+        # group the beats that can be jumped to, so that each beat's jump candidates
+        # are a lookup rather than a scan of the whole song
+
+        candidate_index = JumpCandidateIndex([b['cluster'] for b in beats], [b['is'] for b in beats],
+                                             [b['segment'] for b in beats], first=loop_bounds_begin)
+
         # compute a coherent 'next' beat to play. This is always just the next ordinal beat
         # unless we're at the end of the song. Then it gets a little trickier.
 
         for beat in beats:
-            if beat == beats[-1]:
+            if beat is beats[-1]:
 
                 # if we're at the last beat, then we want to find a reasonable 'next' beat to play. It should (a) share the
                 # same cluster, (b) be in a logical place in its measure, (c) be after the computed loop_bounds_begin, and
@@ -425,12 +2587,7 @@ class InfiniteJukebox(object):
             #
             # THAT collection of beats contains our jump candidates
 
-            jump_candidates = [bx['id'] for bx in beats[loop_bounds_begin:] if
-                               (bx['cluster'] == beats[beat['next']]['cluster']) and
-                               (bx['is'] == beats[beat['next']]['is']) and
-                               (bx['id'] % 4 == beats[beat['next']]['id'] % 4) and
-                               (bx['segment'] != beat['segment']) and
-                               (bx['id'] != beat['next'])]
+            jump_candidates = candidate_index.candidates(beat['id'], beat['next'])
 
             if jump_candidates:
                 beat['jump_candidates'] = jump_candidates
@@ -469,177 +2626,160 @@ class InfiniteJukebox(object):
         else:
             self.outro = info[outro_start:]
 
-        #
-        # This section of the code computes the play_vector -- a 1024*1024 beat length
-        # remix of the current song.
-        #
+        # save off the beats array. The play vector is generated from it on demand by
+        # iter_play_vector(). Signal the play_ready event (if it's been set)
 
-        random.seed()
+        self.beats = BeatTable.from_dicts(beats, self.raw_audio)
 
-        # how long should our longest contiguous playback blocks be? One way to
-        # consider it is that higher bpm songs need longer blocks because
-        # each beat takes less time. A simple way to estimate a good value
-        # is to scale it by it's distance from 120bpm -- the canonical bpm
-        # for popular music. Find that value and round down to the nearest
-        # multiple of 4. (There almost always are 4 beats per measure in Western music).
+        stage_start = self.__record_timing('beat array', stage_start)
 
-        max_sequence_len = int(round((self.tempo / 120.0) * 48.0))
-        max_sequence_len = max_sequence_len - (max_sequence_len % 4)
+        if self.__cache is not None:
+            self.__cache.store(self.cache_key, *self.__analysis_entry())
+            self.__record_timing('cache', stage_start)
 
-        min_sequence = max(random.randrange(16, max_sequence_len, 4), loop_bounds_begin)
+        self.__report_progress(1.0, "finished processing")
 
-        current_sequence = 0
-        beat = beats[0]
+        if self.play_ready:
+            self.play_ready.set()
 
-        self.__report_progress( .9, "creating play vector" )
+    @property
+    def play_vector(self):
 
-        play_vector = []
+        """ The first PLAY_VECTOR_LENGTH entries of iter_play_vector(), as a list. It is
+            built the first time it is read. Consumers that don't need random access
+            should iterate iter_play_vector() instead, which costs nothing up front.
+        """
 
-        play_vector.append( {'beat':0, 'seq_len':min_sequence, 'seq_pos':current_sequence} )
+        if self.__play_vector is None:
+            self.__play_vector = list(itertools.islice(self.iter_play_vector(), PLAY_VECTOR_LENGTH))
 
-        # we want to keep a list of recently played segments so we don't accidentally wind up in a local loop
-        #
-        # the number of segments in a song will vary so we want to set the number of recents to keep
-        # at 25% of the total number of segments. Eg: if there are 34 segments, then the depth will
-        # be set at round(8.5) == 9.
-        #
-        # On the off chance that the (# of segments) *.25 < 1 we set a floor queue depth of 1
+        return self.__play_vector
 
-        recent_depth = int(round(self.segments * .25))
-        recent_depth = max( recent_depth, 1 )
+    def iter_play_vector(self, seed=None, state=None):
 
-        recent = collections.deque(maxlen=recent_depth)
+        """ Generates the play vector -- a never ending, random(ish) play path through
+            the song -- one entry at a time. See the play_vector attribute for what
+            each entry holds.
 
-        # keep track of the time since the last successful jump. If we go more than
-        # 10% of the song length since our last jump, then we will prioritize an
-        # immediate jump to a not recently played segment. Otherwise playback will
-        # be boring for the listener. This also has the advantage of busting out of
-        # local loops.
+            Args:
 
-        max_beats_between_jumps = int(round(len(beats) * .1))
-        beats_since_jump = 0
-        failed_jumps = 0
+                 seed: seeds the random choices, so that the same seed gives the same
+                       remix. The DEFAULT of None seeds from the system.
+                state: a PlayVectorState to resume from. The generator keeps it up to
+                       date as it goes, so a generator that was stopped can be picked up
+                       later, at the next entry, by passing its state back in. Leave it
+                       as None to start a new remix. seed is ignored when it is passed.
+        """
 
-        for i in range(0, 1024 * 1024):
+        if self.__play_engine is None:
+            self.__play_engine = PlayVectorEngine(self.beats, self.tempo, self.__start_beat)
 
-            if beat['segment'] not in recent:
-                recent.append(beat['segment'])
+        if state is None:
+            state = PlayVectorState(seed)
 
-            current_sequence += 1
+        return self.__play_engine.iter_entries(state)
 
-            # it's time to attempt a jump if we've played all the beats we wanted in the
-            # current sequence. Also, if we've gone more than 10% of the length of the song
-            # without jumping we need to immediately prioritze jumping to a non-recent segment.
+    @classmethod
+    def analysis_cache_key(cls, cache, content_hash, **kwargs):
 
-            will_jump = (current_sequence == min_sequence) or (beats_since_jump >= max_beats_between_jumps)
+        """ The key of the entry in an AnalysisCache that a jukebox constructed with these
+            arguments reads and stores. It lets a caller look the analysis up without
+            constructing a jukebox.
 
-            # since it's time to jump, let's find the most musically pleasing place
-            # to go
+            Args:
 
-            if ( will_jump ):
+                       cache: the AnalysisCache
+                content_hash: the AnalysisCache.content_hash() of the audio
+                      kwargs: the keyword arguments the jukebox is (or would be)
+                              constructed with. Those that don't change the analysis
+                              are ignored.
+        """
 
-                # find the jump candidates that haven't been recently played
-                non_recent_candidates = [c for c in beat['jump_candidates'] if beats[c]['segment'] not in recent]
+        return cache.key(content_hash, **cls.analysis_params(**kwargs))
 
-                # if there aren't any good jump candidates, then we need to fall back
-                # to another selection scheme.
+    @staticmethod
+    def analysis_params(clusters=0, use_v1=False, start_beat=1, streaming=False, analysis_sr=None,
+                        silhouette_sample=None, fast_kmeans=False, **ignored):
 
-                if len(non_recent_candidates) == 0:
+        """ The analysis parameters an AnalysisCache entry is keyed by, besides the
+            audio itself. See the constructor for what they mean. Any other constructor
+            arguments are ignored.
+        """
 
-                    beats_since_jump += 1
-                    failed_jumps += 1
+        # the CLI, Web UI and Loopatron copies of this module analyse songs a little
+        # differently, so their entries must never be mixed up
 
-                    # suppose we've been trying to jump but couldn't find a good non-recent candidate. If
-                    # the length of time we've been trying (and failing) is >= 10% of the song length
-                    # then it's time to relax our criteria. Let's find the jump candidate that's furthest
-                    # from the current beat (irrespective if it's been played recently) and go there. Ideally
-                    # we'd like to jump to a beat that is not in the same quartile of the song as the currently
-                    # playing section. That way we maximize our chances of avoiding a long local loop -- such as
-                    # might be found in the section preceeding the outro of a song.
+        return {'analysis': 'cli', 'clusters': clusters, 'use_v1': use_v1, 'start_beat': start_beat,
+                'streaming': streaming, 'analysis_sr': analysis_sr, 'silhouette_sample': silhouette_sample,
+                'fast_kmeans': fast_kmeans}
 
-                    non_quartile_candidates = [c for c in beat['jump_candidates'] if beats[c]['quartile'] != beat['quartile']]
+    def __analysis_entry(self):
 
-                    if (failed_jumps >= (.1 * len(beats))) and (len(non_quartile_candidates) > 0):
+        """ The values and arrays to store in the AnalysisCache for this song. The audio
+            isn't stored; it is decoded from the file again.
+        """
 
-                        furthest_distance = max([abs(beat['id'] - c) for c in non_quartile_candidates])
+        values = {'tempo': float(self.tempo), 'clusters': int(self.clusters),
+                  'segments': int(self.segments), 'max_amplitude': float(self.max_amplitude)}
 
-                        jump_to = next(c for c in non_quartile_candidates
-                                       if abs(beat['id'] - c) == furthest_distance)
+        arrays = self.beats.to_arrays()
 
-                        beat = beats[jump_to]
-                        beats_since_jump = 0
-                        failed_jumps = 0
+        # the outro runs on past the fade-out point, and the beats after that were never
+        # given ids or jump candidates. Only the fields every outro beat has are stored.
 
-                    # uh oh! That fallback hasn't worked for yet ANOTHER 10%
-                    # of the song length. Something is seriously broken. Time
-                    # to punt and just start again from the first beat.
+        if len(self.outro) > 0:
+            fields = set.intersection(*[set(beat.keys()) for beat in self.outro])
+            outro = [{name: beat[name] for name in fields} for beat in self.outro]
 
-                    elif failed_jumps >= (.2 * len(beats)):
-                        beats_since_jump = 0
-                        failed_jumps = 0
-                        beat = beats[loop_bounds_begin]
+            arrays.update(BeatTable.from_dicts(outro).to_arrays('outro_'))
 
-                    # asuuming we're not in one of the failure modes but haven't found a good
-                    # candidate that hasn't been recently played, just play the next beat in the
-                    # sequence
+        return values, arrays
 
-                    else:
-                        beat = beats[beat['next']]
+    def __restore_analysis(self, values, arrays):
 
-                else:
+        """ Restores the analysis of this song from an AnalysisCache entry. See
+            __analysis_entry().
+        """
 
-                    # if it's time to jump and we have at least one good non-recent
-                    # candidate, let's just pick randomly from the list and go there
+        self.tempo = values['tempo']
+        self.clusters = values['clusters']
+        self.segments = values['segments']
+        self.max_amplitude = values['max_amplitude']
 
-                    beats_since_jump = 0
-                    failed_jumps = 0
-                    beat = beats[ random.choice(non_recent_candidates) ]
+        self.beats = BeatTable.from_arrays(arrays, self.raw_audio)
 
-                # reset our sequence position counter and pick a new target length
-                # between 16 and max_sequence_len, making sure it's evenly divisible by
-                # 4 beats
+        self.outro = []
 
-                current_sequence = 0
-                min_sequence = random.randrange(16, max_sequence_len, 4)
+        if 'outro_columns' in arrays:
+            self.outro = BeatTable.from_arrays(arrays, self.raw_audio, 'outro_').to_dicts(include_buffer=True)
 
-                # if we're in the place where we want to jump but can't because
-                # we haven't found any good candidates, then set current_sequence equal to
-                # min_sequence. During playback this will show up as having 00 beats remaining
-                # until we next jump. That's the signal that we'll jump as soon as we possibly can.
-                #
-                # Code that reads play_vector and sees this value can choose to visualize this in some
-                # interesting way.
+    def __report_progress(self, pct_done, message):
 
-                if beats_since_jump >= max_beats_between_jumps:
-                    current_sequence = min_sequence
+        """ If a reporting callback was passed, call it in order
+            to mark progress.
+        """
+        if self.__progress_callback:
+            self.__progress_callback( pct_done, message )
 
-                # add an entry to the play_vector
-                play_vector.append({'beat':beat['id'], 'seq_len': min_sequence, 'seq_pos': current_sequence})
-            else:
+    def timing_report(self):
 
-                # if we're not trying to jump then just add the next item to the play_vector
-                play_vector.append({'beat':beat['next'], 'seq_len': min_sequence, 'seq_pos': current_sequence})
-                beat = beats[beat['next']]
-                beats_since_jump += 1
+        """ Returns a printable report of how long each processing stage took. """
 
-        # save off the beats array and play_vector. Signal
-        # the play_ready event (if it's been set)
+        lines = ["%20s: %6.2fs" % (stage, seconds) for stage, seconds in self.timings.items()]
+        lines.append("%20s: %6.2fs" % ('total', sum(self.timings.values())))
 
-        self.beats = beats
-        self.play_vector = play_vector
+        return "\n".join(lines)
 
-        self.__report_progress(1.0, "finished processing")
+    def __record_timing(self, stage, stage_start):
 
-        if self.play_ready:
-            self.play_ready.set()
+        """ Records how long a processing stage took and returns the start
+            time for the next stage.
+        """
 
-    def __report_progress(self, pct_done, message):
+        now = time.time()
+        self.timings[stage] = now - stage_start
 
-        """ If a reporting callback was passed, call it in order
-            to mark progress.
-        """
-        if self.__progress_callback:
-            self.__progress_callback( pct_done, message )
+        return now
 
     def __compute_best_cluster_with_sil(self, evecs, Cnorm):
 
@@ -702,25 +2842,35 @@ class InfiniteJukebox(object):
         # we need at least 3 clusters for any song and shouldn't need to calculate more than
         # 48 clusters for even a really complicated peice of music.
 
-        for n_clusters in range(48, 2, -1):
+        candidates = []
 
-            self.__report_progress(.51, "Testing a cluster value of %d..." % n_clusters)
+        for n_clusters in range(48, 2, -1):
 
             # compute a matrix of the Eigen-vectors / their normalized values
             X = evecs[:, :n_clusters] / Cnorm[:, n_clusters-1:n_clusters]
 
-            # create the candidate clusters and fit them
-            clusterer = sklearn.cluster.KMeans(n_clusters=n_clusters, max_iter=300,
-                                               random_state=0, n_init=20)
+            candidates.append((n_clusters, X))
+
+        # a long track's candidates can be scored from a sample of its beats. See
+        # SilhouetteSweep.
+
+        silhouettes = None
 
-            cluster_labels = clusterer.fit_predict(X)
+        if self._silhouette_sample is not None and evecs.shape[0] > self._silhouette_sample:
+            silhouettes = SilhouetteSweep(evecs, Cnorm, self._silhouette_sample)
+
+        # create the candidate clusters and fit them. The results come back in the same
+        # order as the candidates, so the winner is picked exactly as if they had been
+        # fit one after another.
+
+        for n_clusters, (cluster_labels, silhouette_avg) in self.__sweep_cluster_candidates(candidates, silhouettes):
+
+            self.__report_progress(.51, "Tested a cluster value of %d..." % n_clusters)
 
             # get some key statistics, including how well each beat in the cluster resemble
             # each other (the silhouette average), the ratio of segments to clusters, and the
             # length of the smallest segment in this cluster configuration
 
-            silhouette_avg = sklearn.metrics.silhouette_score(X, cluster_labels)
-
             ratio, min_segment_len = self.__segment_stats_from_labels(cluster_labels.tolist())
 
             # We need to grade each cluster according to how likely it is to produce a good
@@ -764,9 +2914,78 @@ class InfiniteJukebox(object):
                 best_cluster_size = n_clusters
                 best_labels = cluster_labels
 
+        if silhouettes is not None:
+            self.__add_log("silhouettes estimated from %d of %d beats. largest standard error: %.4f" %
+                           (self._silhouette_sample, evecs.shape[0], max(silhouettes.standard_errors.values())))
+
         # return the best results
         return (best_cluster_size, best_labels)
 
+    def __eigenvector_count(self):
+
+        """ The number of Laplacian eigenvectors the clustering will look at: enough
+            for the largest cluster count that either auto clustering scheme tries, or
+            for the cluster count that was asked for.
+        """
+
+        count = max(48, self.clusters)
+
+        if self._use_v1:
+            count = max(count, 62)
+
+        return count
+
+    def __sweep_cluster_candidates(self, candidates, silhouettes=None):
+
+        """ Fits and scores every candidate cluster count with fit_cluster_candidate(),
+            spreading the work over a pool of processes. Yields a tuple of
+            (n_clusters, (cluster labels, silhouette score)) for each candidate, in the
+            order the candidates were given.
+
+            Each candidate is seeded with random_state=0 on its own, so the results don't
+            depend on which process fit them.
+
+            If a SilhouetteSweep is passed, the processes only fit the candidates, and it
+            scores them here. It reuses its work from one candidate to the next, so it
+            must see them all.
+
+            With fast_kmeans, the candidates are fit in runs of WARM_START_RUN with
+            fit_cluster_run(), and it's the runs that are spread over the processes.
+        """
+
+        fit = fit_cluster_candidate if silhouettes is None else fit_cluster_labels
+        tasks = candidates
+
+        if self._fast_kmeans:
+            fit = fit_cluster_run
+            tasks = [(candidates[i:i + WARM_START_RUN], silhouettes is None)
+                     for i in range(0, len(candidates), WARM_START_RUN)]
+
+        def fitted(results):
+            # each run's result is a list, with one entry for each of its candidates
+            if self._fast_kmeans:
+                return itertools.chain.from_iterable(results)
+
+            return results
+
+        def scored(n_clusters, result):
+            if silhouettes is None:
+                return result
+
+            return result, silhouettes.score(n_clusters, result)
+
+        n_jobs = self._n_jobs or multiprocessing.cpu_count()
+        n_jobs = min(n_jobs, len(tasks))
+
+        if n_jobs <= 1:
+            for candidate, result in zip(candidates, fitted(map(fit, tasks))):
+                yield candidate[0], scored(candidate[0], result)
+            return
+
+        with multiprocessing.Pool(processes=n_jobs) as pool:
+            for candidate, result in zip(candidates, fitted(pool.imap(fit, tasks))):
+                yield candidate[0], scored(candidate[0], result)
+
     @staticmethod
     def __segment_count_from_labels(labels):
 
@@ -858,9 +3077,15 @@ class InfiniteJukebox(object):
             # compute a matrix of the Eigen-vectors / their normalized values
             X = evecs[:, :ki] / Cnorm[:, ki-1:ki]
 
-            # cluster with candidate ki
-            labels = sklearn.cluster.KMeans(n_clusters=ki, max_iter=1000,
-                                            random_state=0, n_init=20).fit_predict(X)
+            # cluster with candidate ki. fast_kmeans starts it from the last candidate.
+            if self._fast_kmeans:
+                init = None if len(self._clusters_list) == 0 else \
+                       seed_centers(X, self._clusters_list[-1]['labels'], ki)
+
+                labels, _, _ = adaptive_kmeans(X, ki, init=init, max_iter=1000)
+            else:
+                labels = sklearn.cluster.KMeans(n_clusters=ki, max_iter=1000,
+                                                random_state=0, n_init=20).fit_predict(X)
 
             entry = {'clusters':ki, 'labels':labels}
 
@@ -900,8 +3125,18 @@ class InfiniteJukebox(object):
 
         # compute a very high fidelity set of clusters using our selected cluster size.
         X = evecs[:, :final_cluster_size] / Cnorm[:, final_cluster_size-1:final_cluster_size]
-        labels = sklearn.cluster.KMeans(n_clusters=final_cluster_size, max_iter=1000,
-                                        random_state=0, n_init=1000).fit_predict(X)
+
+        if self._fast_kmeans:
+            # start from the sweep's clustering of this size, and give the restarts plenty
+            # of rope before deciding they've stopped finding anything better
+
+            sweep_labels = next(cl['labels'] for cl in self._clusters_list if cl['clusters'] == final_cluster_size)
+
+            labels, _, _ = adaptive_kmeans(X, final_cluster_size, seed_centers(X, sweep_labels, final_cluster_size),
+                                           max_init=1000, patience=100, max_iter=1000)
+        else:
+            labels = sklearn.cluster.KMeans(n_clusters=final_cluster_size, max_iter=1000,
+                                            random_state=0, n_init=1000).fit_predict(X)
 
         # labels = next(c['labels'] for c in self._clusters_list if c['clusters'] == final_cluster_size)
 
@@ -11,17 +11,20 @@ import os
 import pygame.event
 import pygame.locals
 import signal
+import threading
 import time
 import multiprocessing
 
-from Remixatron import InfiniteJukebox
 from pygame import mixer
+from pygame.locals import *
 
 from utils import *
 from jukebox_controller import JukeboxController
 
 SOUND_FINISHED = pygame.locals.USEREVENT + 1
 
+warm_up_thread = None
+
 
 def process_args():
 
@@ -84,21 +87,50 @@ def graceful_exit(signum, frame):
 def run_looping_audio_converter():
     pass
 
+def warm_up():
+    """Import, load and compile the analysis code. Remixatron (and with it librosa, scipy and
+    sklearn) is only imported here, so the window appears without waiting for it"""
+
+    import Remixatron
+    Remixatron.warm_up()
+
+def start_warm_up():
+    """Warm up the analysis code in the background, while the user picks a song"""
+
+    global warm_up_thread
+
+    warm_up_thread = threading.Thread(target=warm_up, daemon=True)
+    warm_up_thread.start()
+
+def wait_for_warm_up():
+    """Let the warm up finish before analysing. The analysis forks processes, which
+    mustn't happen while another thread is busy in librosa or numba"""
+
+    if warm_up_thread is not None:
+        warm_up_thread.join()
+
 def initialize_jukebox(filepath, do_async = False):
 
     #pygame.display.quit()
     #pygame.font.quit()
     mixer.quit()
 
+    wait_for_warm_up()
+
+    from Remixatron import InfiniteJukebox
+
     config = get_config()
 
     jukebox = InfiniteJukebox(filepath=filepath, start_beat=0, use_cache = True,
                               clusters=config['clusters'], max_clusters = config['maxClusters'],
-                              progress_callback=UpdateMessageCallback, do_async=do_async, use_v1=config['useV1'])
+                              progress_callback=UpdateMessageCallback, do_async=do_async, use_v1=config['useV1'],
+                              sparse_eigen=config['sparseEigen'], analysis_sr=config['analysisSampleRate'] or None,
+                              silhouette_sample=config['silhouetteSampleSize'] or None,
+                              fast_kmeans=config['fastKMeans'])
 
 
     if (jukebox.time_elapsed > 0):  # don't save if jukebox was loaded from cache
-        jukebox.save_cache(cache_evecs = True)
+        jukebox.save_cache(cache_evecs = True, cache_audio = config['cacheAudio'])
         keep_cache = config['alwaysCache']  # keep cache if config has always cache
         keep_evec_cache = (keep_cache and config['cacheEvecs'])
         if keep_evec_cache:
@@ -175,7 +207,7 @@ def play_loop(filepath):
             jukebox_controller.music_slider(click, mx, my, keys)
 
             if not jukebox_controller.channel.get_busy():
-                jukebox_controller.create_and_play_playback_buffer()
+                jukebox_controller.restart_playback()
             # Handle user-input
             for event in pygame.event.get():
                 if (event.type == pygame.QUIT):
@@ -276,8 +308,8 @@ def play_loop(filepath):
             # pygame.display.flip()
             pygame.display.update()
 
-        # Clamp FPS
-        clock.tick_busy_loop(60)
+        # Clamp FPS. tick() sleeps rather than spinning, so an idle window doesn't hold a whole core
+        clock.tick(60)
 
     mixer.quit()
     pygame.quit()
@@ -287,6 +319,10 @@ def cache_selected_files(filepaths):
     pygame.display.set_caption("Loopatron - Caching...")
     draw_status_message_and_update(f'Loopatron - Caching...', f'Processing {len(filepaths)} songs...', font, Color.DARK_ORANGE.value, window)
 
+    wait_for_warm_up()
+
+    from Remixatron import InfiniteJukebox
+
     config = get_config()
     for i, filepath in enumerate(filepaths):
         draw_status_message(f'Loopatron - Caching...', f'Processing ({i + 1}/{len(filepaths)}) {os.path.basename(filepath)}...', font, Color.DARK_ORANGE.value, window)
@@ -300,9 +336,13 @@ def cache_selected_files(filepaths):
 
         jukebox = InfiniteJukebox(filepath=filepath, start_beat=0, use_cache = False, clusters=config['clusters'],
                                   max_clusters=config['maxClusters'],
-                                  progress_callback=NoCallback, do_async=False, use_v1=config['useV1'])
+                                  progress_callback=NoCallback, do_async=False, use_v1=config['useV1'],
+                                  sparse_eigen=config['sparseEigen'],
+                                  analysis_sr=config['analysisSampleRate'] or None,
+                                  silhouette_sample=config['silhouetteSampleSize'] or None,
+                                  fast_kmeans=config['fastKMeans'])
 
-        jukebox.save_cache(config['cacheEvecs'])
+        jukebox.save_cache(config['cacheEvecs'], config['cacheAudio'])
 
 
 
@@ -350,6 +390,8 @@ if __name__ == "__main__":
     font = pygame.font.Font(CONFIG['fontPath'], 15)
     #font = pygame.font.SysFont('arial', 20)
 
+    start_warm_up()
+
     filepaths = prompt_file(select_multiple=True)
 
     if len(filepaths) == 1:
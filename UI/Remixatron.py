@@ -32,7 +32,9 @@ be signaled when the processing is complete. The default mode is to run synchron
 """
 
 import collections
+import collections.abc
 import librosa
+import itertools
 import math
 import random
 import scipy
@@ -46,15 +48,1273 @@ import multiprocessing
 import functools
 import time
 
+import hashlib
+import json
 import os
-from pathlib import Path
-import csv
+import shutil
+import tempfile
 
 from utils import CONFIG, CacheOptions
 
 def smap(f):
     return f()
 
+def extract_beat_features(y, sr, n_fft=2048, hop_length=512, trim=False, timings=None):
+
+    """ Computes the beat grid, MFCCs and RMS amplitudes of a mono signal from a
+        single shared STFT.
+
+        librosa's beat_track(y=...), mfcc(y=...) and rms(y=...) each run their own
+        spectral transform of the same samples. All three can be derived from one
+        magnitude spectrogram instead: the mel power spectrogram built from it is the
+        onset envelope input for the beat tracker and the input for the MFCCs, and the
+        magnitudes themselves give the RMS.
+
+        Args:
+
+                  y: the mono audio samples
+                 sr: the sample rate of y
+              n_fft: the FFT size of the shared STFT. Matches the librosa defaults.
+         hop_length: the hop size of the shared STFT. Matches the librosa defaults, so
+                     the frames line up with the CQT frames.
+               trim: passed on to the beat tracker. Set to True to trim leading and
+                     trailing beats with weak onsets.
+            timings: an optional dictionary. If passed, the time (in seconds) that each
+                     stage took is stored in it under the stage name.
+
+        Returns:
+
+            a tuple of (tempo, beat frames, mfcc, rms)
+    """
+
+    if timings is None:
+        timings = {}
+
+    stage_start = time.time()
+
+    S = np.abs(librosa.stft(y, n_fft=n_fft, hop_length=hop_length))
+
+    timings['stft'] = time.time() - stage_start
+    stage_start = time.time()
+
+    # the log-power mel spectrogram is exactly what onset_strength() and mfcc()
+    # would have computed internally from y
+
+    mel_db = librosa.power_to_db(librosa.feature.melspectrogram(S=S**2, sr=sr, n_fft=n_fft,
+                                                                hop_length=hop_length))
+
+    timings['mel spectrogram'] = time.time() - stage_start
+    stage_start = time.time()
+
+    onset_envelope = librosa.onset.onset_strength(S=mel_db, sr=sr, hop_length=hop_length,
+                                                  aggregate=np.median)
+
+    tempo, btz = librosa.beat.beat_track(onset_envelope=onset_envelope, sr=sr,
+                                         hop_length=hop_length, trim=trim)
+
+    timings['beat tracking'] = time.time() - stage_start
+    stage_start = time.time()
+
+    mfcc = librosa.feature.mfcc(S=mel_db, sr=sr)
+
+    timings['mfcc'] = time.time() - stage_start
+    stage_start = time.time()
+
+    # newer versions of librosa have renamed the rmse function. RMS computed from
+    # the spectrogram is scaled by the energy of the analysis window, so undo that
+    # to keep the amplitudes on the same scale as the time domain version.
+
+    if hasattr(librosa.feature,'rms'):
+        rms = librosa.feature.rms(S=S, frame_length=n_fft, hop_length=hop_length)
+    else:
+        rms = librosa.feature.rmse(S=S, frame_length=n_fft, hop_length=hop_length)
+
+    window = librosa.filters.get_window('hann', n_fft, fftbins=True)
+    rms /= np.sqrt(np.mean(window**2))
+
+    timings['rms'] = time.time() - stage_start
+
+    return tempo, btz, mfcc, rms
+
+def resample_poly(y, orig_sr, target_sr):
+
+    """ Resamples mono audio with a polyphase filter. This is much faster than the
+        default resampler in librosa.resample() and is more than good enough for
+        feature extraction.
+
+        Args:
+
+                    y: the mono audio samples
+              orig_sr: the sample rate of y
+            target_sr: the sample rate to resample y to
+    """
+
+    gcd = math.gcd(int(orig_sr), int(target_sr))
+
+    return scipy.signal.resample_poly(y, int(target_sr) // gcd, int(orig_sr) // gcd).astype(y.dtype)
+
+def float_to_pcm(y, path=None, chunk_size=1024 * 1024):
+
+    """ Converts float audio, as librosa loads it, to the int16 PCM layout of
+        InfiniteJukebox.raw_audio -- one row per sample, one column per channel.
+
+        The conversion is done a chunk at a time, straight into the result, so the
+        only full size array it allocates is the result itself.
+
+        Args:
+
+                     y: the audio, shaped (samples,) or (channels, samples)
+                  path: if given, the PCM is written to a .npy file at this path and
+                        returned memory-mapped from it. Otherwise it's returned in memory.
+            chunk_size: the number of samples to convert at once
+    """
+
+    shape = y.shape[::-1]
+
+    if path is None:
+        pcm = np.empty(shape, dtype=np.int16)
+    else:
+        pcm = np.lib.format.open_memmap(path, mode='w+', dtype=np.int16, shape=shape)
+
+    scale = np.iinfo(np.int16).max
+
+    for start in range(0, shape[0], chunk_size):
+        pcm[start:start + chunk_size] = (y[..., start:start + chunk_size] * scale).T
+
+    if path is not None:
+        pcm.flush()
+
+    return pcm
+
+def fit_cluster_candidate(candidate):
+
+    """ Clusters the beats into one candidate number of clusters and scores the result.
+
+        This is the unit of work for the silhouette-based cluster sweep. It lives at
+        module level so that it can be shipped to a multiprocessing.Pool.
+
+        Args:
+
+            candidate: a tuple of (n_clusters, X, kmeans_jobs) where X is the matrix of
+                       normalized eigenvectors for that cluster count and kmeans_jobs is
+                       passed through to KMeans as n_jobs
+
+        Returns:
+
+            a tuple of (cluster labels, average silhouette score)
+    """
+
+    n_clusters, X, kmeans_jobs = candidate
+
+    clusterer = sklearn.cluster.KMeans(n_clusters=n_clusters, max_iter=300,
+                                       random_state=0, n_init=20, n_jobs=kmeans_jobs)
+
+    cluster_labels = clusterer.fit_predict(X)
+
+    return cluster_labels, sklearn.metrics.silhouette_score(X, cluster_labels)
+
+def fit_cluster_labels(candidate):
+
+    """ Clusters the beats into one candidate number of clusters, without scoring the
+        result. Used instead of fit_cluster_candidate() when a SilhouetteSweep scores
+        the candidates.
+
+        Args:
+
+            candidate: a tuple of (n_clusters, X, kmeans_jobs), as for fit_cluster_candidate()
+
+        Returns:
+
+            the cluster labels
+    """
+
+    n_clusters, X, kmeans_jobs = candidate
+
+    clusterer = sklearn.cluster.KMeans(n_clusters=n_clusters, max_iter=300,
+                                       random_state=0, n_init=20, n_jobs=kmeans_jobs)
+
+    return clusterer.fit_predict(X)
+
+def adaptive_kmeans(X, n_clusters, init=None, max_init=20, patience=5, max_iter=300, tol=1e-4, random_state=0):
+
+    """ KMeans that stops restarting once restarts stop paying off.
+
+        sklearn.cluster.KMeans(n_init=20) always runs all 20 of its restarts and keeps
+        the one with the lowest inertia (the sum of squared distances from each point
+        to its cluster center). Here the restarts are run one at a time, and stop once
+        patience of them in a row have failed to lower the best inertia by more than a
+        fraction tol. If init centers are given (see seed_centers()), the first run
+        starts from them, which usually makes it the best run there is.
+
+        Args:
+
+            X: the points to cluster, one per row
+            n_clusters: the number of clusters
+            init: initial centers for the first run, or None to start every run
+                  from k-means++
+            max_init: the most runs to make, as KMeans' n_init
+            patience: stop after this many runs in a row without a real improvement
+            max_iter: the most iterations of each run, as for KMeans
+            tol: the smallest fraction of the best inertia that counts as an improvement
+            random_state: seeds the k-means++ runs, so that the result is repeatable
+
+        Returns:
+
+            a tuple of (labels, cluster centers, inertia)
+    """
+
+    seeds = np.random.RandomState(random_state).randint(np.iinfo(np.int32).max, size=max_init)
+
+    best = None
+    stale = 0
+
+    for i in range(max_init):
+        if i == 0 and init is not None:
+            clusterer = sklearn.cluster.KMeans(n_clusters=n_clusters, init=init, n_init=1,
+                                               max_iter=max_iter)
+        else:
+            clusterer = sklearn.cluster.KMeans(n_clusters=n_clusters, n_init=1, max_iter=max_iter,
+                                               random_state=seeds[i])
+
+        clusterer.fit(X)
+
+        if best is not None and clusterer.inertia_ >= best.inertia_ * (1 - tol):
+            stale += 1
+        else:
+            stale = 0
+
+        if best is None or clusterer.inertia_ < best.inertia_:
+            best = clusterer
+
+        if stale >= patience:
+            break
+
+    return best.labels_, best.cluster_centers_, best.inertia_
+
+def seed_centers(X, labels, n_clusters):
+
+    """ Initial centers for clustering X into n_clusters, from a clustering of the same
+        points into a different number of clusters: the neighbouring candidate in a sweep
+        over cluster counts.
+
+        The old clusters' centers are found in X. Then the two clusters that are cheapest
+        to merge (by Ward's criterion) are merged, or the point furthest from every center
+        becomes a new one, until there are n_clusters centers.
+
+        Args:
+
+            X: the points to cluster, one per row
+            labels: the cluster of each point in the other clustering
+            n_clusters: the number of centers wanted
+    """
+
+    _, labels = np.unique(labels, return_inverse=True)
+
+    sizes = np.bincount(labels).astype(float)
+
+    centers = np.zeros((len(sizes), X.shape[1]))
+    np.add.at(centers, labels, X)
+    centers /= sizes[:, np.newaxis]
+
+    while len(centers) > n_clusters:
+        distances = sklearn.metrics.pairwise.euclidean_distances(centers, squared=True)
+        cost = distances * sizes[:, np.newaxis] * sizes / (sizes[:, np.newaxis] + sizes)
+
+        np.fill_diagonal(cost, np.inf)
+
+        i, j = np.unravel_index(np.argmin(cost), cost.shape)
+
+        centers[i] = (centers[i] * sizes[i] + centers[j] * sizes[j]) / (sizes[i] + sizes[j])
+        sizes[i] += sizes[j]
+
+        centers = np.delete(centers, j, axis=0)
+        sizes = np.delete(sizes, j)
+
+    while len(centers) < n_clusters:
+        furthest = sklearn.metrics.pairwise.euclidean_distances(X, centers, squared=True).min(axis=1).argmax()
+
+        centers = np.vstack([centers, X[furthest]])
+        sizes = np.append(sizes, 1)
+
+    return centers
+
+# the number of neighbouring candidate cluster counts that fit_cluster_run() fits one
+# after another. The sweep's runs are always this long, whatever the number of processes
+# they're spread over, so the results don't depend on it.
+
+WARM_START_RUN = 8
+
+def fit_cluster_run(run):
+
+    """ Clusters the beats into each of a run of neighbouring candidate cluster counts,
+        one after another, with adaptive_kmeans(). Each candidate after the first starts
+        from the clustering of the one before it (see seed_centers()).
+
+        This is the unit of work for the cluster sweep with fast_kmeans. It lives at
+        module level so that it can be shipped to a multiprocessing.Pool.
+
+        Args:
+
+            run: a tuple of (candidates, score). candidates is a list of (n_clusters, X)
+                 tuples, where X is the matrix of normalized eigenvectors for that cluster
+                 count. If score is False, the silhouette scores are left out.
+
+        Returns:
+
+            a list of the result for each candidate: as fit_cluster_candidate() returns
+            it if score is True, or as fit_cluster_labels() returns it if not
+    """
+
+    candidates, score = run
+
+    results = []
+    labels = None
+
+    for n_clusters, X in candidates:
+        init = None if labels is None else seed_centers(X, labels, n_clusters)
+
+        labels, _, _ = adaptive_kmeans(X, n_clusters, init=init)
+
+        if score:
+            results.append((labels, sklearn.metrics.silhouette_score(X, labels)))
+        else:
+            results.append(labels)
+
+    return results
+
+class SilhouetteSweep(object):
+
+    """ Estimates the average silhouette score of each candidate clustering in the
+        auto clustering sweep from a fixed random sample of the beats, reusing the work
+        from one candidate to the next.
+
+        Every candidate clusters the rows of X = evecs[:, :k] / Cnorm[:, k-1:k]. Those
+        rows are unit vectors, so the distance between beats i and j is
+
+            sqrt(2 - 2 * G[i, j] / (Cnorm[i, k-1] * Cnorm[j, k-1]))
+
+        where G is the Gram matrix of the first k eigenvectors. Moving from one candidate
+        to the next adds or removes eigenvectors, which is a low-rank update of G. Only
+        the rows of G for the sampled beats are kept, so each candidate costs
+        O(sample_size * N) instead of the O(N^2 * k) of sklearn.metrics.silhouette_score().
+
+        The silhouette of each sampled beat is exact, because it's measured against every
+        beat and not just the other sampled ones. So the estimate is unbiased. Each
+        silhouette lies in [-1, 1], and so by Hoeffding's inequality (in Serfling's form,
+        for sampling without replacement) the estimate is within
+
+            sqrt(2 * (1 - (sample_size - 1) / N) * ln(2 / delta) / sample_size)
+
+        of the true average with probability at least 1 - delta. For a sample of 1000 of
+        4000 beats and delta = 0.05, that's 0.074. That bound assumes the worst spread of
+        silhouettes; the standard errors in standard_errors are the practical measure,
+        and are typically a few thousandths.
+
+        Args:
+
+            evecs: the Laplacian eigenvectors the candidates are clustered from
+            Cnorm: the cumulative normalization of evecs
+            sample_size: the number of beats to sample. With N or more beats, every
+                         beat is used and the scores are exact.
+            seed: seeds the choice of sample, so that the estimates are repeatable
+    """
+
+    def __init__(self, evecs, Cnorm, sample_size, seed=0):
+
+        n = evecs.shape[0]
+
+        self.__evecs = evecs
+        self.__Cnorm = Cnorm
+        self.__rows = np.sort(np.random.RandomState(seed).choice(n, min(sample_size, n), replace=False))
+        self.__gram = np.zeros((len(self.__rows), n))
+        self.__dimensions = 0
+
+        self.standard_errors = {}
+
+    def __set_dimensions(self, k):
+
+        """ Updates the rows of the Gram matrix to cover the first k eigenvectors """
+
+        if k > self.__dimensions:
+            E = self.__evecs[:, self.__dimensions:k]
+            self.__gram += E[self.__rows].dot(E.T)
+
+        elif k < self.__dimensions:
+            E = self.__evecs[:, k:self.__dimensions]
+            self.__gram -= E[self.__rows].dot(E.T)
+
+        self.__dimensions = k
+
+    def score(self, n_clusters, labels):
+
+        """ Returns the estimated average silhouette score of a candidate clustering, and
+            records its standard error in standard_errors.
+
+            Args:
+
+                n_clusters: the candidate cluster count, and so the number of eigenvectors
+                            the beats were clustered by
+                labels: the cluster label of every beat
+        """
+
+        self.__set_dimensions(n_clusters)
+
+        rows = self.__rows
+        m, n = self.__gram.shape
+        sampled = np.arange(m)
+
+        # the distances from each sampled beat to every beat
+
+        scale = 1.0 / self.__Cnorm[:, n_clusters - 1]
+
+        D = self.__gram * scale[rows, np.newaxis]
+        D *= scale
+        D *= -2.0
+        D += 2.0
+
+        np.maximum(D, 0, out=D)
+        np.sqrt(D, out=D)
+
+        # a beat is no distance from itself, whatever the rounding says
+
+        D[sampled, rows] = 0
+
+        # the total distance from each sampled beat to the beats of each cluster. Labels
+        # are renumbered in case KMeans left a cluster empty.
+
+        _, labels = np.unique(labels, return_inverse=True)
+
+        sizes = np.bincount(labels)
+
+        members = np.zeros((n, len(sizes)))
+        members[np.arange(n), labels] = 1
+
+        totals = D.dot(members)
+
+        # a: the mean distance to the rest of the beat's own cluster.
+        # b: the mean distance to the nearest other cluster.
+
+        own = labels[rows]
+
+        a = totals[sampled, own] / np.maximum(sizes[own] - 1, 1)
+
+        totals /= sizes
+        totals[sampled, own] = np.inf
+
+        b = totals.min(axis=1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            s = np.nan_to_num((b - a) / np.maximum(a, b))
+
+        # as for sklearn, a beat alone in its cluster scores 0
+
+        s[sizes[own] == 1] = 0
+
+        if m < n and m > 1:
+            self.standard_errors[n_clusters] = s.std(ddof=1) / math.sqrt(m) * math.sqrt((n - m) / (n - 1.0))
+        else:
+            self.standard_errors[n_clusters] = 0.0
+
+        return s.mean()
+
+def timelag_median_filter(R, size=7, chunk_size=2**16):
+
+    """ Sparse version of librosa.segment.timelag_filter(scipy.ndimage.median_filter)
+        applied with size=(1, size).
+
+        The dense filter shears the N x N recurrence matrix into a 2N x N lag matrix and
+        median filters every row of it, which costs O(N^2) memory. Since the median of a
+        window can only be non-zero when some of its values are, only the stored entries
+        of R and their neighbours along the same diagonal are visited here. The edges
+        are treated the way the dense filter treats them: 'reflect' along the time axis
+        and zeros past the end of each diagonal.
+
+        Args:
+
+                 R: a square scipy.sparse recurrence matrix
+              size: the length of the median window along each diagonal
+        chunk_size: the number of output candidates filtered at once. Bounds the
+                    temporary memory used.
+
+        Returns:
+
+            the filtered recurrence matrix, as a scipy.sparse.csr_matrix
+    """
+
+    R = scipy.sparse.csr_matrix(R)
+    R.sum_duplicates()
+    R.sort_indices()
+
+    n = R.shape[0]
+
+    rec = R.tocoo()
+
+    # the stored entries, keyed by their position in row-major order so they can
+    # be looked up with a binary search
+
+    keys = rec.row.astype(np.int64) * n + rec.col
+    values = rec.data
+
+    lags = rec.row.astype(np.int64) - rec.col
+    offsets = np.arange(size) - size // 2
+
+    # every position that could end up non-zero: the stored entries, slid up and
+    # down their own diagonal by up to half a window
+
+    cols = (rec.col[:, np.newaxis] + offsets).ravel()
+    lags = np.repeat(lags, size)
+    rows = cols + lags
+
+    valid = (cols >= 0) & (cols < n) & (rows >= 0) & (rows < n)
+    candidates = np.unique(rows[valid] * n + cols[valid])
+
+    out_rows = []
+    out_cols = []
+    out_values = []
+
+    for chunk in range(0, len(candidates), chunk_size):
+
+        cand = candidates[chunk:chunk+chunk_size]
+        cand_rows = cand // n
+        cand_cols = cand % n
+
+        # gather each candidate's window along its diagonal, reflecting at the
+        # first and last columns
+
+        win_cols = cand_cols[:, np.newaxis] + offsets
+        win_cols = np.where(win_cols < 0, -win_cols - 1, win_cols)
+        win_cols = np.where(win_cols >= n, 2 * n - win_cols - 1, win_cols)
+        win_rows = win_cols + (cand_rows - cand_cols)[:, np.newaxis]
+
+        in_bounds = (win_rows >= 0) & (win_rows < n)
+        win_keys = np.where(in_bounds, win_rows * n + win_cols, 0)
+
+        pos = np.minimum(np.searchsorted(keys, win_keys), len(keys) - 1)
+        found = in_bounds & (keys[pos] == win_keys)
+
+        medians = np.median(np.where(found, values[pos], 0), axis=1)
+
+        keep = medians != 0
+
+        out_rows.append(cand_rows[keep])
+        out_cols.append(cand_cols[keep])
+        out_values.append(medians[keep])
+
+    if len(out_values) == 0:
+        return scipy.sparse.csr_matrix(R.shape, dtype=R.dtype)
+
+    return scipy.sparse.csr_matrix((np.concatenate(out_values),
+                                    (np.concatenate(out_rows), np.concatenate(out_cols))),
+                                   shape=R.shape)
+
+def laplacian_eigenvectors(L, k):
+
+    """ Computes the eigenvectors for the k smallest eigenvalues of a sparse,
+        normalized graph Laplacian, in ascending order of eigenvalue.
+
+        The eigenvalues of a normalized Laplacian lie in [0, 2], so the smallest ones
+        are found as the largest ones of (I - L) with the Lanczos solver in
+        scipy.sparse.linalg.eigsh. That converges far faster than asking eigsh for the
+        smallest eigenvalues of L directly. The starting vector is fixed so the result
+        is repeatable.
+
+        The diagonal median filter can leave L slightly asymmetric. scipy.linalg.eigh
+        only reads the lower triangle, so L is mirrored from its lower triangle here
+        too, which makes the result match the dense decomposition.
+
+        Args:
+
+            L: the normalized Laplacian, as a scipy.sparse matrix
+            k: the number of eigenvectors to compute
+
+        Returns:
+
+            an N x k matrix whose columns are the eigenvectors
+    """
+
+    n = L.shape[0]
+
+    # Lanczos needs k < N. A matrix that small is cheap to decompose densely anyway.
+
+    if k >= n - 1:
+        _, evecs = scipy.linalg.eigh(L.toarray())
+        return evecs[:, :k]
+
+    L = scipy.sparse.tril(L, format='csr')
+    L = L + scipy.sparse.tril(L, k=-1, format='csr').T
+
+    M = scipy.sparse.identity(n, format='csr') - L
+
+    v0 = np.random.RandomState(0).uniform(-1, 1, n)
+
+    _, evecs = scipy.sparse.linalg.eigsh(M, k=k, which='LA', v0=v0)
+
+    # eigsh returns the eigenvalues of (I - L) in ascending order, which is
+    # descending order for L
+
+    return evecs[:, ::-1]
+
+def warm_up(sr=22050, seconds=10.0):
+
+    """ Runs a tiny analysis of a synthetic click track, so that the one-off costs
+        of the analysis (numba compiling librosa's kernels, building the CQT filters,
+        loading the BLAS and sklearn internals) are paid before a real song arrives.
+        A long-lived worker process calls this once when it starts.
+
+        Args:
+
+            sr: the sample rate to warm up at. The CQT filters depend on it.
+            seconds: the length of the synthetic audio
+
+        Returns:
+
+            the time the warm-up took, in seconds
+    """
+
+    start = time.time()
+
+    # a click every half second over a few slowly changing tones, so that there
+    # are beats to track and more than one kind of beat to cluster
+
+    t = np.arange(int(sr * seconds)) / float(sr)
+
+    y = 0.1 * np.sin(2 * np.pi * 220.0 * (1 + (t // 2) % 3) * t)
+    y[(np.arange(len(t)) % (sr // 2)) < 64] += 0.5
+
+    y = y.astype(np.float32)
+
+    BINS_PER_OCTAVE = 12 * 3
+    N_OCTAVES = 7
+
+    cqt = librosa.cqt(y=y, sr=sr, bins_per_octave=BINS_PER_OCTAVE, n_bins=N_OCTAVES * BINS_PER_OCTAVE)
+    C = librosa.amplitude_to_db(np.abs(cqt), ref=np.max)
+
+    tempo, btz, mfcc, amplitudes = extract_beat_features(y, sr, trim=True)
+
+    Csync = librosa.util.sync(C, btz, aggregate=np.median)
+
+    R = librosa.segment.recurrence_matrix(Csync, width=3, mode='affinity', sym=True)
+    L = scipy.sparse.csgraph.laplacian(R, normed=True)
+
+    _, evecs = scipy.linalg.eigh(L)
+
+    X = evecs[:, :3] / (np.cumsum(evecs**2, axis=1)**0.5)[:, 2:3]
+
+    fit_cluster_candidate((3, X, 1))
+
+    return time.time() - start
+
+class JumpCandidateIndex(object):
+
+    """ Finds the jump candidates for beats by lookup instead of by scanning the
+        whole song for every beat.
+
+        A beat's jump candidates are the beats that sit in the same cluster, at the same
+        position in their segment and (optionally) at the same position in the bar as
+        the beat that would otherwise play next. This index groups the beats by that
+        (cluster, is, id % 4) key once, with each group kept as a sorted NumPy array of
+        beat ids. A beat's candidates then come from one lookup and a vectorized filter
+        of a single group.
+
+        Beat ids are the beats' positions in the arrays that are passed in.
+    """
+
+    def __init__(self, cluster, position, segment, first=0, match_bar_position=True):
+
+        """ Builds the index.
+
+            Args:
+
+                           cluster: the cluster of each beat
+                          position: the position of each beat in its segment (its 'is')
+                           segment: the segment of each beat
+                             first: beats before this position are never jump candidates
+                match_bar_position: set to False to ignore where in the bar (id % 4) a
+                                    beat falls when matching candidates
+        """
+
+        ids = np.arange(len(segment), dtype=np.int64)
+
+        keys = [np.asarray(cluster, dtype=np.int64), np.asarray(position, dtype=np.int64)]
+
+        if match_bar_position:
+            keys.append(ids % 4)
+
+        self.__keys = np.stack(keys, axis=1)
+        self.__segments = np.asarray(segment, dtype=np.int64)
+        self.__empty = np.array([], dtype=np.int64)
+        self.__groups = {}
+
+        # sort the jumpable beats by key, and by id within each key, then cut the
+        # sorted ids wherever the key changes
+
+        ids = ids[first:]
+
+        if len(ids) == 0:
+            return
+
+        order = ids[np.lexsort([ids] + [k[first:] for k in reversed(keys)])]
+        sorted_keys = self.__keys[order]
+
+        bounds = np.flatnonzero(np.any(np.diff(sorted_keys, axis=0) != 0, axis=1)) + 1
+        bounds = [0] + bounds.tolist() + [len(order)]
+
+        for begin, end in zip(bounds[:-1], bounds[1:]):
+            self.__groups[tuple(sorted_keys[begin].tolist())] = order[begin:end]
+
+    def candidates(self, beat_id, next_id, before=None):
+
+        """ Returns the ids of the beats to which it is reasonable to jump instead of
+            playing beat next_id after beat beat_id. Those are the beats that match
+            next_id's group, but that AREN'T next_id itself and AREN'T in beat_id's
+            segment.
+
+            Args:
+
+                beat_id: the id of the beat that is playing
+                next_id: the id of the beat that would play next if there were no jump
+                 before: if set, only beats with a lower id are considered
+
+            Returns:
+
+                a list of beat ids, in ascending order
+        """
+
+        ids = self.__groups.get(tuple(self.__keys[next_id].tolist()), self.__empty)
+
+        if before is not None:
+            ids = ids[:np.searchsorted(ids, before)]
+
+        keep = (self.__segments[ids] != self.__segments[beat_id]) & (ids != next_id)
+
+        return ids[keep].tolist()
+
+class BeatView(collections.abc.MutableMapping):
+
+    """ A dictionary-like view of one beat in a BeatTable.
+
+        Reading a key returns a plain Python value, so a view can stand in anywhere a
+        beat dictionary used to. 'jump_candidates' comes back as a list and 'buffer'
+        as a slice of the table's raw audio. Assigning a key writes through to the
+        table. Keys can't be added or removed.
+    """
+
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __getitem__(self, key):
+
+        if key in self.table.columns.dtype.names:
+            return self.table.columns[key][self.index].item()
+
+        if key == 'jump_candidates' and self.table.jump_offsets is not None:
+            return self.table.jump_candidates(self.index).tolist()
+
+        if key == 'buffer' and self.table.raw_audio is not None:
+            return self.table.buffer(self.index)
+
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+
+        if key in self.table.columns.dtype.names:
+            self.table.columns[key][self.index] = value
+        elif key == 'jump_candidates':
+            self.table.set_jump_candidates(self.index, value)
+        elif key == 'buffer':
+            raise TypeError("a beat's buffer is always raw_audio[start_index:stop_index]")
+        else:
+            raise KeyError(key)
+
+    def __delitem__(self, key):
+        raise TypeError('keys cannot be removed from a beat')
+
+    def __iter__(self):
+        return iter(self.table.keys())
+
+    def __len__(self):
+        return len(self.table.keys())
+
+    def __eq__(self, other):
+
+        if isinstance(other, BeatView):
+            return self.table is other.table and self.index == other.index
+
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'BeatView(%r)' % {k: v for k, v in self.items() if k != 'buffer'}
+
+class BeatTable(collections.abc.Sequence):
+
+    """ The beats of a song, stored column by column.
+
+        Every per-beat scalar (start, duration, cluster, segment, ...) is a field of one
+        NumPy structured array, and the jump candidates of all the beats are packed
+        into two flat arrays in CSR (compressed sparse row) form: the candidates of
+        beat i are jump_targets[jump_offsets[i]:jump_offsets[i+1]]. A beat's audio
+        isn't copied at all. Its buffer is sliced out of raw_audio when asked for.
+
+        That costs a few dozen bytes per beat, against a dictionary, a list and an
+        array view per beat for a list of beat dictionaries. Indexing the table still
+        gives a dictionary-like BeatView, so code written against the old list of
+        dictionaries keeps working. Code that touches every beat should read the
+        columns directly.
+
+        Attributes:
+
+                 columns: the structured array of per-beat values. Which fields it has
+                          depends on how the table was built. See FIELDS.
+            jump_offsets: int64 array of len(table) + 1 offsets into jump_targets, or
+                          None if the table has no jump candidates
+            jump_targets: int32 array of the packed jump candidate ids
+               raw_audio: the audio the start_index/stop_index fields point into, or None
+    """
+
+    # the per-beat fields a table can hold, in the order they are kept
+
+    FIELDS = (('start', np.float64),
+              ('cluster', np.int32),
+              ('amplitude', np.float64),
+              ('segment', np.int32),
+              ('is', np.int32),
+              ('duration', np.float64),
+              ('start_index', np.int64),
+              ('stop_index', np.int64),
+              ('id', np.int32),
+              ('quartile', np.float64),
+              ('next', np.int32))
+
+    def __init__(self, columns, jump_offsets=None, jump_targets=None, raw_audio=None):
+        self.columns = columns
+        self.jump_offsets = jump_offsets
+        self.jump_targets = jump_targets
+        self.raw_audio = raw_audio
+
+    @classmethod
+    def dtype(cls, names):
+
+        """ The structured dtype for a table holding the given fields, in FIELDS order. """
+
+        return np.dtype([(name, kind) for name, kind in cls.FIELDS if name in names])
+
+    @classmethod
+    def from_dicts(cls, beats, raw_audio=None):
+
+        """ Builds a table from a list of beat dictionaries.
+
+            The fields are the ones in FIELDS that the first beat has. 'jump_candidates'
+            is packed if the first beat has it, and 'buffer' is never copied; pass the
+            audio it was sliced from as raw_audio instead. Other keys are ignored. Every
+            beat must have the same fields (and 'jump_candidates', or not) as the first,
+            or a ValueError is raised.
+
+            Args:
+
+                    beats: a list of beat dictionaries
+                raw_audio: the audio the beats' start_index/stop_index point into
+        """
+
+        first = beats[0] if len(beats) > 0 else {}
+
+        # a table has one set of fields, so a beat that has more or fewer of them than
+        # the first can't be stored in it
+
+        keys = [name for name, _ in cls.FIELDS] + ['jump_candidates']
+
+        for i, beat in enumerate(beats):
+            differing = [name for name in keys if (name in beat) != (name in first)]
+
+            if len(differing) > 0:
+                raise ValueError('beat %d and the first beat differ in the fields %s' % (i, ', '.join(differing)))
+
+        dtype = cls.dtype(first.keys())
+        columns = np.array([tuple(b[name] for name in dtype.names) for b in beats], dtype=dtype)
+
+        jump_offsets, jump_targets = None, None
+
+        if 'jump_candidates' in first:
+            jump_offsets, jump_targets = cls.pack_jump_candidates([b['jump_candidates'] for b in beats])
+
+        return cls(columns, jump_offsets, jump_targets, raw_audio)
+
+    @staticmethod
+    def pack_jump_candidates(candidates):
+
+        """ Packs a list of per-beat jump candidate lists into CSR form.
+
+            Returns:
+
+                a tuple of (jump_offsets, jump_targets)
+        """
+
+        jump_offsets = np.zeros(len(candidates) + 1, dtype=np.int64)
+        jump_offsets[1:] = np.cumsum([len(c) for c in candidates])
+
+        jump_targets = np.fromiter(itertools.chain.from_iterable(candidates), dtype=np.int32,
+                                   count=int(jump_offsets[-1]))
+
+        return jump_offsets, jump_targets
+
+    def to_dicts(self, include_buffer=False):
+
+        """ Exports the table as a list of plain beat dictionaries, e.g. for JSON.
+
+            Args:
+
+                include_buffer: set to True to include each beat's 'buffer' slice
+        """
+
+        names = self.columns.dtype.names
+
+        beats = [dict(zip(names, row)) for row in self.columns.tolist()]
+
+        if self.jump_offsets is not None:
+            targets = self.jump_targets.tolist()
+            offsets = self.jump_offsets.tolist()
+
+            for i, beat in enumerate(beats):
+                beat['jump_candidates'] = targets[offsets[i]:offsets[i+1]]
+
+        if include_buffer and self.raw_audio is not None:
+            for i, beat in enumerate(beats):
+                beat['buffer'] = self.buffer(i)
+
+        return beats
+
+    def to_arrays(self, prefix=''):
+
+        """ Exports the table as a dictionary of plain arrays, e.g. for np.savez. The
+            audio is left out. See from_arrays().
+
+            Args:
+
+                prefix: prepended to every key, so several tables can share a dictionary
+        """
+
+        arrays = {prefix + 'columns': self.columns}
+
+        if self.jump_offsets is not None:
+            arrays[prefix + 'jump_offsets'] = self.jump_offsets
+            arrays[prefix + 'jump_targets'] = self.jump_targets
+
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, raw_audio=None, prefix=''):
+
+        """ Rebuilds a table exported by to_arrays().
+
+            Args:
+
+                   arrays: the dictionary of arrays
+                raw_audio: the audio the beats' start_index/stop_index point into
+                   prefix: the prefix the table was exported with
+        """
+
+        return cls(arrays[prefix + 'columns'],
+                   arrays.get(prefix + 'jump_offsets'),
+                   arrays.get(prefix + 'jump_targets'),
+                   raw_audio)
+
+    def keys(self):
+
+        """ The keys every BeatView of this table has. """
+
+        keys = list(self.columns.dtype.names)
+
+        if self.jump_offsets is not None:
+            keys.append('jump_candidates')
+
+        if self.raw_audio is not None:
+            keys.append('buffer')
+
+        return keys
+
+    def jump_candidates(self, i):
+
+        """ The jump candidates of beat i, as a read-only slice of jump_targets. """
+
+        return self.jump_targets[self.jump_offsets[i]:self.jump_offsets[i+1]]
+
+    def jump_counts(self):
+
+        """ The number of jump candidates of every beat, as an array. """
+
+        return np.diff(self.jump_offsets)
+
+    def set_jump_candidates(self, i, candidates):
+
+        """ Replaces the jump candidates of beat i. This repacks the whole CSR array,
+            so it is meant for occasional edits rather than for building a table.
+        """
+
+        i = self.__position(i)
+
+        lists = [self.jump_candidates(b).tolist() for b in range(len(self))]
+        lists[i] = list(candidates)
+
+        self.jump_offsets, self.jump_targets = self.pack_jump_candidates(lists)
+
+    def buffer(self, i):
+
+        """ The audio of beat i: raw_audio[start_index:stop_index]. """
+
+        row = self.columns[i]
+
+        return self.raw_audio[row['start_index']:row['stop_index']]
+
+    def __position(self, i):
+
+        if i < 0:
+            i += len(self)
+
+        if i < 0 or i >= len(self):
+            raise IndexError('beat index out of range')
+
+        return i
+
+    def __len__(self):
+        return len(self.columns)
+
+    def __getitem__(self, i):
+
+        if isinstance(i, slice):
+            return [BeatView(self, b) for b in range(*i.indices(len(self)))]
+
+        return BeatView(self, self.__position(int(i)))
+
+    def __iter__(self):
+        return (BeatView(self, b) for b in range(len(self)))
+
+class AnalysisCache(object):
+
+    """ A cache of finished analyses, on disk, shared by every front end.
+
+        Entries are keyed by a hash of the audio file's content plus the analysis
+        parameters (see key()), so two songs with the same file name never collide
+        and the same audio is never analysed twice with the same settings, whatever
+        it is called. Each entry is a directory holding meta.json (the schema version
+        and the plain values) and one .npy file per NumPy array, so that big arrays
+        (like audio) can be memory-mapped straight out of the cache rather than read.
+
+        Entries are written into a staging directory and renamed into place, so a
+        reader sees a whole entry or none at all. Reading an entry marks it as used,
+        and once the cache grows past max_bytes the least recently used entries are
+        evicted. Bump SCHEMA_VERSION whenever what is stored changes; entries written
+        with another version are never read.
+
+        Attributes:
+
+            cache_dir: the directory the entries live in
+            max_bytes: evict entries once the cache is larger than this. None means
+                       the cache is never trimmed.
+    """
+
+    SCHEMA_VERSION = 2
+
+    def __init__(self, cache_dir, max_bytes=1024 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def content_hash(filename, chunk_size=1024 * 1024):
+
+        """ The SHA-256 of a file's content, as a hex string. """
+
+        sha = hashlib.sha256()
+
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                sha.update(chunk)
+
+        return sha.hexdigest()
+
+    def key(self, content_hash, **params):
+
+        """ The key of the entry for some audio analysed with some parameters.
+
+            Args:
+
+                content_hash: the content_hash() of the audio file
+                      params: the analysis parameters. They must be JSON serializable.
+        """
+
+        description = json.dumps({'schema': self.SCHEMA_VERSION,
+                                  'content': content_hash,
+                                  'params': params}, sort_keys=True)
+
+        return hashlib.sha256(description.encode('utf-8')).hexdigest()
+
+    def load(self, key, mmap=()):
+
+        """ Reads an entry and marks it as recently used.
+
+            Args:
+
+                 key: the key() of the entry
+                mmap: the names of the arrays to memory-map (read only) instead of read
+
+            Returns:
+
+                a tuple of (values, arrays) -- the dictionaries passed to store() -- or
+                None if there's no usable entry for key
+        """
+
+        entry = os.path.join(self.cache_dir, key)
+
+        try:
+            with open(os.path.join(entry, 'meta.json'), 'r') as f:
+                meta = json.load(f)
+
+            if meta.get('schema') != self.SCHEMA_VERSION:
+                return None
+
+            arrays = {}
+
+            for name in meta['arrays']:
+                arrays[name] = np.load(os.path.join(entry, name + '.npy'), allow_pickle=False,
+                                       mmap_mode='r' if name in mmap else None)
+
+            os.utime(entry)
+
+        except (OSError, ValueError, KeyError):
+            return None
+
+        return meta['values'], arrays
+
+    def store(self, key, values, arrays):
+
+        """ Writes an entry, replacing any entry already stored under key, then evicts
+            the least recently used entries if the cache has grown too large.
+
+            Args:
+
+                     key: the key() of the entry
+                values: a dictionary of JSON serializable values
+                arrays: a dictionary of NumPy arrays, named like variables. Object arrays
+                        aren't allowed.
+        """
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        entry = os.path.join(self.cache_dir, key)
+        staging = tempfile.mkdtemp(prefix='.staging-', dir=self.cache_dir)
+
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(staging, name + '.npy'), array, allow_pickle=False)
+
+            with open(os.path.join(staging, 'meta.json'), 'w') as f:
+                json.dump({'schema': self.SCHEMA_VERSION, 'values': values, 'arrays': sorted(arrays)}, f)
+
+            # an existing entry is moved aside rather than overwritten in place, so
+            # that nobody ever reads half of one
+
+            self.remove(key)
+
+            try:
+                os.rename(staging, entry)
+            except OSError:
+                # another process stored the same entry first. Keep theirs.
+                pass
+
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+        self.evict(keep=key)
+
+    def remove(self, key):
+
+        """ Removes the entry for key, if there is one. """
+
+        entry = os.path.join(self.cache_dir, key)
+
+        if not os.path.isdir(entry):
+            return
+
+        retired = tempfile.mkdtemp(prefix='.retired-', dir=self.cache_dir)
+
+        try:
+            os.rename(entry, os.path.join(retired, key))
+        except OSError:
+            pass
+
+        shutil.rmtree(retired, ignore_errors=True)
+
+    def remove_arrays(self, key, names):
+
+        """ Removes some of the arrays from the entry for key, if there is one. The rest
+            of the entry is kept.
+        """
+
+        entry = os.path.join(self.cache_dir, key)
+
+        try:
+            with open(os.path.join(entry, 'meta.json'), 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        meta['arrays'] = [name for name in meta.get('arrays', []) if name not in names]
+
+        # rewrite meta.json first, so the entry never lists an array that's gone
+
+        staging = os.path.join(entry, '.meta.json')
+
+        with open(staging, 'w') as f:
+            json.dump(meta, f)
+
+        os.replace(staging, os.path.join(entry, 'meta.json'))
+
+        for name in names:
+            try:
+                os.remove(os.path.join(entry, name + '.npy'))
+            except OSError:
+                pass
+
+    def evict(self, keep=None):
+
+        """ Removes the least recently used entries until the cache is no larger than
+            max_bytes. The entry for keep is never removed.
+        """
+
+        if self.max_bytes is None or not os.path.isdir(self.cache_dir):
+            return
+
+        entries = []
+
+        for name in os.listdir(self.cache_dir):
+
+            entry = os.path.join(self.cache_dir, name)
+
+            # skip anything that's still being written or removed
+
+            if name.startswith('.') or not os.path.isdir(entry):
+                continue
+
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, name))
+            except OSError:
+                continue
+
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, name in sorted(entries):
+
+            if total <= self.max_bytes:
+                break
+
+            if name != keep:
+                self.remove(name)
+                total -= size
+
 class InfiniteJukebox(object):
 
     """ Class to "infinitely" remix a song.
@@ -85,12 +1345,15 @@ class InfiniteJukebox(object):
 
     sample_rate: the sample rate from the audio file. Usually 44100 or 48000
 
+    beat_frames: the STFT frames (hop length 512, at the analysis sample rate) at which the
+                 beats were found
+
        clusters: the number of clusters used to group the beats. If you pass in a value, then
                  this will be reflected here. If you let the algorithm decide, then auto-generated
                  value will be reflected here.
 
-          beats: a dictionary containing the individual beats of the song in normal order. Each
-                 beat will have the following keys:
+          beats: a BeatTable containing the individual beats of the song in normal order. Each
+                 beat reads like a dictionary with the following keys:
 
                          id: the ordinal position of the beat in the song
                       start: the time (in seconds) in the song where this beat occurs
@@ -137,10 +1400,17 @@ class InfiniteJukebox(object):
                  seq_pos: this beat's position in seq_len. When
                           seq_len - seq_pos == 0 the song will "jump"
 
+        timings: a dictionary of how long (in seconds) each stage of the processing took,
+                 in the order the stages ran. See timing_report() for a printable version.
+
+      cache_key: the key of this song's entry in the analysis cache (see AnalysisCache).
+                 It is only worked out when it is first needed.
+
     """
 
     def __init__(self, filepath, start_beat=1, use_cache = False, clusters=0, max_clusters = 48, progress_callback=None,
-                 do_async=False, use_v1=False):
+                 do_async=False, use_v1=False, n_jobs=None, sparse_eigen=False, pcm_path=None,
+                 analysis_sr=None, silhouette_sample=None, fast_kmeans=False):
 
         """ The constructor for the class. Also starts the processing thread.
 
@@ -149,7 +1419,7 @@ class InfiniteJukebox(object):
                 filepath: the path to the audio file to process
               start_beat: the first beat to play in the file. Should almost always be 1,
                           but you can override it to skip into a specific part of the song.
-               use_cache: use cache if it exists
+               use_cache: use the song's entry in the analysis cache if it has one
                 clusters: the number of similarity clusters to compute. The DEFAULT value
                           of 0 means that the code will try to automatically find an optimal
                           cluster. If you specify your own value, it MUST be non-negative. Lower
@@ -164,6 +1434,34 @@ class InfiniteJukebox(object):
                                       message: STRING with the progress message
                   use_v1: set to True if you want to use the original auto clustering algorithm.
                           Otherwise, it will use the newer silhouette-based scheme.
+                  n_jobs: the number of processes used to test candidate cluster counts in
+                          parallel. The DEFAULT of None uses every core. Pass 1 to do all
+                          the work in the calling process.
+            sparse_eigen: set to True to keep the recurrence matrices sparse and compute
+                          only the eigenvectors the clustering needs. Memory then grows
+                          roughly linearly with the number of beats instead of
+                          quadratically, which matters for very long tracks.
+                pcm_path: write the trimmed audio, as int16 PCM, to a .npy file at this path
+                          and memory-map raw_audio (and so every beat's buffer) from it,
+                          instead of holding it in memory. The DEFAULT of None keeps it in
+                          memory.
+             analysis_sr: the highest sample rate to analyse the audio at. Audio at a higher
+                          rate is resampled down to it before its features are extracted,
+                          which makes the analysis much quicker for 48kHz or 96kHz audio.
+                          raw_audio, and so playback, keeps the file's own rate. The DEFAULT
+                          of None analyses the audio at the file's own rate.
+       silhouette_sample: when auto clustering a song with more beats than this, estimate
+                          each candidate's silhouette score from this many of its beats
+                          instead of all of them. See SilhouetteSweep for how close the
+                          estimates are. Around 1000 makes the scoring of long tracks
+                          several times quicker. The DEFAULT of None always scores every
+                          beat.
+             fast_kmeans: set to True to cluster with adaptive_kmeans(), which stops
+                          restarting KMeans once the restarts stop paying off, and to start
+                          each candidate of the auto clustering sweep from the clustering of
+                          its neighbour. That's several times quicker than the fixed
+                          n_init=20 (or 1000) of the DEFAULT of False, and finds clusterings
+                          that are as tight on average, but not the same ones.
         """
         self.__progress_callback = progress_callback
         self.filepath = filepath
@@ -172,11 +1470,33 @@ class InfiniteJukebox(object):
         self.__max_clusters = max_clusters
         self._extra_diag = ""
         self._use_v1 = use_v1
+        self._n_jobs = n_jobs
+        self._sparse_eigen = sparse_eigen
+        self._pcm_path = pcm_path
+        self._analysis_sr = analysis_sr
+        self._silhouette_sample = silhouette_sample
+        self._fast_kmeans = fast_kmeans
         self.cache_option = CacheOptions.DISCARD
+        self.timings = collections.OrderedDict()
+
+        # songs are cached by their content and the analysis settings, not by their
+        # file names. See AnalysisCache. Hashing the file takes a while for a long
+        # song, so the key is only worked out once the cache is used (see cache_key).
 
-        if use_cache and os.path.isfile(os.path.join(CONFIG['cacheDir'], Path(filepath).stem + '.csv')):
+        self.__cache = AnalysisCache(CONFIG['cacheDir'], CONFIG['cacheSizeMB'] * 1024 * 1024)
+        self.__cache_args = {'clusters': clusters, 'max_clusters': max_clusters, 'use_v1': use_v1,
+                             'start_beat': start_beat, 'analysis_sr': analysis_sr,
+                             'silhouette_sample': silhouette_sample, 'fast_kmeans': fast_kmeans}
+        self.__cache_key = None
+
+        cached = None
+
+        if use_cache:
+            cached = self.__cache.load(self.cache_key, mmap=['raw_audio'])
+
+        if cached is not None:
             self.evecs = np.array([])
-            self.__load_cache()
+            self.__load_cache(*cached)
         else:
             if do_async == True:
                 self.play_ready = threading.Event()
@@ -189,75 +1509,96 @@ class InfiniteJukebox(object):
 
 
 
-    def save_cache(self, cache_evecs = False):
-        os.makedirs(CONFIG['cacheDir'], exist_ok=True)
-        with open(os.path.join(CONFIG['cacheDir'], Path(self.filepath).stem + '.csv'), 'w', newline='') as csvfile:
-            fieldnames = ['start_index', 'cluster']  # , 'stop_index', 'start', 'duration' ]
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerow({'start_index': "",  # jukebox.filename,
-                             'cluster': self.avg_amplitude})
-            writer.writerow({'start_index': self.__start_beat,
-                             'cluster': self.clusters})
-            # ,
-            # 'stop_index': filepath,
-            # 'start': 0,
-            # 'duration': jukebox.duration})
-            for beat in self.beats:
-                writer.writerow({'start_index': beat['start_index'],
-                                 'cluster': beat['cluster']})  # ,
-                # 'stop_index': beat['stop_index'],
-                # 'start': beat['start'],
-                # 'duration': beat['duration']})
+    @property
+    def cache_key(self):
+
+        """ The key of this song's entry in the analysis cache. It is worked out, and the
+            file hashed, the first time it is read.
+        """
+
+        if self.__cache_key is None:
+            self.__cache_key = InfiniteJukebox.analysis_cache_key(self.__cache,
+                                                                  AnalysisCache.content_hash(self.filepath),
+                                                                  **self.__cache_args)
+
+        return self.__cache_key
+
+    def save_cache(self, cache_evecs = False, cache_audio = False):
+
+        """ Stores the beats in the analysis cache. See AnalysisCache.
+
+            Args:
+
+                cache_evecs: also store the eigenvectors needed to recluster the beats
+                cache_audio: also store the trimmed audio, so that opening the song from
+                             the cache maps it from disk instead of decoding the file
+        """
+
+        values = {'avg_amplitude': float(self.avg_amplitude), 'clusters': int(self.clusters),
+                  'tempo': float(self.tempo), 'sample_rate': int(self.sample_rate),
+                  'duration': float(self.duration), 'start_index': int(self.start_index)}
+
+        arrays = {'start_index': self.beats.columns['start_index'],
+                  'cluster': self.beats.columns['cluster'],
+                  'amplitude': self.beats.columns['amplitude'],
+                  'beat_frames': np.asarray(self.beat_frames)}
 
         if cache_evecs:
-            np.save(os.path.join(CONFIG['cacheDir'], Path(self.filepath).stem + '.npy'), self.evecs)
+            arrays['evecs'] = self.evecs
+
+        if cache_audio:
+            arrays['raw_audio'] = self.raw_audio
+
+        self.__cache.store(self.cache_key, values, arrays)
 
     def remove_cache(self):
-        songname = Path(self.filepath).stem
+
+        """ Removes the song from the analysis cache, or just its eigenvectors, as
+            cache_option says.
+        """
+
         if self.cache_option == self.cache_option.DISCARD:
-            if os.path.isfile(os.path.join(CONFIG['cacheDir'], songname + '.csv')):
-                os.remove(os.path.join(CONFIG['cacheDir'], songname + '.csv'))
-            if os.path.isfile(os.path.join(CONFIG['cacheDir'], songname + '.npy')):
-                os.remove(os.path.join(CONFIG['cacheDir'], songname + '.npy'))
+            self.__cache.remove(self.cache_key)
         elif self.cache_option == self.cache_option.KEEP_CACHE:
-            if os.path.isfile(os.path.join(CONFIG['cacheDir'], songname + '.npy')):
-                os.remove(os.path.join(CONFIG['cacheDir'], songname + '.npy'))
-
-    def __load_cache(self):
-        self.beats = []
-        with open(os.path.join(CONFIG['cacheDir'], Path(self.filepath).stem + '.csv'), newline='') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for i, beat in enumerate(reader):
-                if i == 0:
-                    #if beat['start_index'] != self.filepath:
-                    #    break
-                    self.__report_progress(.8, "loading from cache...")
-                    self.avg_amplitude = float(beat['cluster'])
-
-                elif i == 1:
-                    start_index_diff = max(0, int(beat['start_index']) - self.__start_beat)
-                    self.__start_beat += start_index_diff
-                    clusters = int(beat['cluster'])
-                elif i >= start_index_diff + 2:
-                    self.beats.append({'start_index': int(beat['start_index']),
-                                  'cluster': int(beat['cluster'])})#,
-                                  #'id': i})  # ,
-                    # 'stop_index': beat['stop_index'],
-                    # 'start': beat['start'],
-                    # 'duration': beat['duration']})
+            self.__cache.remove_arrays(self.cache_key, ['evecs'])
 
-        y, sr = librosa.core.load(self.filepath, mono=False, sr=None)
-        y, index = librosa.effects.trim(y)
+    def __load_cache(self, values, arrays):
 
-        self.start_index = index[0]
+        self.__report_progress(.8, "loading from cache...")
 
-        self.duration = librosa.core.get_duration(y, sr)
-        self.raw_audio = (y * np.iinfo(np.int16).max).astype(np.int16).T.copy(order='C')
-        self.sample_rate = sr
+        self.avg_amplitude = values['avg_amplitude']
+        self.tempo = values['tempo']
+        self.beat_frames = arrays['beat_frames']
+        clusters = values['clusters']
+
+        columns = np.empty(len(arrays['start_index']), dtype=BeatTable.dtype(['cluster', 'amplitude', 'start_index']))
+        columns['start_index'] = arrays['start_index']
+        columns['cluster'] = arrays['cluster']
+        columns['amplitude'] = arrays['amplitude']
+
+        if 'raw_audio' in arrays:
+
+            # the trimmed audio was cached too, so it's mapped from the cache rather than decoded
+
+            self.raw_audio = arrays['raw_audio']
+            self.sample_rate = values['sample_rate']
+            self.duration = values['duration']
+            self.start_index = values['start_index']
+
+        else:
+            y, sr = librosa.core.load(self.filepath, mono=False, sr=None)
+            y, index = librosa.effects.trim(y)
+
+            self.start_index = index[0]
+
+            self.duration = librosa.core.get_duration(y, sr)
+            self.raw_audio = float_to_pcm(y, self._pcm_path)
+            self.sample_rate = sr
 
-        if os.path.isfile(os.path.join(CONFIG['cacheDir'], Path(self.filepath).stem + '.npy')):
-            self.evecs = np.load(os.path.join(CONFIG['cacheDir'], Path(self.filepath).stem + '.npy'))
+        if 'evecs' in arrays:
+            self.evecs = arrays['evecs']
+
+        self.beats = BeatTable(columns)
 
         if self.clusters == 0: # if 0 in config, use what was saved
             self.clusters = clusters
@@ -267,58 +1608,56 @@ class InfiniteJukebox(object):
 
     def recompute_beat_array(self, clusters):
 
+        cluster = self.beats.columns['cluster']
+
         if (self.clusters != clusters): # if num of clusters different from what was saved
 
             seg_ids, self.clusters = self.__compute_cluster(self.evecs, clusters, self._use_v1)
 
-            for i, beat in enumerate(self.beats):
-                beat['cluster'] = seg_ids[i]
+            cluster = np.asarray(seg_ids)[:len(self.beats)]
         else:
             self.clusters = clusters
 
         total_indices = self.raw_audio.shape[0]
 
-        for i, beat in enumerate(self.beats):
-            beat['id'] = i
-            beat['start'] = (beat['start_index']/total_indices) * self.duration
-            beat['quartile'] = beat['id'] // (len(self.beats) / 4.0)
+        start_index = self.beats.columns['start_index'].astype(np.int64)
+        beat_count = len(start_index)
+        ids = np.arange(beat_count)
 
-            if i == (len(self.beats) - 1):
-                beat['stop_index'] = total_indices
-                beat['next'] = self.beats[0]['id']
-                beat['duration'] = self.duration - beat['start']
-            else:
-                beat['stop_index']  = self.beats[i + 1]['start_index']
-                beat['next'] = i + 1
-                beat['duration'] = ((self.beats[i + 1]['start_index'] - beat['start_index']) / total_indices) * self.duration
+        stop_index = np.append(start_index[1:], total_indices)
 
-            if i == 0:
-                beat['segment'] = 0
-                beat['is'] = 0
-            else:
-                if beat['cluster'] != self.beats[i - 1]['cluster']:
-                    beat['segment'] = self.beats[i - 1]['segment'] + 1
-                    beat['is'] = 0
-                else:
-                    beat['segment'] = self.beats[i - 1]['segment']
-                    beat['is'] = self.beats[i - 1]['is'] + 1
+        start = (start_index / total_indices) * self.duration
+        duration = ((stop_index - start_index) / total_indices) * self.duration
+        duration[-1] = self.duration - start[-1]
 
-            beat['buffer'] = self.raw_audio[beat['start_index']: beat['stop_index']]
+        next_beat = ids + 1
+        next_beat[-1] = ids[0]
 
-        for beat in self.beats[:-1]:
-            jump_candidates = [bx['id'] for bx in self.beats[:beat['id']] if  # only consider beats that are earlier
-                               (bx['cluster'] == self.beats[beat['next']]['cluster']) and
-                               (bx['is'] == self.beats[beat['next']]['is']) and
-                               # (bx['id'] % 4 == beats[beat['next']]['id'] % 4) and # removed as was limiting loop points
-                               (bx['segment'] != beat['segment']) and
-                               (bx['id'] != beat['next'])]
+        # a new segment starts wherever the cluster changes, and 'is' counts the beats
+        # since the start of the segment
 
-            if jump_candidates:
-                beat['jump_candidates'] = jump_candidates
-            else:
-                beat['jump_candidates'] = []
+        new_segment = np.ones(beat_count, dtype=bool)
+        new_segment[1:] = cluster[1:] != cluster[:-1]
+
+        segment = np.cumsum(new_segment) - 1
+        position = ids - np.maximum.accumulate(np.where(new_segment, ids, 0))
+
+        computed = {'id': ids, 'start': start, 'quartile': ids // (beat_count / 4.0),
+                    'stop_index': stop_index, 'next': next_beat, 'duration': duration,
+                    'cluster': cluster, 'segment': segment, 'is': position}
+
+        columns = np.zeros(beat_count, dtype=BeatTable.dtype(set(self.beats.columns.dtype.names) | set(computed)))
+
+        for name in columns.dtype.names:
+            columns[name] = computed[name] if name in computed else self.beats.columns[name]
+
+        candidate_index = JumpCandidateIndex(cluster, position, segment, match_bar_position=False)
+
+        # only consider beats that are earlier. The bar position isn't matched, as it was limiting loop points
+        jump_candidates = [candidate_index.candidates(i, i + 1, before=i) for i in range(beat_count - 1)]
+        jump_candidates.append([])
 
-        self.beats[-1]['jump_candidates'] = []
+        self.beats = BeatTable(columns, *BeatTable.pack_jump_candidates(jump_candidates), raw_audio=self.raw_audio)
 
     def __process_audio(self):
 
@@ -335,6 +1674,7 @@ class InfiniteJukebox(object):
         """
 
         start = time.time()
+        stage_start = start
 
         self.__report_progress( .1, "loading file and extracting raw audio")
 
@@ -349,7 +1689,7 @@ class InfiniteJukebox(object):
         self.start_index = index[0]
 
         self.duration = librosa.core.get_duration(y,sr)
-        self.raw_audio = (y * np.iinfo(np.int16).max).astype(np.int16).T.copy(order='C')
+        self.raw_audio = float_to_pcm(y, self._pcm_path)
         self.sample_rate = sr
 
         # after the raw audio bytes are saved, convert the samples to mono
@@ -357,6 +1697,15 @@ class InfiniteJukebox(object):
 
         y = librosa.core.to_mono(y)
 
+        # only playback needs the full sample rate. The beats are timed in seconds,
+        # so they still line up with raw_audio.
+
+        if self._analysis_sr is not None and sr > self._analysis_sr:
+            y = resample_poly(y, sr, self._analysis_sr)
+            sr = self._analysis_sr
+
+        stage_start = self.__record_timing('load', stage_start)
+
         self.__report_progress( .2, "computing pitch data and finding beats...")
 
         # Compute the constant-q chromagram for the samples.
@@ -364,19 +1713,27 @@ class InfiniteJukebox(object):
         BINS_PER_OCTAVE = 12 * 3
         N_OCTAVES = 7
 
-        # If multiple cores exist, process cqt and beat track at same time to cut computation time
-        if multiprocessing.cpu_count() > 1:
+        # The beat tracker input, the MFCCs and the amplitudes all come from one shared STFT of the
+        # mono signal. If multiple cores exist, process cqt and the STFT features at same time to cut
+        # computation time (unless we've been asked to do all the work in this process)
+        if multiprocessing.cpu_count() > 1 and self._n_jobs != 1:
             f_cqt = functools.partial(librosa.cqt, y=y, sr=sr, bins_per_octave=BINS_PER_OCTAVE, n_bins=N_OCTAVES * BINS_PER_OCTAVE)
-            f_beat_track = functools.partial(librosa.beat.beat_track, y=y, sr=sr, trim=False)
+            f_beat_features = functools.partial(extract_beat_features, y, sr, trim=False)
 
             with multiprocessing.Pool(processes=2) as pool:
-                res = pool.map(smap, [f_cqt, f_beat_track])
+                res = pool.map(smap, [f_cqt, f_beat_features])
                 cqt = res[0]
-                tempo = res[1][0]
-                btz = res[1][1]
+                tempo, btz, mfcc, amplitudes = res[1]
+
+            stage_start = self.__record_timing('cqt and beat features', stage_start)
         else:
             cqt = librosa.cqt(y=y, sr=sr, bins_per_octave=BINS_PER_OCTAVE, n_bins=N_OCTAVES * BINS_PER_OCTAVE) ######
-            tempo, btz = librosa.beat.beat_track(y=y, sr=sr, trim=False)  ##########
+
+            stage_start = self.__record_timing('cqt', stage_start)
+
+            tempo, btz, mfcc, amplitudes = extract_beat_features(y, sr, trim=False, timings=self.timings)
+
+            stage_start = time.time()
 
         # Cynthia
         # single core: 21s, 23s, 28s, 26s
@@ -401,6 +1758,7 @@ class InfiniteJukebox(object):
         Csync = librosa.util.sync(C, btz, aggregate=np.median)
 
         self.tempo = tempo
+        self.beat_frames = btz
 
         # For alignment purposes, we'll need the timing of the beats
         # we fix_frames to include non-beat frames 0 and C.shape[1] (final frame)
@@ -416,11 +1774,14 @@ class InfiniteJukebox(object):
         # width=3 prevents links within the same bar
         # mode='affinity' here implements S_rep (after Eq. 8)
         R = librosa.segment.recurrence_matrix(Csync, width=3, mode='affinity',
-                                              sym=True)
+                                              sym=True, sparse=self._sparse_eigen)
 
         # Enhance diagonals with a median filter (Equation 2)
-        df = librosa.segment.timelag_filter(scipy.ndimage.median_filter)
-        Rf = df(R, size=(1, 7))
+        if self._sparse_eigen:
+            Rf = timelag_median_filter(R, size=7)
+        else:
+            df = librosa.segment.timelag_filter(scipy.ndimage.median_filter)
+            Rf = df(R, size=(1, 7))
 
 
         ###################################################################
@@ -430,21 +1791,27 @@ class InfiniteJukebox(object):
         #
         # Here, we take :math:`\sigma` to be the median distance between successive beats.
         #
-        mfcc = librosa.feature.mfcc(y=y, sr=sr)
         Msync = librosa.util.sync(mfcc, btz)
 
         path_distance = np.sum(np.diff(Msync, axis=1)**2, axis=0)
         sigma = np.median(path_distance)
         path_sim = np.exp(-path_distance / sigma)
 
-        R_path = np.diag(path_sim, k=1) + np.diag(path_sim, k=-1)
+        if self._sparse_eigen:
+            R_path = scipy.sparse.diags([path_sim, path_sim], [1, -1], format='csr')
+        else:
+            R_path = np.diag(path_sim, k=1) + np.diag(path_sim, k=-1)
 
 
         ##########################################################
         # And compute the balanced combination (Equations 6, 7, 9)
 
-        deg_path = np.sum(R_path, axis=1)
-        deg_rec = np.sum(Rf, axis=1)
+        if self._sparse_eigen:
+            deg_path = np.asarray(R_path.sum(axis=1)).ravel()
+            deg_rec = np.asarray(Rf.sum(axis=1)).ravel()
+        else:
+            deg_path = np.sum(R_path, axis=1)
+            deg_rec = np.sum(Rf, axis=1)
 
         mu = deg_path.dot(deg_path + deg_rec) / np.sum((deg_path + deg_rec)**2)
 
@@ -455,8 +1822,13 @@ class InfiniteJukebox(object):
         L = scipy.sparse.csgraph.laplacian(A, normed=True)
 
 
+        stage_start = self.__record_timing('recurrence matrix', stage_start)
+
         # and its spectral decomposition
-        _, evecs = scipy.linalg.eigh(L)
+        if self._sparse_eigen:
+            evecs = laplacian_eigenvectors(L, self.__eigenvector_count())
+        else:
+            _, evecs = scipy.linalg.eigh(L)
 
 
         # We can clean this up further with a median filter.
@@ -465,18 +1837,15 @@ class InfiniteJukebox(object):
 
         self.evecs = evecs #save intermediate step for caching
 
+        stage_start = self.__record_timing('eigen decomposition', stage_start)
+
         # Cluster beats
         seg_ids, self.clusters = self.__compute_cluster(self.evecs, self.clusters, self._use_v1)
 
-        # Get the amplitudes and beat-align them
-        self.__report_progress( .6, "getting amplitudes")
-
-        # newer versions of librosa have renamed the rmse function
+        stage_start = self.__record_timing('clustering', stage_start)
 
-        if hasattr(librosa.feature,'rms'):
-            amplitudes = librosa.feature.rms(y=y)
-        else:
-            amplitudes = librosa.feature.rmse(y=y)
+        # beat-align the amplitudes
+        self.__report_progress( .6, "getting amplitudes")
 
         ampSync = librosa.util.sync(amplitudes, btz)
 
@@ -554,10 +1923,16 @@ class InfiniteJukebox(object):
         self.__report_progress( .8, "computing final beat array and finding loops...")
 
         # assign final beat ids
-        for beat in beats:
-            beat['id'] = beats.index(beat)
+        for i, beat in enumerate(beats):
+            beat['id'] = i
             beat['quartile'] = beat['id'] // (len(beats) / 4.0)
 
+        # group the beats that can be jumped to, so that each beat's jump candidates
+        # are a lookup rather than a scan of the whole song
+
+        candidate_index = JumpCandidateIndex([b['cluster'] for b in beats], [b['is'] for b in beats],
+                                             [b['segment'] for b in beats], match_bar_position=False)
+
         # compute a coherent 'next' beat to play. This is always just the next ordinal beat
         # unless we're at the end of the song. Then it gets a little trickier.
 
@@ -583,12 +1958,8 @@ class InfiniteJukebox(object):
             #
             # THAT collection of beats contains our jump candidates
 
-            jump_candidates = [bx['id'] for bx in beats[:beat['id']] if # only consider beats that are earlier
-                               (bx['cluster'] == beats[beat['next']]['cluster']) and
-                               (bx['is'] == beats[beat['next']]['is']) and
-                               #(bx['id'] % 4 == beats[beat['next']]['id'] % 4) and # removed as was limiting loop points
-                               (bx['segment'] != beat['segment']) and
-                               (bx['id'] != beat['next'])]
+            # only consider beats that are earlier. The bar position isn't matched, as it was limiting loop points
+            jump_candidates = candidate_index.candidates(beat['id'], beat['next'], before=beat['id'])
 
             if jump_candidates:
                 beat['jump_candidates'] = jump_candidates
@@ -641,9 +2012,11 @@ class InfiniteJukebox(object):
         # save off the beats array and play_vector. Signal
         # the play_ready event (if it's been set)
 
-        self.beats = beats
+        self.beats = BeatTable.from_dicts(beats, self.raw_audio)
         self.play_vector = play_vector
 
+        self.__record_timing('beat array', stage_start)
+
         self.__report_progress(1.0, "finished processing")
 
         if self.play_ready:
@@ -651,6 +2024,40 @@ class InfiniteJukebox(object):
 
         self.time_elapsed = time.time() - start
 
+    @classmethod
+    def analysis_cache_key(cls, cache, content_hash, **kwargs):
+
+        """ The key of the entry in an AnalysisCache that a jukebox constructed with these
+            arguments reads and stores. It lets a caller look the analysis up without
+            constructing a jukebox.
+
+            Args:
+
+                       cache: the AnalysisCache
+                content_hash: the AnalysisCache.content_hash() of the audio
+                      kwargs: the keyword arguments the jukebox is (or would be)
+                              constructed with. Those that don't change the analysis
+                              are ignored.
+        """
+
+        return cache.key(content_hash, **cls.analysis_params(**kwargs))
+
+    @staticmethod
+    def analysis_params(clusters=0, max_clusters=48, use_v1=False, start_beat=1, analysis_sr=None,
+                        silhouette_sample=None, fast_kmeans=False, **ignored):
+
+        """ The analysis parameters an AnalysisCache entry is keyed by, besides the
+            audio itself. See the constructor for what they mean. Any other constructor
+            arguments are ignored.
+        """
+
+        # the CLI, Web UI and Loopatron copies of this module analyse songs a little
+        # differently, so their entries must never be mixed up
+
+        return {'analysis': 'loopatron', 'clusters': clusters, 'max_clusters': max_clusters,
+                'use_v1': use_v1, 'start_beat': start_beat, 'analysis_sr': analysis_sr,
+                'silhouette_sample': silhouette_sample, 'fast_kmeans': fast_kmeans}
+
     def __report_progress(self, pct_done, message):
 
         """ If a reporting callback was passed, call it in order
@@ -659,6 +2066,26 @@ class InfiniteJukebox(object):
         if self.__progress_callback:
             self.__progress_callback(pct_done, message, self.filepath)
 
+    def timing_report(self):
+
+        """ Returns a printable report of how long each processing stage took. """
+
+        lines = ["%20s: %6.2fs" % (stage, seconds) for stage, seconds in self.timings.items()]
+        lines.append("%20s: %6.2fs" % ('total', sum(self.timings.values())))
+
+        return "\n".join(lines)
+
+    def __record_timing(self, stage, stage_start):
+
+        """ Records how long a processing stage took and returns the start
+            time for the next stage.
+        """
+
+        now = time.time()
+        self.timings[stage] = now - stage_start
+
+        return now
+
     def __compute_cluster(self, evecs, clusters, use_v1 = False):
 
         # cumulative normalization is needed for symmetric normalize laplacian eigenvectors
@@ -684,14 +2111,20 @@ class InfiniteJukebox(object):
 
             self.__report_progress(.51, "using %d clusters" % clusters)
 
+            # evecs only has as many columns as were computed (see sparse_eigen)
+            clusters = min(clusters, evecs.shape[1])
+
             X = evecs[:, :clusters] / Cnorm[:, clusters - 1:clusters]
 
             while (np.any(np.isnan(X))) and (not np.all(np.isfinite(X))): # if input is invalid, increment until a valid input is calculated
                 clusters += 1
                 X = evecs[:, :clusters] / Cnorm[:, clusters - 1:clusters]
 
-            seg_ids = sklearn.cluster.KMeans(n_clusters=clusters, max_iter=1000,
-                                             random_state=0, n_init=1000, n_jobs=-1).fit_predict(X)
+            if self._fast_kmeans:
+                seg_ids, _, _ = adaptive_kmeans(X, clusters, max_init=1000, patience=100, max_iter=1000)
+            else:
+                seg_ids = sklearn.cluster.KMeans(n_clusters=clusters, max_iter=1000,
+                                                 random_state=0, n_init=1000, n_jobs=-1).fit_predict(X)
 
         return seg_ids, clusters
 
@@ -756,73 +2189,158 @@ class InfiniteJukebox(object):
         # we need at least 3 clusters for any song and shouldn't need to calculate more than
         # 48 clusters for even a really complicated peice of music.
 
-        for n_clusters in range(self.__max_clusters, 2, -1):
+        candidates = []
 
-            self.__report_progress(.51, "Testing a cluster value of %d..." % n_clusters)
+        for n_clusters in range(self.__max_clusters, 2, -1):
 
             # compute a matrix of the Eigen-vectors / their normalized values
             X = evecs[:, :n_clusters] / Cnorm[:, n_clusters-1:n_clusters]
 
             if (not np.any(np.isnan(X))) and (np.all(np.isfinite(X))): # ensure input is valid
+                candidates.append((n_clusters, X))
+
+        # a long track's candidates can be scored from a sample of its beats. See
+        # SilhouetteSweep.
+
+        silhouettes = None
+
+        if self._silhouette_sample is not None and evecs.shape[0] > self._silhouette_sample:
+            silhouettes = SilhouetteSweep(evecs, Cnorm, self._silhouette_sample)
+
+        # create the candidate clusters and fit them. The results come back in the same
+        # order as the candidates, so the winner is picked exactly as if they had been
+        # fit one after another.
+
+        for n_clusters, (cluster_labels, silhouette_avg) in self.__sweep_cluster_candidates(candidates, silhouettes):
+
+            self.__report_progress(.51, "Tested a cluster value of %d..." % n_clusters)
+
+            # get some key statistics, including how well each beat in the cluster resemble
+            # each other (the silhouette average), the ratio of segments to clusters, and the
+            # length of the smallest segment in this cluster configuration
+
+            ratio, min_segment_len = self.__segment_stats_from_labels(cluster_labels.tolist())
+
+            # We need to grade each cluster according to how likely it is to produce a good
+            # result. There are a few factors to look at.
+            #
+            # First, we can look at how similar the beats in each cluster (on average) are for
+            # this candidate cluster size. This is known as the silhouette score. It ranges
+            # from -1 (very bad) to 1 (very good).
+            #
+            # Another thing we can look at is the ratio of clusters to segments. Higher ratios
+            # are preferred because they afford each beat in a cluster the opportunity to jump
+            # around to meaningful places in the song.
+            #
+            # All other things being equal, we prefer a higher cluster count to a lower one
+            # because it will tend to make the jumps more selective -- and therefore higher
+            # quality.
+            #
+            # Lastly, if we see that we have segments equal to just one beat, that might be
+            # a sign of overfitting. We call these one beat segments 'orphans'. Some songs,
+            # however, will have orphans no matter what cluster count you use. So, we don't
+            # want to throw out a cluster count just because it has orphans. Instead, we
+            # just de-rate its fitness score. If most of the cluster candidates have orphans
+            # then this won't matter in the overall scheme because everyone will be de-rated
+            # by the same scaler.
+            #
+            # Putting this all together, we muliply the cluster count * the average
+            # silhouette score for the clusters in this candidate * the ratio of clusters to
+            # segments. Then we scale (or de-rate) the fitness score by whether or not is has
+            # orphans in it.
+
+            orphan_scaler = .8 if min_segment_len == 1 else 1
+
+            cluster_score = n_clusters * silhouette_avg * ratio * orphan_scaler
+            #cluster_score = ((n_clusters/48.0) * silhouette_avg * (ratio/10.0)) * orphan_scaler
+
+            # if this cluster count has a score that's better than the best score so far, store
+            # it for later.
 
-                # create the candidate clusters and fit them
-                clusterer = sklearn.cluster.KMeans(n_clusters=n_clusters, max_iter=300,
-                                                   random_state=0, n_init=20, n_jobs=-1) # multiprocess
-
-                cluster_labels = clusterer.fit_predict(X)
-
-                # get some key statistics, including how well each beat in the cluster resemble
-                # each other (the silhouette average), the ratio of segments to clusters, and the
-                # length of the smallest segment in this cluster configuration
-
-                silhouette_avg = sklearn.metrics.silhouette_score(X, cluster_labels)
-
-                ratio, min_segment_len = self.__segment_stats_from_labels(cluster_labels.tolist())
-
-                # We need to grade each cluster according to how likely it is to produce a good
-                # result. There are a few factors to look at.
-                #
-                # First, we can look at how similar the beats in each cluster (on average) are for
-                # this candidate cluster size. This is known as the silhouette score. It ranges
-                # from -1 (very bad) to 1 (very good).
-                #
-                # Another thing we can look at is the ratio of clusters to segments. Higher ratios
-                # are preferred because they afford each beat in a cluster the opportunity to jump
-                # around to meaningful places in the song.
-                #
-                # All other things being equal, we prefer a higher cluster count to a lower one
-                # because it will tend to make the jumps more selective -- and therefore higher
-                # quality.
-                #
-                # Lastly, if we see that we have segments equal to just one beat, that might be
-                # a sign of overfitting. We call these one beat segments 'orphans'. Some songs,
-                # however, will have orphans no matter what cluster count you use. So, we don't
-                # want to throw out a cluster count just because it has orphans. Instead, we
-                # just de-rate its fitness score. If most of the cluster candidates have orphans
-                # then this won't matter in the overall scheme because everyone will be de-rated
-                # by the same scaler.
-                #
-                # Putting this all together, we muliply the cluster count * the average
-                # silhouette score for the clusters in this candidate * the ratio of clusters to
-                # segments. Then we scale (or de-rate) the fitness score by whether or not is has
-                # orphans in it.
-
-                orphan_scaler = .8 if min_segment_len == 1 else 1
-
-                cluster_score = n_clusters * silhouette_avg * ratio * orphan_scaler
-                #cluster_score = ((n_clusters/48.0) * silhouette_avg * (ratio/10.0)) * orphan_scaler
-
-                # if this cluster count has a score that's better than the best score so far, store
-                # it for later.
-
-                if cluster_score >= best_cluster_score:
-                    best_cluster_score = cluster_score
-                    best_cluster_size = n_clusters
-                    best_labels = cluster_labels
+            if cluster_score >= best_cluster_score:
+                best_cluster_score = cluster_score
+                best_cluster_size = n_clusters
+                best_labels = cluster_labels
+
+        if silhouettes is not None:
+            self.__add_log("silhouettes estimated from %d of %d beats. largest standard error: %.4f" %
+                           (self._silhouette_sample, evecs.shape[0], max(silhouettes.standard_errors.values())))
 
         # return the best results
         return (best_cluster_size, best_labels)
 
+    def __eigenvector_count(self):
+
+        """ The number of Laplacian eigenvectors the clustering will look at: enough
+            for the largest cluster count that either auto clustering scheme tries, or
+            for the cluster count that was asked for.
+        """
+
+        count = max(self.__max_clusters, self.clusters)
+
+        if self._use_v1:
+            count = max(count, 62)
+
+        return count
+
+    def __sweep_cluster_candidates(self, candidates, silhouettes=None):
+
+        """ Fits and scores every candidate cluster count with fit_cluster_candidate(),
+            spreading the work over a pool of processes. Yields a tuple of
+            (n_clusters, (cluster labels, silhouette score)) for each candidate, in the
+            order the candidates were given.
+
+            Each candidate is seeded with random_state=0 on its own, so the results don't
+            depend on which process fit them.
+
+            If a SilhouetteSweep is passed, the processes only fit the candidates, and it
+            scores them here. It reuses its work from one candidate to the next, so it
+            must see them all.
+
+            With fast_kmeans, the candidates are fit in runs of WARM_START_RUN with
+            fit_cluster_run(), and it's the runs that are spread over the processes.
+        """
+
+        fit = fit_cluster_candidate if silhouettes is None else fit_cluster_labels
+
+        def fitted(results):
+            # each run's result is a list, with one entry for each of its candidates
+            if self._fast_kmeans:
+                return itertools.chain.from_iterable(results)
+
+            return results
+
+        def scored(n_clusters, result):
+            if silhouettes is None:
+                return result
+
+            return result, silhouettes.score(n_clusters, result)
+
+        n_jobs = self._n_jobs or multiprocessing.cpu_count()
+
+        if self._fast_kmeans:
+            fit = fit_cluster_run
+            tasks = [(candidates[i:i + WARM_START_RUN], silhouettes is None)
+                     for i in range(0, len(candidates), WARM_START_RUN)]
+
+            n_jobs = min(n_jobs, len(tasks))
+        else:
+            n_jobs = min(n_jobs, len(candidates))
+
+            # with nothing to spread across processes, let KMeans use the cores instead
+            kmeans_jobs = -1 if n_jobs <= 1 else 1
+
+            tasks = [(n_clusters, X, kmeans_jobs) for n_clusters, X in candidates]
+
+        if n_jobs <= 1:
+            for candidate, result in zip(candidates, fitted(map(fit, tasks))):
+                yield candidate[0], scored(candidate[0], result)
+            return
+
+        with multiprocessing.Pool(processes=n_jobs) as pool:
+            for candidate, result in zip(candidates, fitted(pool.imap(fit, tasks))):
+                yield candidate[0], scored(candidate[0], result)
+
     @staticmethod
     def __segment_count_from_labels(labels):
 
@@ -915,9 +2433,15 @@ class InfiniteJukebox(object):
             X = evecs[:, :ki] / Cnorm[:, ki-1:ki]
 
             if (not np.any(np.isnan(X))) and (np.all(np.isfinite(X))): # ensure input is valid
-                # cluster with candidate ki
-                labels = sklearn.cluster.KMeans(n_clusters=ki, max_iter=1000,
-                                                random_state=0, n_init=20, n_jobs=-1).fit_predict(X)
+                # cluster with candidate ki. fast_kmeans starts it from the last candidate.
+                if self._fast_kmeans:
+                    init = None if len(self._clusters_list) == 0 else \
+                           seed_centers(X, self._clusters_list[-1]['labels'], ki)
+
+                    labels, _, _ = adaptive_kmeans(X, ki, init=init, max_iter=1000)
+                else:
+                    labels = sklearn.cluster.KMeans(n_clusters=ki, max_iter=1000,
+                                                    random_state=0, n_init=20, n_jobs=-1).fit_predict(X)
 
                 entry = {'clusters':ki, 'labels':labels}
 
@@ -957,8 +2481,18 @@ class InfiniteJukebox(object):
 
         # compute a very high fidelity set of clusters using our selected cluster size.
         X = evecs[:, :final_cluster_size] / Cnorm[:, final_cluster_size-1:final_cluster_size]
-        labels = sklearn.cluster.KMeans(n_clusters=final_cluster_size, max_iter=1000,
-                                        random_state=0, n_init=1000, n_jobs=-1).fit_predict(X)
+
+        if self._fast_kmeans:
+            # start from the sweep's clustering of this size, and give the restarts plenty
+            # of rope before deciding they've stopped finding anything better
+
+            sweep_labels = next(cl['labels'] for cl in self._clusters_list if cl['clusters'] == final_cluster_size)
+
+            labels, _, _ = adaptive_kmeans(X, final_cluster_size, seed_centers(X, sweep_labels, final_cluster_size),
+                                           max_init=1000, patience=100, max_iter=1000)
+        else:
+            labels = sklearn.cluster.KMeans(n_clusters=final_cluster_size, max_iter=1000,
+                                            random_state=0, n_init=1000, n_jobs=-1).fit_predict(X)
 
         # labels = next(c['labels'] for c in self._clusters_list if c['clusters'] == final_cluster_size)
 
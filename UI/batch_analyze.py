@@ -0,0 +1,195 @@
+"""batch_analyze.py - analyses a library of songs into the Loopatron cache, without the GUI.
+
+Songs are analysed over a pool of worker processes with the settings in Loopatron.json,
+and stored in the analysis cache exactly as if they had been opened (and cached) in
+Loopatron. Every finished song is recorded in a manifest, so an interrupted run picks up
+where it stopped when it's run again.
+
+    python batch_analyze.py ~/Music -workers 8
+
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+from utils import get_config
+
+# Remixatron (and with it librosa, scipy and sklearn) is only imported by the workers,
+# so listing the songs, --help and a run with nothing left to do start quickly
+
+AUDIO_EXTENSIONS = ('.aac', '.aiff', '.flac', '.m4a', '.mp3', '.ogg', '.opus', '.wav', '.wma')
+
+def process_args():
+
+    """ Process the command line args """
+
+    description = """Analyses songs into the Loopatron cache over a pool of worker processes, using the settings in Loopatron.json. Finished songs are recorded in a manifest, so an interrupted run resumes where it stopped."""
+
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument("sources", type=str, nargs='+',
+                        help="audio files, directories to search for audio files, or text files listing one audio file per line")
+
+    parser.add_argument("-workers", metavar='N', type=int, default=multiprocessing.cpu_count(),
+                        help="the number of songs to analyse at once. Each worker needs the memory to analyse one song. Default: the number of cores")
+
+    parser.add_argument("-manifest", metavar='path', type=str, default='batch_manifest.jsonl',
+                        help="where to record finished songs. Default: batch_manifest.jsonl")
+
+    parser.add_argument("-retry_failed", action='store_true',
+                        help="analyse the songs that failed in an earlier run again")
+
+    return parser.parse_args()
+
+def find_songs(sources):
+
+    """ Returns the audio files named by sources, in order and without duplicates.
+
+        Args:
+
+            sources: audio files, directories (which are searched recursively for
+                     files with one of the AUDIO_EXTENSIONS) or text files that list
+                     one audio file per line
+    """
+
+    songs = []
+
+    for source in sources:
+        if os.path.isdir(source):
+            for root, dirs, files in os.walk(source):
+                dirs.sort()
+                songs.extend(os.path.join(root, f) for f in sorted(files)
+                             if f.lower().endswith(AUDIO_EXTENSIONS))
+
+        elif source.lower().endswith('.txt'):
+            with open(source) as f:
+                songs.extend(line.strip() for line in f if line.strip())
+
+        else:
+            songs.append(source)
+
+    return list(dict.fromkeys(os.path.abspath(song) for song in songs))
+
+def read_manifest(path):
+
+    """ Reads a manifest written by record(), and returns a dictionary of the last
+        entry for each song. A line that was only partly written when a run was
+        interrupted is ignored.
+    """
+
+    entries = {}
+
+    if not os.path.exists(path):
+        return entries
+
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+
+            entries[entry['path']] = entry
+
+    return entries
+
+def record(manifest, entry):
+
+    """ Appends an entry to the open manifest and makes sure it's on disk, so that
+        it survives the run being killed.
+    """
+
+    manifest.write(json.dumps(entry) + '\n')
+    manifest.flush()
+    os.fsync(manifest.fileno())
+
+def init_worker():
+
+    """ Leaves Ctrl-C to the parent process, which stops the pool, and warms up the
+        analysis code once for all the songs the worker will analyse.
+    """
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    from Remixatron import warm_up
+
+    warm_up()
+
+def analyse(path):
+
+    """ Analyses one song in a worker process and stores it in the cache, unless
+        it's cached already. Returns its manifest entry.
+    """
+
+    from Remixatron import InfiniteJukebox
+
+    config = get_config()
+    start = time.time()
+
+    try:
+        # each worker analyses a single song with a single process. The pool already
+        # keeps every core busy.
+
+        jukebox = InfiniteJukebox(filepath=path, start_beat=0, use_cache=True, clusters=config['clusters'],
+                                  max_clusters=config['maxClusters'], do_async=False, use_v1=config['useV1'],
+                                  n_jobs=1, sparse_eigen=config['sparseEigen'],
+                                  analysis_sr=config['analysisSampleRate'] or None,
+                                  silhouette_sample=config['silhouetteSampleSize'] or None,
+                                  fast_kmeans=config['fastKMeans'])
+
+        # a song loaded from the cache has nothing new to store
+
+        if jukebox.time_elapsed > 0:
+            jukebox.save_cache(config['cacheEvecs'], config['cacheAudio'])
+
+        return {'path': path, 'status': 'done', 'seconds': round(time.time() - start, 2)}
+
+    except Exception as e:
+        return {'path': path, 'status': 'failed', 'error': repr(e), 'seconds': round(time.time() - start, 2)}
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+
+    args = process_args()
+
+    songs = find_songs(args.sources)
+    finished = read_manifest(args.manifest)
+
+    skip = ('done', 'failed') if not args.retry_failed else ('done',)
+    pending = [song for song in songs if song not in finished or finished[song]['status'] not in skip]
+
+    print("%d songs, %d already analysed, %d to go" % (len(songs), len(songs) - len(pending), len(pending)))
+
+    if len(pending) == 0:
+        sys.exit(0)
+
+    pool = multiprocessing.Pool(processes=max(args.workers, 1), initializer=init_worker)
+
+    failures = 0
+
+    try:
+        with open(args.manifest, 'a') as manifest:
+            for i, entry in enumerate(pool.imap_unordered(analyse, pending, chunksize=1)):
+                record(manifest, entry)
+
+                if entry['status'] == 'failed':
+                    failures += 1
+
+                print("[%d/%d] %s %s (%.1fs)" % (i + 1, len(pending), entry['status'], entry['path'], entry['seconds']))
+
+        pool.close()
+
+    except KeyboardInterrupt:
+        print("interrupted. Run again to pick up where this run stopped.")
+        pool.terminate()
+        sys.exit(1)
+
+    finally:
+        pool.join()
+
+    print("finished: %d analysed, %d failed" % (len(pending) - failures, failures))
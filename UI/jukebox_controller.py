@@ -1,13 +1,114 @@
+import collections
 import os
+import threading
 import time
 import numpy as np
 from pygame import mixer
 import pygame.locals
+from pygame.locals import *
 
 from utils import *
 
 SOUND_FINISHED = pygame.locals.USEREVENT + 1
-import librosa
+
+# the play path is streamed to the mixer in blocks of this many samples (about 0.1s)
+BLOCK_FRAMES = 4096
+
+class PlaybackStream:
+
+    """ Streams the play path to a mixer channel a block at a time, instead of rendering
+        all of it into a buffer as long as the song first.
+
+        A thread keeps one block queued behind the one playing. Blocks are filled from
+        the beats' buffers (which are views of raw_audio), and at the end of each beat
+        next_beat_id is asked where to go, so changed loop points take effect at the next
+        beat boundary that hasn't been streamed yet, within a block or two of playback.
+
+        Each block is filled in one scratch array and then copied into a new Sound, since
+        mixer.Sound(buffer=...) copies the samples. So the scratch array can be refilled
+        as soon as its Sound is made, even while that Sound is still playing.
+    """
+
+    def __init__(self, channel, jukebox, next_beat_id, block_frames=BLOCK_FRAMES):
+        self.channel = channel
+        self.jukebox = jukebox
+        self.next_beat_id = next_beat_id
+
+        self.block = np.zeros((block_frames,) + jukebox.raw_audio.shape[1:], dtype=jukebox.raw_audio.dtype)
+
+        # where the next block starts: a beat, and how far into it
+        self.beat_id = 0
+        self.offset = 0
+
+        # the beats that have been streamed after the one the stream was started on, in
+        # the order they play. JukeboxController.playback_timer() follows them.
+        self.upcoming = collections.deque()
+
+        self.active = False
+
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+
+        self.thread = threading.Thread(target=self.feed, args=(block_frames / float(jukebox.sample_rate),), daemon=True)
+        self.thread.start()
+
+    def seek(self, beat_id, paused=False):
+        ## (Re)start the stream at the start of a beat
+        with self.lock:
+            self.channel.stop()
+
+            self.beat_id = beat_id
+            self.offset = 0
+            self.upcoming.clear()
+
+            self.channel.queue(self.next_block())
+            if paused:
+                self.channel.pause()
+
+            self.active = True
+
+    def stop(self):
+        ## Stop streaming until the next seek()
+        with self.lock:
+            self.active = False
+            self.channel.stop()
+
+    def close(self):
+        self.stop()
+        self.closed.set()
+        self.thread.join()
+
+    def feed(self, block_seconds):
+        ## Keep a block queued behind the one playing. Checking a few times a block
+        ## leaves plenty of time to fill the next one.
+        while not self.closed.wait(block_seconds / 4):
+            with self.lock:
+                if self.active and self.channel.get_queue() is None:
+                    self.channel.queue(self.next_block())
+
+    def next_block(self):
+        block = self.block
+
+        filled = 0
+        while filled < len(block):
+            buffer = self.jukebox.beats[self.beat_id]['buffer']
+
+            count = min(len(block) - filled, len(buffer) - self.offset)
+            block[filled:filled + count] = buffer[self.offset:self.offset + count]
+
+            filled += count
+            self.offset += count
+
+            if self.offset >= len(buffer):
+                self.beat_id = self.next_beat_id(self.beat_id)
+                self.offset = 0
+                self.upcoming.append(self.beat_id)
+
+        return mixer.Sound(buffer=block)
+
+    def next_played_beat(self):
+        ## The next beat that was streamed, or None if the stream hasn't got that far
+        return self.upcoming.popleft() if len(self.upcoming) > 0 else None
 
 class JukeboxController:
 
@@ -17,11 +118,19 @@ class JukeboxController:
 
         self.volume = 1.0
 
+        self.stream = None
+
+        # (beats, (window size, highlighted end beat), surface) of the last music slider surface drawn
+        self.slider_cache = None
+
         self.initialize_controller(jukebox)
 
     def initialize_controller(self, jukebox):
         self.jukebox = jukebox
 
+        if self.stream:
+            self.stream.close()
+
         # mixer.init(frequency=jukebox.sample_rate)
         self.channel = mixer.Channel(0)
         self.channel.set_volume(self.volume)
@@ -58,58 +167,29 @@ class JukeboxController:
         self.playback_time = jukebox.beats[0]['start']
         self.last_time = 0
 
-        self.create_and_play_playback_buffer()
-
-    def create_and_play_playback_buffer(self, max_buffer = None):
-        ## create buffer of audio path (because playing chunks at a time causes choppiness)
-        if not max_buffer:
-            max_buffer = len(self.jukebox.raw_audio)
-
-        self.channel.stop()
-
-        if len(self.jukebox.raw_audio.shape) == 1:
-            playback_buffer = np.zeros([max_buffer], dtype='int16')
-        else:
-            playback_buffer = np.zeros([max_buffer, 2], dtype='int16')
-
-        current_pos = 0
-        current_beat_id = self.beat_id
-        current_buffer = self.jukebox.beats[current_beat_id]['buffer']
-
-        while (current_pos + len(current_buffer)) < max_buffer:
-
-            # Assign buffer from beat
-            if len(playback_buffer.shape) == 1:
-                playback_buffer[current_pos:current_pos + len(current_buffer)] = current_buffer
-            else:
-                playback_buffer[current_pos:current_pos + len(current_buffer)] = current_buffer
-
-            current_pos += len(current_buffer)
-
-            # If on selected end beat, go to selected jump beat, otherwise increment by 1
-            if current_beat_id == self.selected_end_beat_id:
-                current_beat_id = self.selected_jump_beat_id
-            else:
-                current_beat_id += 1
-                if current_beat_id >= len(self.jukebox.beats):  # if no beats left (i.e. song finished)
-                    current_beat_id = self.selected_start_beat_id if self.trim_start else 0
+        self.stream = PlaybackStream(self.channel, jukebox, self.next_beat_id)
+        self.restart_playback()
 
-            current_buffer = self.jukebox.beats[current_beat_id]['buffer']
+    def next_beat_id(self, beat_id):
+        # If on selected end beat, go to selected jump beat, otherwise increment by 1
+        if beat_id == self.selected_end_beat_id:
+            return self.selected_jump_beat_id
 
+        beat_id += 1
+        if beat_id >= len(self.jukebox.beats):  # if no beats left (i.e. song finished)
+            beat_id = self.selected_start_beat_id if self.trim_start else 0
 
-        if len(playback_buffer.shape) == 1:
-            playback_buffer = playback_buffer[0:current_pos - len(current_buffer)]
-        else:
-            playback_buffer = playback_buffer[0:current_pos - len(current_buffer), :]
+        return beat_id
 
-        snd = mixer.Sound(buffer=playback_buffer)
-        self.channel.queue(snd)
+    def restart_playback(self):
+        ## Start streaming the audio path from the current beat. Changing the loop points doesn't need this; the stream
+        ## takes them up at the next beat
+        self.stream.seek(self.beat_id, paused=self.is_paused)
         self.playback_time = self.jukebox.beats[self.beat_id]['start']
-        if self.is_paused:
-            self.channel.pause()
 
     def playback_timer(self):
-        ## Because audio path is premade, this function will keep track of the current beat based on time (Note: breakpoints breaks this) so slider UI can update
+        ## Keep track of the current beat based on time (Note: breakpoints breaks this) so slider UI can update. The beats
+        ## follow each other in the order they were streamed
         current_time = time.time()
         if not self.is_paused:
             self.playback_time += current_time - self.last_time
@@ -119,13 +199,8 @@ class JukeboxController:
             # If current time is past the current beat
             if self.playback_time > current_beat_end_time:
 
-                # If on selected end beat, go to selected jump beat, otherwise increment by 1
-                if self.beat_id == self.selected_end_beat_id:
-                    self.beat_id = self.selected_jump_beat_id
-                else:
-                    self.beat_id += 1
-                    if self.beat_id >= len(self.jukebox.beats): # if no beats left (i.e. song finished
-                        self.beat_id = self.selected_start_beat_id if self.trim_start else 0
+                next_beat_id = self.stream.next_played_beat()
+                self.beat_id = next_beat_id if next_beat_id is not None else self.next_beat_id(self.beat_id)
 
                 self.playback_time = (self.playback_time - current_beat_end_time) + self.jukebox.beats[self.beat_id]['start']
 
@@ -133,7 +208,7 @@ class JukeboxController:
 
     def recluster(self):
         if (self.jukebox.evecs.size > 0) and (self.selected_num_clusters != self.jukebox.clusters):
-            self.channel.stop()
+            self.stream.stop()
             self.is_paused = True
             self.jukebox.recompute_beat_array(self.selected_num_clusters)
 
@@ -222,9 +297,9 @@ class JukeboxController:
         segment_chars = '#-'
         cluster_chars = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz1234567890-=,.<>/?;:!@#$%^&*()_+'
 
-        for b in self.jukebox.beats:
-            segment_map += segment_chars[b['segment'] % 2]
-            cluster_map += cluster_chars[b['cluster']]
+        for segment, cluster in zip(self.jukebox.beats.columns['segment'].tolist(), self.jukebox.beats.columns['cluster'].tolist()):
+            segment_map += segment_chars[segment % 2]
+            cluster_map += cluster_chars[cluster]
 
         verbose_info += "\n" + segment_map + "\n\n"
 
@@ -315,7 +390,7 @@ class JukeboxController:
         draw_text("[C]ache", self.font, Color.WHITE.value, self.window, x, y)
 
     def select_file(self):
-        self.channel.stop()  # Stop before opening prompt otherwise playback will speed up
+        self.stream.stop()  # Stop before opening prompt otherwise playback will speed up
         self.is_paused = True
         return prompt_file(select_multiple=True)
 
@@ -373,7 +448,7 @@ class JukeboxController:
                 self.export_success = run_lac(filepath, self.jukebox.sample_rate, self.amplify_ratio)
 
             self.export_timestamp = get_timestamp()
-            self.create_and_play_playback_buffer()
+            self.restart_playback()
 
     def export_button(self, click, mx, my):
         if (self.selected_jump_beat_id <= self.selected_end_beat_id) and ((not self.trim_start) or (self.selected_start_beat_id <= self.selected_jump_beat_id)):
@@ -428,7 +503,6 @@ class JukeboxController:
             self.channel.pause()
             self.is_paused = True
         else:
-            self.create_and_play_playback_buffer()
             self.channel.unpause()
             self.is_paused = False
 
@@ -458,7 +532,7 @@ class JukeboxController:
     def set_beat_to_last_selected(self):
         if (self.last_selected_beat_id >= 0):
             self.beat_id = self.last_selected_beat_id
-            self.create_and_play_playback_buffer()
+            self.restart_playback()
 
     def back_button(self, click, mx, my):
         ## Rewind to where cursor was last placed
@@ -489,7 +563,6 @@ class JukeboxController:
 
         if len(jump_beats):
             self.selected_jump_beat_id = jump_beats[self.selected_jump_beat_num]
-            self.create_and_play_playback_buffer()
 
     def jump_buttons(self, click, mx, my):
         x = self.window.get_width() / 2 + BUTTON_WIDTH
@@ -593,6 +666,69 @@ class JukeboxController:
 
         pygame.draw.rect(self.window, Color.GRAY.value, [x_line - SCROLL_WIDTH / 2, self.window.get_height() - BUTTON_WIDTH - 10, SCROLL_WIDTH*2, BUTTON_WIDTH])
 
+    def slider_surface(self, highlight_cluster):
+        ## The parts of the music slider that are the same from frame to frame: the bar, segment borders and beats with jump
+        ## beats, and (if highlight_cluster) the beats in the same cluster as the selected end beat. They're drawn once onto a
+        ## transparent surface, and only drawn again when the beats (i.e. the clusters), the window size or the selected end
+        ## beat change
+        key = (self.window.get_size(), self.selected_end_beat_id if highlight_cluster else None)
+
+        if self.slider_cache is not None and self.slider_cache[0] is self.jukebox.beats and self.slider_cache[1] == key:
+            return self.slider_cache[2]
+
+        # the surface covers the slider from the top of the segment borders, 10 pixels above the bar
+        surface = pygame.Surface((self.window.get_width(), BAR_HEIGHT + 20), pygame.SRCALPHA)
+
+        pygame.draw.rect(surface, Color.GRAY.value, [BAR_X, 10, get_bar_width(self.window), BAR_HEIGHT])
+
+        # read the beats column by column rather than through a view per beat
+
+        columns = self.jukebox.beats.columns
+        jump_counts = self.jukebox.beats.jump_counts().tolist()
+        first_start_index = self.jukebox.beats[0]['start_index']
+        selected_end_beat = self.jukebox.beats[self.selected_end_beat_id]
+
+        current_segment = -1
+        for start_index, segment, cluster, jump_count in zip(columns['start_index'].tolist(),
+                                                             columns['segment'].tolist(),
+                                                             columns['cluster'].tolist(),
+                                                             jump_counts):
+            x_line = BAR_X + (float(start_index - first_start_index) /
+                              float(self.total_indices)) * get_bar_width(self.window)
+
+            ## Draw segment borders in white
+            if segment > current_segment:
+                current_segment = segment
+
+                pygame.draw.rect(surface, Color.WHITE.value,
+                                 [x_line - SEGMENT_LINE_WIDTH/2, 0, SEGMENT_LINE_WIDTH, BAR_HEIGHT + 20])
+
+            # Color current beat if it had a jump beat
+            if jump_count > 0:
+                pygame.draw.rect(surface, Color.LIGHT_BLUE.value,
+                                 [x_line - SEGMENT_LINE_WIDTH / 2, 10, SEGMENT_LINE_WIDTH, BAR_HEIGHT])
+
+            # Color beats in the same cluster as selected end beat if holding shift to guide manual jump beat selection
+            if highlight_cluster:
+                if (segment < selected_end_beat['segment']) and (cluster == selected_end_beat['cluster']):
+                    pygame.draw.rect(surface, Color.DARK_ORANGE.value,
+                                     [x_line - SEGMENT_LINE_WIDTH / 2, 10 + 3 * BAR_HEIGHT / 4, SEGMENT_LINE_WIDTH, BAR_HEIGHT / 4])
+
+        self.slider_cache = (self.jukebox.beats, key, surface)
+
+        return surface
+
+    def beat_at_index(self, index):
+        ## The id of the beat that the sample index falls in, or None. A binary search on the beats' start indices
+        columns = self.jukebox.beats.columns
+
+        i = int(np.searchsorted(columns['start_index'], index, side='right')) - 1
+
+        if i < 0 or index >= columns['stop_index'][i]:
+            return None
+
+        return int(columns['id'][i])
+
     def music_slider(self, click, mx, my, keys):
 
         music_slider_bar = pygame.Rect(BAR_X, self.window.get_height() - BUTTON_WIDTH - 20 - BAR_HEIGHT - 10, get_bar_width(self.window), BAR_HEIGHT)
@@ -610,61 +746,35 @@ class JukeboxController:
                         self.selected_jump_beat_num = 0
                         self.selected_jump_beat_id = 0
 
-        pygame.draw.rect(self.window, Color.GRAY.value, music_slider_bar)
+        beat_id = self.beat_at_index(scroll_index) if scroll_index >= 0 else None
 
-        current_segment = -1
-        for beat in self.jukebox.beats:
-            x_line = BAR_X + (float(beat['start_index'] - self.jukebox.beats[0]['start_index']) /
-                              float(self.total_indices)) * get_bar_width(self.window)
-
-            if scroll_index >= beat['start_index'] and scroll_index < beat['stop_index']: # find beat which index belongs to
-                ## If start indices doesn't match, i.e. the scroll bar was moved, set beat id to new beat (based on which controls)
-                # Left click controls play slider
-                # Right click controls end beat
-                # Shift right click controls jump beat
-                # Shift left click controls start
-
-                if click == (1, 0, 0):
-                    if (keys[pygame.K_LSHIFT] or keys[pygame.K_RSHIFT]) and self.trim_start:
-                        if self.selected_start_beat_id != beat['id']:
-                            self.selected_start_beat_id = beat['id']
-                    else:
-                        if self.beat_id != beat['id']:
-                            self.beat_id = beat['id']
-                            self.last_selected_beat_id = self.beat_id
-                            self.create_and_play_playback_buffer()
-                elif click == (0, 0, 1):
-                    if keys[pygame.K_LSHIFT] or keys[pygame.K_RSHIFT]:
-                        if self.selected_jump_beat_id_manual != beat['id']:
-                            self.selected_jump_beat_id_manual = beat['id']
-                    else:
-                        if self.selected_end_beat_id != beat['id']:
-                            self.selected_end_beat_id = beat['id']
-                            self.create_and_play_playback_buffer()
+        if beat_id is not None: # find beat which index belongs to
+            ## If start indices doesn't match, i.e. the scroll bar was moved, set beat id to new beat (based on which controls)
+            # Left click controls play slider
+            # Right click controls end beat
+            # Shift right click controls jump beat
+            # Shift left click controls start
 
-            ## Draw segment borders in white
-            if beat['segment'] > current_segment:
-                current_segment = beat['segment']
-
-                pygame.draw.rect(self.window, Color.WHITE.value,
-                                 [x_line - SEGMENT_LINE_WIDTH/2, self.window.get_height() - BUTTON_WIDTH - 20 - BAR_HEIGHT - 20, SEGMENT_LINE_WIDTH,
-                                  BAR_HEIGHT + 20])
-
-            # Color current beat if it had a jump beat
-            if len(beat['jump_candidates']) > 0:
-                pygame.draw.rect(self.window, Color.LIGHT_BLUE.value,
-                         [x_line - SEGMENT_LINE_WIDTH / 2,
-                          self.window.get_height() - BUTTON_WIDTH - 20 - BAR_HEIGHT - 10, SEGMENT_LINE_WIDTH,
-                          BAR_HEIGHT])
-
-            # Color beats in the same cluster as selected end beat if holding shift to guide manual jump beat selection
-            if keys[pygame.K_LSHIFT]:
-                if (beat['segment'] < self.jukebox.beats[self.selected_end_beat_id]['segment']) and (beat['cluster'] == self.jukebox.beats[self.selected_end_beat_id]['cluster']):
-                    x_jump_line = BAR_X + (float(beat['start_index'] - self.jukebox.beats[0]['start_index']) / float(self.total_indices)) * get_bar_width(self.window)
-                    pygame.draw.rect(self.window, Color.DARK_ORANGE.value , [x_jump_line - SEGMENT_LINE_WIDTH / 2,
-                                      self.window.get_height() - BUTTON_WIDTH - 20 - BAR_HEIGHT - 10 + 3 * BAR_HEIGHT / 4,
-                                      SEGMENT_LINE_WIDTH, BAR_HEIGHT / 4])
+            if click == (1, 0, 0):
+                if (keys[pygame.K_LSHIFT] or keys[pygame.K_RSHIFT]) and self.trim_start:
+                    if self.selected_start_beat_id != beat_id:
+                        self.selected_start_beat_id = beat_id
+                else:
+                    if self.beat_id != beat_id:
+                        self.beat_id = beat_id
+                        self.last_selected_beat_id = self.beat_id
+                        self.restart_playback()
+            elif click == (0, 0, 1):
+                if keys[pygame.K_LSHIFT] or keys[pygame.K_RSHIFT]:
+                    if self.selected_jump_beat_id_manual != beat_id:
+                        self.selected_jump_beat_id_manual = beat_id
+                else:
+                    if self.selected_end_beat_id != beat_id:
+                        self.selected_end_beat_id = beat_id
 
+        # the bar, segments and jump beats come from a cached surface. The selections and the scroll location are drawn
+        # over it every frame
+        self.window.blit(self.slider_surface(keys[pygame.K_LSHIFT]), (0, music_slider_bar.top - 10))
 
         end_beat = self.jukebox.beats[self.selected_end_beat_id]
 
@@ -746,6 +856,8 @@ class JukeboxController:
     ## Fixed audio playback
     # Tried a timer and different channels, still can be choppy
     # Pre-made buffer works, redid functionality so a buffer is made taking loop points into account, and timer updates UI accordingly
+    # Replaced the pre-made buffer with short blocks streamed by a thread, one queued behind the other, so changing loop points
+    # rebuilds nothing and takes effect at the next beat
 
     # TODO: Update status during loading (doesn't update, would have to use async, not sure affect on performance)
 
@@ -1,23 +1,19 @@
-import pygame
 import sys
-import tkinter
-import tkinter.filedialog
 from datetime import datetime
 import os
 import subprocess
 from pathlib import Path
 
-from pygame.locals import *
 from enum import Enum
-import soundfile as sf
 
-
-import xml.etree.ElementTree as ET
 import json
 import typing
 
 import ctypes
-from win10toast import ToastNotifier
+
+# pygame, tkinter, soundfile, win10toast and ElementTree are imported by the functions
+# that use them, so that the analysis code and batch_analyze.py (which only need the
+# config) don't load a GUI toolkit
 
 VERSION = "v1.0.0"
 
@@ -42,24 +38,33 @@ SCROLL_WIDTH = 2
 SEGMENT_LINE_WIDTH = 2
 
 def get_config():
+    config = {
+        "clusters": 0,
+        "maxClusters": 48,
+        "useV1": False,
+        "sparseEigen": False,
+        "maxSampleRate": 32000,
+        "analysisSampleRate": 0,
+        "silhouetteSampleSize": 0,
+        "fastKMeans": False,
+        "alwaysCache": False,
+        "cacheEvecs": False,
+        "cacheAudio": True,
+        "outputDir": "./output",
+        "cacheDir": "./cache",
+        "cacheSizeMB": 1024,
+        "lacDir": "./LoopingAudioConverter",
+        "lacXML": "LoopingAudioConverter.xml",
+        "fontPath": "./resources/FreeSansBold.ttf"
+    }
+
     if os.path.exists(CONFIG_JSON):
         # Use singleton pattern to store config file location/load config once
+        # Options missing from an older config file keep their defaults
         with open(CONFIG_JSON, 'r') as f:
-            return json.load(f)
-    else:
-        return {
-            "clusters": 0,
-            "maxClusters": 48,
-            "useV1": False,
-            "maxSampleRate": 32000,
-            "alwaysCache": False,
-            "cacheEvecs": False,
-            "outputDir": "./output",
-            "cacheDir": "./cache",
-            "lacDir": "./LoopingAudioConverter",
-            "lacXML": "LoopingAudioConverter.xml",
-            "fontPath": "./resources/FreeSansBold.ttf"
-        }
+            config.update(json.load(f))
+
+    return config
 
 CONFIG = get_config()
 
@@ -90,6 +95,7 @@ class CacheOptions(Enum):
 
 def notify(message):
     if os.name == 'nt':
+        from win10toast import ToastNotifier
         toaster = ToastNotifier()
         toaster.show_toast("Loopatron",
                            message,
@@ -98,6 +104,8 @@ def notify(message):
 
 def prompt_file(select_multiple = False):
     """Create a Tk file dialog and cleanup when finished"""
+    import tkinter
+    import tkinter.filedialog
     top = tkinter.Tk()
     top.withdraw()  # hide window
     if select_multiple:
@@ -123,6 +131,7 @@ def draw_status_message(main_status, sub_status, font, sub_status_color, window)
     draw_text(VERSION, font, Color.WHITE.value, window, window.get_width() - BUTTON_WIDTH * 3 - 20, 20)
 
 def draw_status_message_and_update(main_status, sub_status, font, sub_status_color, window):
+    import pygame.display
     draw_status_message(main_status, sub_status, font, sub_status_color, window)
     pygame.display.update()
 
@@ -130,6 +139,7 @@ def get_timestamp():
     return datetime.now().strftime("%H:%M:%S")
 
 def edit_lac_xml(xml_path, sample_rate, amplify_ratio, output_dir):
+    import xml.etree.ElementTree as ET
 
     tree = ET.parse(xml_path)
     root = tree.getroot()
@@ -147,6 +157,7 @@ def edit_lac_xml(xml_path, sample_rate, amplify_ratio, output_dir):
     tree.write(xml_path)
 
 def export_trimmed_wav(output_path, raw_audio, sample_rate, new_start_index = 0):
+    import soundfile as sf
     # write out the wav file with trimmed start
     sf.write(output_path, raw_audio[new_start_index:] , sample_rate, format='WAV', subtype='PCM_24')
 
@@ -9,19 +9,22 @@
     how to install, configure, and run this.
 
 """
-import bz2
+import atexit
 import collections
 import glob
+import itertools
 import json
+import multiprocessing
 import numpy as np
 import os
-import requests
+import queue
 import secrets
 import subprocess
 import soundfile as sf
+import struct
 import sys
-import urllib.parse
 import tempfile
+import traceback
 
 from flask import Flask, current_app, g, make_response, redirect, request, send_from_directory, session, url_for
 from flask_compress import Compress
@@ -29,7 +32,7 @@ from flask_socketio import SocketIO, emit, send
 
 from multiprocessing import Process
 
-from Remixatron import InfiniteJukebox
+from Remixatron import AnalysisCache, BeatTable, InfiniteJukebox, PLAY_VECTOR_LENGTH, warm_up
 
 # supress warnings from any of the imported libraries. This will keep the
 # console clean.
@@ -50,6 +53,33 @@ compress = Compress(app)
 
 socketio = None
 
+# finished analyses are cached by the content of the audio and the analysis settings,
+# so the same song is only ever analysed once, whatever URL or file it came from
+
+analysis_cache = AnalysisCache(tempfile.gettempdir() + '/remixatron-cache')
+
+# audio longer than this (in seconds) is analysed a block at a time, so that a
+# mix or podcast hours long doesn't have to be decoded into memory all at once
+
+STREAMING_MIN_SECONDS = 20 * 60
+
+# songs are analysed at no more than this sample rate. Only playback needs the full
+# rate, and hi-res uploads analyse far quicker this way.
+
+ANALYSIS_SAMPLE_RATE = 22050
+
+# the candidate cluster counts of songs with more beats than this are scored on a
+# random sample of this many beats. That's several times quicker for long songs, and
+# the scores are typically within a few thousandths of the exact ones.
+
+SILHOUETTE_SAMPLE_SIZE = 1000
+
+# cluster with restarts that stop once they stop paying off, each candidate cluster
+# count starting from the one before. Several times quicker, and the clusters are as
+# good on average, though not the same ones.
+
+FAST_KMEANS = True
+
 # the cors.cfg file defines which domains will be trusted for connections. The
 # default entry of localhost:8000 will be fine if you are running the web
 # browser on the same host as this server. Otherwise, you'll have to modify
@@ -65,11 +95,29 @@ else:
 # this will hold the 50 most recent messages for each client
 messageQueues = {}
 
+# the audio processing sub-processes post their messages for the clients here. A
+# background task in the server passes them on every RELAY_INTERVAL seconds. See
+# relay_messages().
+
+messageRelay = multiprocessing.Queue()
+relayTask = None
+
+RELAY_INTERVAL = 0.1
+
 # this will hold the Process object current being used for audio processing
 # for each client. No client should have more than one process working at a
 # time
 procMap = {}
 
+# the audio is processed by a fixed number of pre-forked worker processes. Jobs
+# wait in a queue (of at most MAX_PENDING_JOBS) for a free worker; beyond that,
+# requests are turned away until the queue drains. See AnalysisWorkerPool.
+
+ANALYSIS_WORKERS = 2
+MAX_PENDING_JOBS = 16
+
+analysisPool = None
+
 def get_userid():
     """ Returns the device id of the connected user form their cookies.
 
@@ -160,6 +208,8 @@ def on_connect():
     if deviceid not in messageQueues:
         messageQueues[deviceid] = collections.deque(maxlen=50)
 
+    start_relay()
+
 
 def fetch_from_youtube(url, userid):
 
@@ -170,7 +220,8 @@ def fetch_from_youtube(url, userid):
         url (string): the url to fetch
         userid (string): the device asking for this
     Returns:
-        string: the final file name of the retrieved and trimmed audio.
+        tuple: the final file name of the retrieved and trimmed audio, and the
+               AnalysisCache.content_hash() of the audio as it was downloaded.
     """
 
     # this function runs out-of-process from the main serving thread, so
@@ -201,11 +252,15 @@ def fetch_from_youtube(url, userid):
     result = subprocess.run(['ffmpeg', '-y', '-i', fn, '-af', filter, of],
                             stderr=subprocess.PIPE, stdout=subprocess.PIPE)
 
+    # the trimmed file is different every time it's made, so the analysis cache is
+    # keyed by the downloaded file instead
+    content_hash = AnalysisCache.content_hash(fn)
+
     # delete the downlaoded file because we don't need it anymore
     os.remove(fn)
 
     # return the name of the trimmed file
-    return of
+    return of, content_hash
 
 def fetch_from_local(fn, userid):
     """ Trim and prepare an audio file uploaded from the user
@@ -215,7 +270,8 @@ def fetch_from_local(fn, userid):
         userid (string): the client asking for this
 
     Returns:
-        string: the file name of the final prepard file
+        tuple: the file name of the final prepard file, and the
+               AnalysisCache.content_hash() of the file that was uploaded
     """
 
     # trim silence from the ends and save as ogg
@@ -227,11 +283,15 @@ def fetch_from_local(fn, userid):
     result = subprocess.run(['ffmpeg', '-y', '-i', fn, '-af', filter, of],
                             stderr=subprocess.PIPE, stdout=subprocess.PIPE)
 
+    # the trimmed file is different every time it's made, so the analysis cache is
+    # keyed by the uploaded file instead
+    content_hash = AnalysisCache.content_hash(fn)
+
     # delete the uploaded file
     os.remove(fn)
 
     # return the name of the trimmed file
-    return of
+    return of, content_hash
 
 @app.route('/healthcheck')
 def healthcheck():
@@ -300,23 +360,10 @@ def fetch_url():
 
     print( deviceid, 'asked for:', url, 'with', clusters, 'clusters and useCache of', useCache)
 
-    # if there is already a proc entry for this client, then
-    # kill it if it's running.
-
-    proc = None
-
-    if deviceid in procMap:
-        proc = procMap[deviceid]
-
-    if proc != None and proc.is_alive():
-        print('!!!!!! killing', proc.pid, '!!!!!')
-        proc.terminate()
-
-    # start the main audio processing proc and save a pointer to it
-    # for this client
+    # queue the job for the worker pool. This replaces any job this client
+    # already has queued or running.
 
-    procMap[deviceid] = Process(target=process_audio, args=(url, deviceid, False, clusters, useCache))
-    procMap[deviceid].start()
+    submit_job(deviceid, (url, deviceid, False, clusters, useCache))
 
     return index()
 
@@ -332,15 +379,11 @@ def cancel_fetch():
     print('cancelling work for', deviceid)
 
     # if we're not processing for this client already, just return
-    if deviceid not in procMap:
+    if analysisPool is None:
         return 'OK'
 
-    # otherwise, kill the running process if it's still running
-    proc = procMap[deviceid]
-
-    if proc != None and proc.is_alive():
-        print('!!!!!! killing', proc.pid, '!!!!!')
-        proc.terminate()
+    # otherwise, drop its queued job or stop the worker running it
+    analysisPool.cancel(deviceid)
 
     # return
     return 'OK'
@@ -348,9 +391,8 @@ def cancel_fetch():
 def post_status_message( userid, percentage, message ):
     """ The main audio processing is done outside of the main thread. From
     time to time during that processing, we will want to post an update to
-    the client about what's going on. To do this, we call back into the
-    /relay endpoint. That enpoint exists in the main web thread and can send
-    messages via scoket.io.
+    the client about what's going on. To do this, we post it to the
+    messageRelay queue. The server passes it on via socket.io.
 
     Args:
         userid (string): the client id to whom to send the message
@@ -360,12 +402,55 @@ def post_status_message( userid, percentage, message ):
 
     payload = json.dumps({'percentage': percentage, 'message':message})
 
-    requests.get(
-        'http://localhost:8000/relay',
-        params={'namespace': '/' + userid, 'event':'status', 'message': payload}
-    )
+    messageRelay.put(('/' + userid, 'status', payload))
+
+# the header of a binary play vector file. See write_play_vector()
+
+PLAY_VECTOR_MAGIC = b'RXPV'
+PLAY_VECTOR_VERSION = 1
+
+def write_play_vector(fn, play_vector, chunk_size=65536):
+    """ Writes the first PLAY_VECTOR_LENGTH entries of a play vector generator to
+    a file in the compact binary format that /playvector serves. The entries are
+    packed a chunk at a time as they are generated.
+
+    The file is a 16 byte header -- the magic bytes 'RXPV', then the format version,
+    the number of entries and a reserved word, each a uint32 -- followed by three
+    packed arrays of that many entries: beat (uint32), seq_len (uint16) and seq_pos
+    (uint16). Everything is little-endian. See decode_playvector() in static/index.js.
+
+    Args:
+        fn (string): the file to write
+        play_vector (iterator): the play vector entries (see InfiniteJukebox.iter_play_vector)
+        chunk_size (int): how many entries to pack at once
+    """
+
+    entries = itertools.islice(play_vector, PLAY_VECTOR_LENGTH)
+
+    beat = np.empty(PLAY_VECTOR_LENGTH, dtype='<u4')
+    seq_len = np.empty(PLAY_VECTOR_LENGTH, dtype='<u2')
+    seq_pos = np.empty(PLAY_VECTOR_LENGTH, dtype='<u2')
 
-def process_audio(url, userid, isupload=False, clusters=0, useCache=True):
+    count = 0
+    chunk = list(itertools.islice(entries, chunk_size))
+
+    while chunk:
+        packed = np.array([(v['beat'], v['seq_len'], v['seq_pos']) for v in chunk]).T
+
+        beat[count:count + len(chunk)] = packed[0]
+        seq_len[count:count + len(chunk)] = packed[1]
+        seq_pos[count:count + len(chunk)] = packed[2]
+
+        count += len(chunk)
+        chunk = list(itertools.islice(entries, chunk_size))
+
+    with open(fn, 'wb') as f:
+        f.write(struct.pack('<4sIII', PLAY_VECTOR_MAGIC, PLAY_VECTOR_VERSION, count, 0))
+        f.write(beat[:count].tobytes())
+        f.write(seq_len[:count].tobytes())
+        f.write(seq_pos[:count].tobytes())
+
+def process_audio(url, userid, isupload=False, clusters=0, useCache=True, relay=None):
     """ The main processing for the audio is done here. It makes heavy use of the
     InfiniteJukebox class (https://github.com/drensin/Remixatron).
 
@@ -374,14 +459,22 @@ def process_audio(url, userid, isupload=False, clusters=0, useCache=True):
         userid (string): the id of the requesting client
         isupload (bool, optional): Is this processing for uploaded audio (True)
                                    or Youtube audio (False). Defaults to False.
+        relay (multiprocessing.Queue, optional): the server's messageRelay. If this
+                                   process was spawned rather than forked, its own
+                                   copy of this module has a different queue.
     """
 
+    global messageRelay
+
+    if relay is not None:
+        messageRelay = relay
+
     fn = ""
 
     if isupload == False:
-        fn = fetch_from_youtube(url,userid)
+        fn, content_hash = fetch_from_youtube(url,userid)
     else:
-        fn = fetch_from_local(url, userid)
+        fn, content_hash = fetch_from_local(url, userid)
 
     print('fetch complete')
 
@@ -396,35 +489,72 @@ def process_audio(url, userid, isupload=False, clusters=0, useCache=True):
 
     remixatron_callback(0.1, 'Audio downloaded')
 
-    cached_beatmap_fn = tempfile.gettempdir() + '/' + urllib.parse.quote(url, safe='') + ".beatmap.bz2"
+    streaming = sf.info(fn).duration > STREAMING_MIN_SECONDS
+
+    # the same arguments key the cache entry and construct the jukebox, so the two
+    # can't drift apart. Each worker analyses its song with a single process. The pool
+    # already bounds how many cores the analyses use, and a worker with no processes
+    # of its own can be terminated without leaving any orphans behind.
+
+    analysis_args = {'clusters': clusters, 'start_beat': 0, 'n_jobs': 1, 'streaming': streaming,
+                     'analysis_sr': ANALYSIS_SAMPLE_RATE, 'silhouette_sample': SILHOUETTE_SAMPLE_SIZE,
+                     'fast_kmeans': FAST_KMEANS}
+
+    cache_key = InfiniteJukebox.analysis_cache_key(analysis_cache, content_hash, **analysis_args)
+
+    # if we've been asked not to use the cache, throw away any earlier analysis so
+    # that the fresh one replaces it
+
+    if useCache == False:
+        analysis_cache.remove(cache_key)
 
     beats = None
     play_vector = None
 
-    if (os.path.isfile(cached_beatmap_fn) == False) or (useCache == False):
+    cached = analysis_cache.load(cache_key)
+
+    if cached is None:
+
+        # all of the core analytics and processing is done in this call. The result
+        # is stored in the analysis cache as well. The decoded audio isn't needed
+        # here once the beats are found, so it's kept in a memory-mapped file rather
+        # than in this worker's memory.
+        pcm_fn = pcm_file(userid)
+
+        # a worker that was terminated (say, its job was cancelled) didn't get to clean
+        # up after itself, so remove anything it left behind first
+
+        remove_pcm_file(pcm_fn)
+
+        try:
+            jukebox = InfiniteJukebox(fn, progress_callback=remixatron_callback,
+                                      do_async=False, cache=analysis_cache,
+                                      content_hash=content_hash, pcm_path=pcm_fn,
+                                      **analysis_args)
 
-        # all of the core analytics and processing is done in this call
-        jukebox = InfiniteJukebox(fn, clusters=clusters,
-                                  progress_callback=remixatron_callback,
-                                  start_beat=0, do_async=False)
+            print(jukebox.timing_report())
 
-        beats = jukebox.beats
-        play_vector = jukebox.play_vector
+            # export the beats as plain dictionaries. The audio buffers are left out
+            # since they can't (and needn't) be sent as JSON.
 
-        def skip_encoder(o):
-            return ''
+            beats = jukebox.beats.to_dicts()
+            play_vector = InfiniteJukebox.IterPlayVectorFromBeats(beats, start_beat=0)
 
-        with bz2.open(cached_beatmap_fn, 'wb') as f:
-            f.write(json.dumps(jukebox.beats, default=skip_encoder).encode('utf-8'))
+            del jukebox
+
+        finally:
+            remove_pcm_file(pcm_fn)
 
     else:
 
-        print("Reading beatmap from disk.")
+        print("Reading analysis from the cache.")
+
+        # the audio itself isn't needed here, so there's no need to decode it
 
-        with bz2.open(cached_beatmap_fn, 'rb') as f:
-            beats = json.load(f)
+        _, arrays = cached
 
-        play_vector = InfiniteJukebox.CreatePlayVectorFromBeats(beats, start_beat=0)
+        beats = BeatTable.from_arrays(arrays).to_dicts()
+        play_vector = InfiniteJukebox.IterPlayVectorFromBeats(beats, start_beat=0)
 
     # save off a dictionary of all the beats of the song. We care about the id, when the
     # beat starts, how long it lasts, to which segment and cluster it belongs, and which
@@ -444,38 +574,117 @@ def process_audio(url, userid, isupload=False, clusters=0, useCache=True):
         f.write(json.dumps(beatmap))
 
     # save off a 1024 * 1024 vector of beats to play. This is the random(ish)ly
-    # generated play path through the song.
+    # generated play path through the song, packed into a compact binary file.
 
-    with open(tempfile.gettempdir() + '/' + userid + '.playvector', 'w') as f:
-        f.write(json.dumps(play_vector))
+    write_play_vector(tempfile.gettempdir() + '/' + userid + '.playvector', play_vector)
 
     # signal the client that we're done processing
 
     ready_msg = {'message':'ready'}
 
-    requests.get(
-        'http://localhost:8000/relay',
-        params={'namespace': '/' + userid, 'event':'ready', 'message': json.dumps(ready_msg)}
-    )
+    messageRelay.put(('/' + userid, 'ready', json.dumps(ready_msg)))
 
-@app.route('/relay')
-def relay():
+def pcm_file(userid):
 
-    """ The audio processing sub-process will need to send messages back to the client. In
-    order to use socket.io, however, you have to be in the main Flaks context. So, the process
-    will call this endpoint and this function will then use socket.io to pass the message along
-    to the client.
+    """ Where process_audio() keeps a client's decoded audio while it's analysed. """
 
-    Returns:
-        flask.Response: HTTP 200 OK
+    return tempfile.gettempdir() + '/' + userid + '.pcm.npy'
+
+def remove_pcm_file(pcm_fn):
+
+    """ Removes the memory-mapped audio that process_audio() keeps in pcm_fn, if it's there. """
+
+    if os.path.exists(pcm_fn):
+        os.remove(pcm_fn)
+
+def start_relay():
+
+    """ Starts the relay_messages() background task, if it isn't running already. """
+
+    global relayTask
+
+    if relayTask is None:
+        relayTask = socketio.start_background_task(relay_messages)
+
+def relay_messages():
+
+    """ The audio processing sub-processes need to send messages back to the clients. In
+    order to use socket.io, however, you have to be in the server. So, the processes post
+    their messages to the messageRelay queue, and this background task passes them along.
+
+    Every RELAY_INTERVAL seconds it takes everything that has been posted since the last
+    time. A status message replaces the one before it, so only the latest status for each
+    client in a batch is sent.
     """
 
-    namespace = request.args['namespace']
-    message = request.args['message']
-    event_name = request.args['event']
+    while True:
+        socketio.sleep(RELAY_INTERVAL)
+
+        # this is the only task relaying messages and dispatching queued jobs, so an
+        # error in one round is logged and the next round carries on
+
+        try:
+            relay_message_batch()
+        except Exception:
+            traceback.print_exc()
+
+def relay_message_batch():
+
+    """ Relays everything posted since the last round. See relay_messages(). """
+
+    messages = drain(messageRelay)
+
+    if analysisPool is not None:
+        analysisPool.replace_dead_workers()
+        messages = itertools.chain(messages, analysisPool.messages())
+
+    batch = collections.OrderedDict()
+
+    for namespace, event_name, message in messages:
+
+        # a message without a namespace is from the worker pool itself
+
+        if namespace is None:
+            analysisPool.job_finished(int(message))
+            continue
+
+        if event_name == 'status':
+            key = (namespace, event_name)
+            batch.pop(key, None)
+        else:
+            key = (namespace, event_name, len(batch))
+
+        batch[key] = message
+
+    for key, message in batch.items():
+        try:
+            send_message(key[0], key[1], message)
+        except Exception as e:
+            print('failed to relay a message to', key[0], e)
+
+def drain(q):
+
+    """ Yields everything in a multiprocessing.Queue, without waiting for more. """
+
+    while True:
+        try:
+            yield q.get_nowait()
+        except queue.Empty:
+            return
+
+def send_message(namespace, event_name, message):
+
+    """ Records a message in the client's message queue and sends it to the client
+    via socket.io.
+
+    Args:
+        namespace (string): the socket.io namespace of the client. That's '/' + its id.
+        event_name (string): the socket.io event
+        message (string): the message, as JSON
+    """
 
     # get the message queue for this client
-    q = messageQueues[namespace[1:]]
+    q = messageQueues.setdefault(namespace[1:], collections.deque(maxlen=50))
 
     # compute the next message id.
     id = 0
@@ -496,7 +705,223 @@ def relay():
         j['id'] = id
 
     socketio.emit(event_name, json.dumps(j), namespace=namespace)
-    return 'OK', [('Content-Type', 'text/plain')]
+
+def start_pool():
+
+    """ Starts the audio processing worker pool, if it isn't running already. """
+
+    global analysisPool
+
+    if analysisPool is None:
+        analysisPool = AnalysisWorkerPool(ANALYSIS_WORKERS, MAX_PENDING_JOBS, procMap)
+        atexit.register(analysisPool.shutdown)
+
+def submit_job(deviceid, job):
+
+    """ Hands an audio processing job to the worker pool, starting the pool (and the
+    message relay) if need be. If the queue is full, the client is told to try again
+    later.
+
+    Args:
+        deviceid (string): the client the job is for
+        job (tuple): the args for process_audio()
+    """
+
+    start_relay()
+    start_pool()
+
+    if not analysisPool.submit(deviceid, job):
+        print('!!!!!! turning away', deviceid, '-- the queue is full !!!!!')
+
+        send_message('/' + deviceid, 'status',
+                     json.dumps({'percentage': 0, 'message': 'The server is busy. Please try again in a few minutes.'}))
+
+def analysis_worker(inbox, outbox):
+
+    """ The main loop of a pre-forked audio processing process. It warms up the analysis
+    code, then runs the jobs it's given, one at a time, until it's sent None. Its messages
+    for the clients, and word of each finished job, go to its outbox.
+
+    Args:
+        inbox (multiprocessing.Queue): the jobs for this worker
+        outbox (multiprocessing.Queue): the messages from this worker
+    """
+
+    # a worker forked from a warmed up server has little left to do here. One that
+    # was spawned (e.g. on Windows) starts cold.
+
+    try:
+        print('worker', os.getpid(), 'warmed up in %.2fs' % warm_up(sr=ANALYSIS_SAMPLE_RATE))
+    except Exception:
+        traceback.print_exc()
+
+    for job in iter(inbox.get, None):
+        try:
+            process_audio(*job, relay=outbox)
+        except Exception:
+            traceback.print_exc()
+            post_status_message(job[1], 1, "Failed to process the audio. Check the logs!")
+
+        outbox.put((None, 'finished', str(os.getpid())))
+
+class AnalysisWorkerPool(object):
+
+    """ A fixed number of pre-forked audio processing processes, and a bounded queue of
+    the jobs waiting for one of them.
+
+    Each client has at most one job, queued or running. A new job from a client replaces
+    its old one. A queued job is simply dropped; a running one is stopped by terminating
+    its worker, which is then replaced with a fresh one. Clients with queued jobs are
+    sent their place in the queue whenever it changes.
+
+    Everything here runs in the server process. The message relay collects the workers'
+    messages with messages(), and calls job_finished() when a worker says it's done.
+
+    Each worker posts to a queue of its own, because a process that is terminated while
+    writing to a queue can leave the queue unusable. The queue of a terminated worker is
+    never read again.
+
+    Args:
+        workers (int): the number of worker processes
+        max_pending (int): the most jobs that may wait for a worker
+        running (dict): maps each client to the Process running its job, or None.
+                        Kept up to date by the pool. (procMap)
+    """
+
+    def __init__(self, workers, max_pending, running):
+
+        self.__max_pending = max_pending
+        self.__running = running
+        self.__pending = collections.deque()
+        self.__workers = [self.__start_worker() for _ in range(workers)]
+
+    def __start_worker(self):
+
+        inbox = multiprocessing.Queue()
+        outbox = multiprocessing.Queue()
+
+        proc = Process(target=analysis_worker, args=(inbox, outbox))
+        proc.start()
+
+        return {'process': proc, 'inbox': inbox, 'outbox': outbox, 'deviceid': None}
+
+    def __replace_worker(self, worker):
+
+        """ Stops a worker, if it's still running, and starts a fresh one in its place. """
+
+        if worker['deviceid'] is not None:
+            self.__running[worker['deviceid']] = None
+
+        if worker['process'].is_alive():
+            print('!!!!!! killing', worker['process'].pid, '!!!!!')
+            worker['process'].terminate()
+
+        worker['process'].join()
+
+        # a terminated worker doesn't clean up after its job
+
+        if worker['deviceid'] is not None:
+            remove_pcm_file(pcm_file(worker['deviceid']))
+
+        self.__workers[self.__workers.index(worker)] = self.__start_worker()
+
+    def submit(self, deviceid, job):
+
+        """ Queues a job for a client, replacing any job it already has. Returns False
+        (and doesn't queue it) if the queue is full.
+        """
+
+        self.cancel(deviceid)
+
+        if len(self.__pending) >= self.__max_pending:
+            return False
+
+        self.__pending.append((deviceid, job))
+        self.__dispatch()
+
+        return True
+
+    def cancel(self, deviceid):
+
+        """ Drops a client's queued job, or stops its running one. """
+
+        queued = len(self.__pending)
+        self.__pending = collections.deque(p for p in self.__pending if p[0] != deviceid)
+
+        for worker in self.__workers:
+            if worker['deviceid'] == deviceid:
+                self.__replace_worker(worker)
+
+        self.__dispatch(len(self.__pending) != queued)
+
+    def messages(self):
+
+        """ Yields the messages the workers have posted, without waiting for more. """
+
+        for worker in list(self.__workers):
+            for message in drain(worker['outbox']):
+                yield message
+
+    def job_finished(self, pid):
+
+        """ Marks the worker with this process id as free for the next job. """
+
+        for worker in self.__workers:
+            if worker['process'].pid == pid and worker['deviceid'] is not None:
+                self.__running[worker['deviceid']] = None
+                worker['deviceid'] = None
+
+        self.__dispatch()
+
+    def replace_dead_workers(self):
+
+        """ Replaces any worker that has died (say, killed for running out of memory)
+        and tells its client.
+        """
+
+        for worker in list(self.__workers):
+            if not worker['process'].is_alive():
+                if worker['deviceid'] is not None:
+                    send_message('/' + worker['deviceid'], 'status',
+                                 json.dumps({'percentage': 1, 'message': 'Failed to process the audio. Check the logs!'}))
+
+                self.__replace_worker(worker)
+                self.__dispatch()
+
+    def shutdown(self):
+
+        """ Stops all of the workers. """
+
+        for worker in self.__workers:
+            worker['process'].terminate()
+
+    def __idle_worker(self):
+
+        return next((w for w in self.__workers if w['deviceid'] is None), None)
+
+    def __dispatch(self, moved=False):
+
+        """ Starts queued jobs on idle workers, and tells the clients still waiting
+        where they are in the queue if that has changed.
+        """
+
+        while len(self.__pending) > 0 and self.__idle_worker() is not None:
+            worker = self.__idle_worker()
+            deviceid, job = self.__pending.popleft()
+
+            worker['deviceid'] = deviceid
+            worker['inbox'].put(job)
+
+            self.__running[deviceid] = worker['process']
+
+            moved = True
+
+        if not moved:
+            return
+
+        for position, (deviceid, _) in enumerate(self.__pending):
+            message = 'Waiting for a free worker. You are number %d in the queue...' % (position + 1)
+            send_message('/' + deviceid, 'status', json.dumps({'percentage': 0, 'message': message}))
 
 @app.route('/getQueue')
 def getQueue():
@@ -540,20 +965,17 @@ def get_beatmap():
 @app.route('/playvector')
 def get_playvector():
 
-    """ Return the play vector for this audio. See the process_audio() function
-    for more info about this.
+    """ Return the play vector for this audio, in the binary format written by
+    write_play_vector(). Range requests are honored. See the process_audio()
+    function for more info about this.
 
     Returns:
-        string: JSON of the play vector
+        flask.Response: the play vector file
     """
 
-    json = ""
-
-    with open(tempfile.gettempdir() + '/' + get_userid() + '.playvector', 'r') as f:
-        json = f.readlines()
-
-    return json[0], [('Content-Type', 'application/json'),
-                     ('Cache-Control', 'no-store')]
+    return send_from_directory(tempfile.gettempdir() + '/', get_userid() + '.playvector',
+                               mimetype='application/octet-stream', conditional=True,
+                               cache_timeout=0)
 
 @app.route('/getaudio')
 def get_audio():
@@ -664,19 +1086,10 @@ def upload_audio():
         j = {'title': file.filename, 'thumbnail':'/static/favicon.ico'}
         f.write(json.dumps(j))
 
-    # if there's already an audio processing subproc running for this client,
-    # then kill it.
-
-    proc = procMap[deviceid]
+    # queue the job for the worker pool. If there's already an audio processing
+    # job queued or running for this client, then it's replaced.
 
-    if proc != None and proc.is_alive():
-        print('!!!!!! killing', proc.pid, '!!!!!')
-        proc.terminate()
-
-    # kick of a proc to process the audio.
-
-    procMap[deviceid] = Process(target=process_audio, args=(of, deviceid, True))
-    procMap[deviceid].start()
+    submit_job(deviceid, (of, deviceid, True))
 
     return index()
 
@@ -684,5 +1097,12 @@ if __name__ == '__main__':
 
     # The main thread. Listens on any IP address and port 8000
 
+    # load and compile the analysis code once, up front, so that the workers forked
+    # from here don't each pay for it, and then start them
+
+    print('warmed up in %.2fs' % warm_up(sr=ANALYSIS_SAMPLE_RATE))
+
+    start_pool()
+
     compress.init_app(app)
     socketio.run(app, host="0.0.0.0", port=8000)
@@ -287,15 +287,47 @@ function on_get_beatmap(d) {
     // these files. To work around it, I append a random number. This is a
     // hack. When I track down the problem, I'll fix this up.
 
-    $.get('/playvector?' + Math.random(), on_get_playvector);
+    fetch('/playvector?' + Math.random())
+        .then(response => response.arrayBuffer())
+        .then(buffer => on_get_playvector(decode_playvector(buffer)));
     $.get('/trackinfo?' + Math.random(), on_get_trackinfo);
 }
 
+/**
+ * Decodes the binary play vector sent by the server: a 16 byte header (the magic
+ * bytes 'RXPV', then the format version, the number of entries and a reserved word,
+ * each a uint32) followed by the packed beat (uint32), seq_len (uint16) and seq_pos
+ * (uint16) arrays. Everything is little-endian, which is also the byte order of the
+ * typed arrays on every platform browsers run on. The arrays are views on the buffer,
+ * so nothing is copied.
+ *
+ * @param {ArrayBuffer} buffer
+ */
+function decode_playvector(buffer) {
+    var header = new DataView(buffer, 0, 16);
+
+    var magic = String.fromCharCode(header.getUint8(0), header.getUint8(1),
+                                    header.getUint8(2), header.getUint8(3));
+
+    if (magic != 'RXPV' || header.getUint32(4, true) != 1) {
+        throw new Error('unrecognized play vector format');
+    }
+
+    var count = header.getUint32(8, true);
+
+    return {
+        length: count,
+        beat: new Uint32Array(buffer, 16, count),
+        seq_len: new Uint16Array(buffer, 16 + 4 * count, count),
+        seq_pos: new Uint16Array(buffer, 16 + 6 * count, count)
+    };
+}
+
 /**
  * Called after the play vector is received and we're ready to start
  * playing the audio
  *
- * @param {json object} d
+ * @param {object} d the decoded play vector (see decode_playvector)
  */
 function on_get_playvector(d) {
     playvector = d;
@@ -552,7 +584,7 @@ function playback(createNew = true){
         }else{
             // if it wasn't already playing, then un-pause it and start the playback events
             sound.play(String(sndIndex));
-            timerPlaybackID = setTimeout(onSoundEnd, beatmap[playvector[sndIndex].beat].duration);
+            timerPlaybackID = setTimeout(onSoundEnd, beatmap[playvector.beat[sndIndex]].duration);
             $('#playIcon').text('pause_circle_outline');
             return;
         }
@@ -632,7 +664,7 @@ function onSoundEnd() {
     // look in the play vector to see which beat we need to play next
     sndIndex = sndIndex + 1;
 
-    var toplay = playvector[sndIndex].beat + 1;
+    var toplay = playvector.beat[sndIndex] + 1;
 
     // play that beat and reset the play timer
     id = sound.play(String(toplay));
@@ -701,8 +733,8 @@ function drawViz() {
                   0, timelineY + timelineHeight + 23);
 
     // get the current X and beat
-    var currentX = (playvector[sndIndex].beat * beatWidth) + xOffset;
-    var currentBeat = beatmap[playvector[sndIndex].beat];
+    var currentX = (playvector.beat[sndIndex] * beatWidth) + xOffset;
+    var currentBeat = beatmap[playvector.beat[sndIndex]];
 
     var segmentColorMap = ['#C2C2C2', '#FFFFFF'];
 
@@ -808,7 +840,7 @@ function drawViz() {
     ctx.shadowBlur = 0;
 
     // compute how many beats until we want to jump (or '!!' if we're late)
-    var leftInSeq =  playvector[sndIndex].seq_len - playvector[sndIndex].seq_pos;
+    var leftInSeq =  playvector.seq_len[sndIndex] - playvector.seq_pos[sndIndex];
 
     var str = '-' + String(leftInSeq).padStart(2, '0')
 
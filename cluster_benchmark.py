@@ -0,0 +1,96 @@
+"""cluster_benchmark.py - checks that fast_kmeans clusters songs as well as the default.
+
+Each song is analysed twice, with fast_kmeans off and on, and the two are compared: the
+time spent clustering, the number of clusters chosen, how closely the fast clusters
+agree with the default ones, and the share of beats that can jump somewhere else in the
+song. Run it on a few songs after changing the clustering:
+
+    python cluster_benchmark.py song.mp3 another.mp3 -clusters 0 16
+
+It exits with status 1 if the fast clusters drift too far from the default ones, or
+leave noticeably fewer beats with somewhere to jump, so it can gate a build.
+
+"""
+
+import argparse
+import sys
+
+def process_args():
+
+    """ Process the command line args """
+
+    description = """Analyses songs with fast_kmeans off and on, and compares the time spent clustering and the quality of the clusters."""
+
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument("filenames", type=str, nargs='+',
+                        help="the songs to analyse")
+
+    parser.add_argument("-clusters", metavar='N', type=int, nargs='+', default=[0],
+                        help="the cluster counts to analyse each song with. 0 picks them automatically. Default: 0")
+
+    parser.add_argument("-use_v1", action='store_true',
+                        help="pick the cluster counts with the original auto clustering algorithm")
+
+    parser.add_argument("-min_agreement", metavar='ARI', type=float, default=0.5,
+                        help="fail if the adjusted Rand index between the fast and default clusters is below this. Default: 0.5")
+
+    parser.add_argument("-max_jump_loss", metavar='X', type=float, default=0.05,
+                        help="fail if the share of beats with a jump drops by more than this. Default: 0.05")
+
+    return parser.parse_args()
+
+def analyse(filename, clusters, use_v1, fast_kmeans):
+
+    """ Analyses a song, and returns a tuple of (seconds spent clustering, the number
+        of clusters, the cluster of each beat, the share of beats that can jump)
+    """
+
+    from Remixatron import InfiniteJukebox
+
+    jukebox = InfiniteJukebox(filename=filename, start_beat=0, clusters=clusters, do_async=False,
+                              use_v1=use_v1, fast_kmeans=fast_kmeans)
+
+    labels = [beat['cluster'] for beat in jukebox.beats]
+    jumps = sum(1 for beat in jukebox.beats if len(beat['jump_candidates']) > 0)
+
+    return jukebox.timings['clustering'], jukebox.clusters, labels, jumps / float(len(jukebox.beats))
+
+if __name__ == "__main__":
+
+    args = process_args()
+
+    # imported here so that --help doesn't wait for scikit-learn
+    import sklearn.metrics
+
+    failures = 0
+
+    print('%-30s %8s %17s %17s %7s %15s' % ('song', 'clusters', 'default', 'fast', 'ARI', 'beats w/ jumps'))
+
+    for filename in args.filenames:
+        for clusters in args.clusters:
+            slow_secs, slow_k, slow_labels, slow_jumps = analyse(filename, clusters, args.use_v1, False)
+            fast_secs, fast_k, fast_labels, fast_jumps = analyse(filename, clusters, args.use_v1, True)
+
+            agreement = sklearn.metrics.adjusted_rand_score(slow_labels, fast_labels)
+
+            problems = []
+
+            if agreement < args.min_agreement:
+                problems.append('the clusters agree with the default ones by %.2f, under %.2f' %
+                                (agreement, args.min_agreement))
+
+            if slow_jumps - fast_jumps > args.max_jump_loss:
+                problems.append('%.0f%% of beats can jump, down from %.0f%%' % (fast_jumps * 100, slow_jumps * 100))
+
+            print('%-30s %8s %5.2fs %3d clust %5.2fs %3d clust %7.2f %6.0f%% -> %3.0f%%  %s' %
+                  (filename[-30:], clusters or 'auto', slow_secs, slow_k, fast_secs, fast_k, agreement,
+                   slow_jumps * 100, fast_jumps * 100, 'OK' if len(problems) == 0 else 'FAIL'))
+
+            for problem in problems:
+                print('    ' + problem)
+
+            if len(problems) > 0:
+                failures += 1
+
+    sys.exit(1 if failures > 0 else 0)
@@ -7,22 +7,25 @@ work.
 """
 
 import argparse
+import collections
 import curses
 import curses.textpad
-import numpy as np
+import itertools
 import os
-import pygame
-import pygame.event
-import pygame.locals
 import signal
-import soundfile as sf
 import sys
+import tempfile
+import threading
 import time
 
-from Remixatron import InfiniteJukebox
-from pygame import mixer
+# Remixatron (and with it librosa, scipy and sklearn), numpy, soundfile and pygame
+# take far longer to import than the rest of the program takes to start. They're
+# imported where they're first needed, so --help, a bad argument or a -save render
+# don't pay for the ones they never use.
 
-SOUND_FINISHED = pygame.locals.USEREVENT + 1
+mixer = None
+scheduler = None
+segment_map = None
 
 def process_args():
 
@@ -45,18 +48,217 @@ def process_args():
                         help="start on a specific beat. Default: 1")
 
     parser.add_argument("-save", metavar='label', type=str,
-                        help="Save the remix to a file, rather than play it. Will create file named [label].wav")
+                        help="Save the remix to a file, rather than play it. Will create file named [label].wav (or [label].flac, etc. with -format)")
 
     parser.add_argument("-duration", metavar='seconds', type=int, default=180,
                         help="length (in seconds) to save. Must use with -save. Default: 180")
 
+    parser.add_argument("-format", metavar='name', type=str, default='WAV',
+                        help="the file format to save in: WAV, FLAC, OGG, W64, RF64 (for WAV files over 4GB), etc. Must use with -save. Default: WAV")
+
+    parser.add_argument("-subtype", metavar='name', type=str,
+                        help="the sample format to save in: PCM_16, PCM_24, FLOAT, VORBIS, etc. It must suit -format. Must use with -save. Default: PCM_24 if -format supports it, otherwise the format's usual one (e.g. VORBIS for OGG)")
+
+    parser.add_argument("-crossfade", metavar='ms', type=float, default=0,
+                        help="crossfade each jump over this many milliseconds (e.g. 10) to smooth the join. Must use with -save. Default: 0 (cut straight to the new beat)")
+
     parser.add_argument("-verbose", action='store_true',
                         help="print extra info about the track and play vector")
 
     parser.add_argument("-use_v1", action='store_true',
                         help="use the original auto clustering algorithm instead of the new one. -clusters must not be set.")
 
-    return parser.parse_args()
+    parser.add_argument("-sparse", action='store_true',
+                        help="keep the similarity matrices sparse and only compute the eigenvectors that clustering needs. Uses far less memory on very long tracks.")
+
+    parser.add_argument("-seed", metavar='N', type=int,
+                        help="seed the remix, so that the same seed plays (or saves) the same remix. Default: a new remix every time")
+
+    parser.add_argument("-cache_dir", metavar='path', type=str, default=os.path.join(tempfile.gettempdir(), 'remixatron-cache'),
+                        help="where to cache finished analyses, so the same song is only analysed once with the same settings. Default: remixatron-cache in the temp directory")
+
+    parser.add_argument("-no_cache", action='store_true',
+                        help="don't read or write the analysis cache")
+
+    parser.add_argument("-pcm_file", metavar='path', type=str,
+                        help="keep the decoded audio in a memory-mapped file at this path instead of in memory. Useful for very long tracks")
+
+    parser.add_argument("-stream", action='store_true',
+                        help="analyse the audio a block at a time instead of decoding it all into memory first. For mixes and podcasts hours long. Implies -sparse; best used with -pcm_file")
+
+    parser.add_argument("-analysis_sr", metavar='Hz', type=int,
+                        help="analyse audio with a higher sample rate than this at this rate (e.g. 22050). Much quicker for 48kHz or 96kHz audio; playback keeps the full rate. Default: the file's own rate")
+
+    parser.add_argument("-silhouette_sample", metavar='N', type=int,
+                        help="when automatically choosing the number of clusters for a track with more than N beats, score each choice on N beats picked at random (e.g. 1000). Several times quicker for long tracks. Default: score every beat")
+
+    parser.add_argument("-fast_kmeans", action='store_true',
+                        help="stop restarting KMeans once the restarts stop finding better clusters, and start each candidate number of clusters from the last one. Several times quicker; finds clusters as good on average, but not the same ones")
+
+    parser.add_argument("-lookahead", metavar='N', type=int, default=4,
+                        help="hand the audio to the mixer N beats at a time. Larger values ride out longer stalls on a busy machine. Default: 4")
+
+    args = parser.parse_args()
+
+    # check the output format now, rather than after the analysis has run
+
+    if args.save:
+        import soundfile as sf
+
+        args.format = args.format.upper()
+
+        if args.format not in sf.available_formats():
+            parser.error("unknown -format %s. Choose from: %s" % (args.format, ', '.join(sorted(sf.available_formats()))))
+
+        if args.subtype is None:
+            args.subtype = 'PCM_24' if sf.check_format(args.format, 'PCM_24') else sf.default_subtype(args.format)
+
+        args.subtype = args.subtype.upper()
+
+        if not sf.check_format(args.format, args.subtype):
+            parser.error("can't save %s audio in the %s format. Choose from: %s" %
+                         (args.subtype, args.format, ', '.join(sorted(sf.available_subtypes(args.format)))))
+
+    return args
+
+class BeatScheduler(object):
+
+    """ Plays the play vector from a thread of its own, so that nothing the display
+        does can hold up the audio.
+
+        The thread copies the next lookahead beats, back to back, into one block and
+        hands it to the mixer, always keeping one block queued behind the one that's
+        playing. The mixer's own callback plays one block straight after the other, so
+        the beats are gapless and every beat starts at a known sample of the output.
+
+        The display asks next_beat() what's playing. It works that out from the
+        output sample the mixer has reached, which is re-anchored each time a block
+        starts so it doesn't drift. The thread only appends to the timeline and
+        swaps the anchor, so the display never takes a lock.
+    """
+
+    # how often the thread checks whether the queued block has started
+    POLL_SECONDS = 0.005
+
+    def __init__(self, channel, jukebox, play_vector, lookahead=4):
+
+        """ Args:
+
+                channel: the pygame mixer Channel to play on
+                jukebox: the analysed InfiniteJukebox
+                play_vector: an iterator over the play vector, as iter_play_vector() returns
+                lookahead: the number of beats in each block handed to the mixer
+        """
+
+        import numpy as np
+
+        self.channel = channel
+        self.beats = jukebox.beats
+        self.sample_rate = jukebox.sample_rate
+        self.play_vector = play_vector
+        self.lookahead = max(lookahead, 1)
+
+        # each block is filled in this scratch array. mixer.Sound(buffer=...) copies it,
+        # so it can be refilled while the Sound made from it plays.
+
+        columns = jukebox.beats.columns
+        longest = int((columns['stop_index'] - columns['start_index']).max())
+
+        self.block = np.zeros((self.lookahead * longest,) + jukebox.raw_audio.shape[1:],
+                              dtype=jukebox.raw_audio.dtype)
+
+        # (the output sample each beat starts at, its play vector entry), in play order
+
+        self.timeline = collections.deque()
+        self.samples_rendered = 0
+
+        # (an output sample, the time it was played). Replaced whole, never modified.
+
+        self.anchor = (0, time.time())
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def render(self):
+
+        """ Copies the next lookahead beats of the play vector into the scratch block,
+            and returns them as a Sound.
+        """
+
+        block = self.block
+
+        filled = 0
+
+        for v in itertools.islice(self.play_vector, self.lookahead):
+            buffer = self.beats.buffer(v['beat'])
+
+            block[filled:filled + len(buffer)] = buffer
+
+            self.timeline.append((self.samples_rendered + filled, v))
+            filled += len(buffer)
+
+        self.samples_rendered += filled
+
+        return mixer.Sound(buffer=block[:filled])
+
+    def run(self):
+
+        # the first block starts playing as soon as it's queued
+
+        self.channel.queue(self.render())
+        self.anchor = (0, time.time())
+
+        queued_start = self.samples_rendered
+        self.channel.queue(self.render())
+
+        while not self.stopped.wait(self.POLL_SECONDS):
+
+            # the queued block has started playing. Re-anchor the position on it and
+            # queue the next one.
+
+            if self.channel.get_queue() is None:
+                self.anchor = (queued_start, time.time())
+
+                queued_start = self.samples_rendered
+                self.channel.queue(self.render())
+
+    def position(self):
+
+        """ The output sample that's playing now. """
+
+        sample, played_at = self.anchor
+
+        return sample + (time.time() - played_at) * self.sample_rate
+
+    def next_beat(self):
+
+        """ Waits for the next beat to start playing, and returns its play vector
+            entry. If the caller has fallen behind, it gets the beat that's playing
+            now and the ones it missed are skipped, so it never lags the audio.
+        """
+
+        while True:
+            position = self.position()
+
+            v = None
+
+            while len(self.timeline) > 0 and self.timeline[0][0] <= position:
+                v = self.timeline.popleft()[1]
+
+            if v is not None:
+                return v
+
+            if len(self.timeline) > 0:
+                time.sleep(max((self.timeline[0][0] - position) / self.sample_rate, 0.001))
+            else:
+                time.sleep(self.POLL_SECONDS)
 
 def MyCallback(pct_complete, message):
 
@@ -74,69 +276,99 @@ def MyCallback(pct_complete, message):
     window.refresh()
 
 
-def display_playback_progress(v):
+class SegmentMap(object):
+
+    """ Draws the segment map and keeps it up to date as the song plays.
 
+        The map itself only changes if the terminal is resized, so it's drawn once. On
+        each beat only the cells that change are repainted: the ones under the old and
+        new position tracker, and the old and new jump candidates.
     """
-        Displays a super low-fi playback progress map
 
-        See README.md for details..
+    SEGMENT_CHARS = '#-'
 
-        Returns the time this function took so we can deduct it from the
-        sleep time for the beat
-    """
+    def __init__(self, window, beats, y_offset):
+        self.window = window
+        self.beats = beats
+        self.y_offset = y_offset
 
-    time_start = time.time()
+        self.cells = ''.join(self.SEGMENT_CHARS[segment % 2] for segment in beats.columns['segment'].tolist())
 
-    term_width = curses.tigetnum('cols')
+        self.term_width = None
+        self.dirty = set()
 
-    y_offset = 11
+    def paint(self, beat_id, highlight=False):
 
-    beat = v['beat']
-    min_sequence = v['seq_len']
-    current_sequence = v['seq_pos']
+        """ Repaints the cell of one beat. The cell after the last beat is the blank
+            that the position tracker can spill into.
+        """
 
-    # compute a segment map and display it. See README.md for an
-    # explanation of segment maps and cluster maps.
+        cell = self.cells[beat_id] if beat_id < len(self.cells) else ' '
 
-    segment_map = ''
-    segment_chars = '#-'
+        self.window.addch(self.y_offset + int(beat_id / self.term_width),   # y position of character
+                          beat_id % self.term_width,                        # x position of character
+                          ord(cell),                                        # either '#' or '-' depending on the segment
+                          curses.A_REVERSE if highlight else curses.A_NORMAL)
+
+    def update(self, beat, beats_until_jump):
+
+        """ Moves the position tracker to beat, and highlights its jump candidates. """
+
+        term_width = curses.tigetnum('cols')
 
-    for b in jukebox.beats:
-        segment_map += segment_chars[ b['segment'] % 2 ]
+        # draw the whole map the first time, and again if the terminal was resized
 
-    window.addstr(y_offset,0,segment_map + " ")
+        if term_width != self.term_width:
+            self.term_width = term_width
+            self.dirty = set()
 
-    # highlight all the jump candidates in the segment
-    # map
+            self.window.addstr(self.y_offset, 0, self.cells + " ")
 
-    for c in jukebox.beats[beat]['jump_candidates']:
+        candidates = set(self.beats[beat]['jump_candidates'])
 
-        b = jukebox.beats[c]
+        # the position tracker is two characters wide
 
-        window.addch(y_offset + int(b['id'] / term_width),   # y position of character
-                      b['id'] % term_width,                  # x position of character
-                      ord(segment_chars[b['segment'] %2]),   # either '#' or '-' depending on the segment
-                      curses.A_REVERSE)                      # print in reverse highlight
+        tracker = {beat, beat + 1}
 
-    # print the position tracker on the segment map
+        for b in (self.dirty | candidates) - tracker:
+            self.paint(b, b in candidates)
 
-    x_pos = beat % term_width
-    y_pos = int(beat/term_width) + y_offset
+        self.dirty = candidates | tracker
 
-    beats_until_jump = min_sequence - current_sequence
+        # show the beats until the next jump. If the value == 0 then
+        # then sequence wanted to jump but couldn't find a suitable
+        # target. Display an appropriate symbol for that (a frowny face, of course!)
 
-    buj_disp = ''
+        if beats_until_jump > 0:
+            buj_disp = str(beats_until_jump).zfill(2)
+        else:
+            buj_disp = ':('
 
-    # show the beats until the next jump. If the value == 0 then
-    # then sequence wanted to jump but couldn't find a suitable
-    # target. Display an appropriate symbol for that (a frowny face, of course!)
+        self.window.addstr(int(beat / term_width) + self.y_offset, beat % term_width, buj_disp,
+                           curses.A_BOLD | curses.A_REVERSE | curses.A_STANDOUT)
 
-    if beats_until_jump > 0:
-        buj_disp = str(beats_until_jump).zfill(2)
-    else:
-        buj_disp = ':('
+def display_playback_progress(v):
 
-    window.addstr(y_pos, x_pos, buj_disp, curses.A_BOLD | curses.A_REVERSE | curses.A_STANDOUT )
+    """
+        Displays a super low-fi playback progress map
+
+        See README.md for details..
+
+        Returns the time this function took so we can deduct it from the
+        sleep time for the beat
+    """
+
+    global segment_map
+
+    time_start = time.time()
+
+    # the segment map is built the first time. See README.md for an
+    # explanation of segment maps and cluster maps.
+
+    if segment_map is None:
+        segment_map = SegmentMap(window, jukebox.beats, y_offset=11)
+
+    segment_map.update(v['beat'], v['seq_len'] - v['seq_pos'])
 
     window.refresh()
 
@@ -170,14 +402,15 @@ def get_verbose_info():
     segment_chars = '#-'
     cluster_chars = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz1234567890-=,.<>/?;:!@#$%^&*()_+'
 
-    for b in jukebox.beats:
-        segment_map += segment_chars[ b['segment'] % 2 ]
-        cluster_map += cluster_chars[ b['cluster'] ]
+    for segment, cluster in zip(jukebox.beats.columns['segment'].tolist(), jukebox.beats.columns['cluster'].tolist()):
+        segment_map += segment_chars[ segment % 2 ]
+        cluster_map += cluster_chars[ cluster ]
 
     verbose_info += "\n" + segment_map + "\n\n"
 
     if args.verbose:
         verbose_info += cluster_map + "\n\n"
+        verbose_info += jukebox.timing_report() + "\n\n"
 
     verbose_info += jukebox._extra_diag
 
@@ -206,7 +439,11 @@ def cleanup():
     print(w_str.rstrip())
     print
 
-    mixer.quit()
+    if scheduler is not None:
+        scheduler.stop()
+
+    if mixer is not None:
+        mixer.quit()
 
 def graceful_exit(signum, frame):
 
@@ -219,24 +456,77 @@ def graceful_exit(signum, frame):
     cleanup()
     sys.exit(0)
 
-def save_to_file(jukebox, label, duration):
-    ''' Save a fixed length of audio to disk. '''
+def save_to_file(jukebox, label, duration, seed=None, file_format='WAV', subtype='PCM_24', crossfade=0):
+    ''' Save a fixed length of audio to disk.
+
+        The beats are written to the file one after another as the play vector is
+        generated, so the memory used doesn't grow with the duration, and the file
+        fills up as it renders.
+
+        Args:
+
+            jukebox: the analysed InfiniteJukebox
+            label: the name of the file to write, without its extension
+            duration: the length to save, in seconds
+            seed: seeds the play vector, as for iter_play_vector()
+            file_format: any format soundfile can write, e.g. 'WAV', 'FLAC' or 'OGG'
+            subtype: the sample format, e.g. 'PCM_16', 'PCM_24' or 'VORBIS'
+            crossfade: the length of the crossfade at each jump, in milliseconds. At a
+                       jump, the start of the new beat is faded in over the audio that
+                       would have followed the old one, which is faded out.
+
+        Returns:
+
+            the name of the file written
+    '''
+
+    import numpy as np
+    import soundfile as sf
+
+    if not sf.check_format(file_format, subtype):
+        raise ValueError("can't save %s audio in the %s format" % (subtype, file_format))
+
+    raw_audio = jukebox.raw_audio
+    channels = 1 if raw_audio.ndim == 1 else raw_audio.shape[1]
 
     avg_beat_duration = 60 / jukebox.tempo
     num_beats_to_save = int(duration / avg_beat_duration)
 
-    # this list comprehension returns all the 'buffer' arrays from the beats
-    # associated with the [0..num_beats_to_save] entries in the play vector
+    # the fades are computed once, shaped to broadcast over the channels
+
+    fade_len = int(jukebox.sample_rate * crossfade / 1000.0)
+
+    fade_in = np.linspace(0.0, 1.0, fade_len, endpoint=False).reshape((-1,) + (1,) * (raw_audio.ndim - 1))
+    fade_out = 1.0 - fade_in
+
+    filename = label + '.' + file_format.lower()
+
+    with sf.SoundFile(filename, 'w', samplerate=jukebox.sample_rate, channels=channels,
+                      format=file_format, subtype=subtype) as f:
+
+        previous = None
+
+        for v in itertools.islice(jukebox.iter_play_vector(seed), num_beats_to_save):
+
+            buffer = jukebox.beats.buffer(v['beat'])
+
+            # a jump: crossfade from the audio that follows the last beat in the song
+
+            if fade_len > 0 and previous is not None and v['beat'] != previous + 1:
+                follows = jukebox.beats.columns[previous]['stop_index']
+                n = min(fade_len, len(buffer), len(raw_audio) - follows)
 
-    main_bytes = [jukebox.beats[v['beat']]['buffer'] for v in jukebox.play_vector[0:num_beats_to_save]]
+                if n > 0:
+                    head = buffer[:n] * fade_in[:n] + raw_audio[follows:follows + n] * fade_out[:n]
 
-    # main_bytes is an array of byte[] arrays. We need to flatten it to just a
-    # regular byte[]
+                    f.write(head.astype(raw_audio.dtype))
+                    buffer = buffer[n:]
 
-    output_bytes = np.concatenate( main_bytes )
+            f.write(buffer)
 
-    # write out the wav file
-    sf.write(label + '.wav', output_bytes, jukebox.sample_rate, format='WAV', subtype='PCM_24')
+            previous = v['beat']
+
+    return filename
 
 
 if __name__ == "__main__":
@@ -253,14 +543,24 @@ if __name__ == "__main__":
 
     args = process_args()
 
+    from Remixatron import AnalysisCache, InfiniteJukebox
+
     curses.setupterm()
 
     window = curses.initscr()
     curses.curs_set(0)
 
+    cache = None
+
+    if not args.no_cache:
+        cache = AnalysisCache(args.cache_dir)
+
     # do the clustering. Run synchronously. Post status messages to MyCallback()
     jukebox = InfiniteJukebox(filename=args.filename, start_beat=args.start, clusters=args.clusters,
-                                progress_callback=MyCallback, do_async=False, use_v1=args.use_v1)
+                                progress_callback=MyCallback, do_async=False, use_v1=args.use_v1,
+                                sparse_eigen=args.sparse, cache=cache, pcm_path=args.pcm_file,
+                                streaming=args.stream, analysis_sr=args.analysis_sr,
+                                silhouette_sample=args.silhouette_sample, fast_kmeans=args.fast_kmeans)
 
     # show more info about what was found
     window.addstr(2,0, get_verbose_info())
@@ -270,9 +570,11 @@ if __name__ == "__main__":
     # find the necessarry beats and do that
 
     if args.save:
-        save_to_file(jukebox, args.save, args.duration)
+        save_to_file(jukebox, args.save, args.duration, args.seed, args.format, args.subtype, args.crossfade)
         graceful_exit(0, 0)
 
+    from pygame import mixer
+
     # it's important to make sure the mixer is setup with the
     # same sample rate as the audio. Otherwise the playback will
     # sound too slow/fast/awful
@@ -280,40 +582,12 @@ if __name__ == "__main__":
     mixer.init(frequency=jukebox.sample_rate)
     channel = mixer.Channel(0)
 
-    # pygame's event handling functions won't work unless the
-    # display module has been initialized -- even though we
-    # won't be making any display calls.
-
-    pygame.display.init()
-
-    # register the event type we want fired when a sound buffer
-    # finishes playing
-
-    channel.set_endevent(SOUND_FINISHED)
-
-    # queue and start playing the first event in the play vector. This is basic
-    # audio double buffering that will reduce choppy audio from impercise timings. The
-    # goal is to always have one beat in queue to play as soon as the last one is done.
-
-    beat_to_play = jukebox.beats[ jukebox.play_vector[0]['beat'] ]
-
-    snd = mixer.Sound(buffer=beat_to_play['buffer'])
-    channel.queue(snd)
-
-    display_playback_progress(jukebox.play_vector[0])
-
-    # go through the rest of  the playback list, start playing each beat, display
-    # the progress and wait for the playback to complete. Playback happens on another
-    # thread in the pygame library, so we have to wait to be signaled to queue another
-    # event.
-
-    for v in jukebox.play_vector[1:]:
-
-        beat_to_play = jukebox.beats[ v['beat'] ]
-
-        snd = mixer.Sound(buffer=beat_to_play['buffer'])
-        channel.queue(snd)
+    # the play vector is generated as it is played, rather than all up front. The
+    # scheduler plays it on a thread of its own, and this one just keeps the display
+    # up with it.
 
-        pygame.event.wait()
+    scheduler = BeatScheduler(channel, jukebox, jukebox.iter_play_vector(args.seed), args.lookahead)
+    scheduler.start()
 
-        display_playback_progress(v)
+    while True:
+        display_playback_progress(scheduler.next_beat())
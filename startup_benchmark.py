@@ -0,0 +1,165 @@
+"""startup_benchmark.py - checks that the programs in this project start quickly.
+
+Each case starts a program in a fresh interpreter with python -X importtime, and fails
+if its imports take longer than its budget, or if it imports a heavy module (librosa,
+pygame, tkinter, ...) that it has no use for yet. Run it after changing any imports:
+
+    python startup_benchmark.py
+
+It exits with status 1 if any case is over budget, so it can gate a build.
+
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# the analysis stack. Importing Remixatron pulls in all of these.
+
+ANALYSIS_MODULES = ('Remixatron', 'librosa', 'numba', 'scipy', 'sklearn', 'numpy', 'soundfile')
+
+# the GUI toolkits and desktop integration
+
+GUI_MODULES = ('pygame', 'tkinter', 'win10toast')
+
+# (name, working directory, interpreter args, import budget in ms, modules it mustn't import)
+
+CASES = [
+    ('infinite_jukebox.py --help', HERE, ['infinite_jukebox.py', '--help'], 150,
+     ANALYSIS_MODULES + GUI_MODULES),
+
+    ('batch_analyze.py --help', os.path.join(HERE, 'UI'), ['batch_analyze.py', '--help'], 150,
+     ANALYSIS_MODULES + GUI_MODULES),
+
+    # Loopatron plays through pygame, which imports numpy, and its playback streams
+    # are numpy arrays. Everything else of the analysis stack waits for the first song.
+
+    ('import Loopatron', os.path.join(HERE, 'UI'), ['-c', 'import Loopatron'], 500,
+     tuple(m for m in ANALYSIS_MODULES if m != 'numpy') + ('tkinter', 'win10toast')),
+]
+
+def process_args():
+
+    """ Process the command line args """
+
+    description = """Checks the import time of each program in this project against a budget, and that none of them imports the analysis stack or a GUI toolkit before it needs to."""
+
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument("cases", type=str, nargs='*',
+                        help="only run the cases whose names contain one of these. Default: all of them")
+
+    parser.add_argument("-repeat", metavar='N', type=int, default=5,
+                        help="run each case N times and keep the quickest, to smooth out a cold disk cache. Default: 5")
+
+    parser.add_argument("-scale", metavar='X', type=float, default=1.0,
+                        help="multiply every budget by X, for slower machines. Default: 1.0")
+
+    parser.add_argument("-verbose", action='store_true',
+                        help="list the slowest top-level imports of each case")
+
+    return parser.parse_args()
+
+def parse_importtime(stderr):
+
+    """ Parses the report that python -X importtime writes to stderr.
+
+        Returns:
+
+            a list of (module, cumulative microseconds, nesting level) in import order
+    """
+
+    imports = []
+
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+
+        _, cumulative, name = line[len('import time:'):].split('|')
+
+        if not cumulative.strip().isdigit():
+            continue    # the header
+
+        # nested imports are indented two spaces per level
+
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+
+        imports.append((name.strip(), int(cumulative), level))
+
+    return imports
+
+def run_case(cwd, args, repeat):
+
+    """ Starts a program repeat times, and returns the quickest run as a tuple of
+        (wall time in s, import time in ms, imports, returncode, stderr)
+    """
+
+    best = None
+
+    for _ in range(repeat):
+        start = time.time()
+
+        proc = subprocess.run([sys.executable, '-X', 'importtime'] + args, cwd=cwd,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                              universal_newlines=True)
+
+        wall = time.time() - start
+
+        imports = parse_importtime(proc.stderr)
+        import_ms = sum(us for _, us, level in imports if level == 0) / 1000.0
+
+        if best is None or import_ms < best[1]:
+            best = (wall, import_ms, imports, proc.returncode, proc.stderr)
+
+    return best
+
+if __name__ == "__main__":
+
+    args = process_args()
+
+    failures = 0
+
+    for name, cwd, case_args, budget, forbidden in CASES:
+
+        if args.cases and not any(c in name for c in args.cases):
+            continue
+
+        wall, import_ms, imports, returncode, stderr = run_case(cwd, case_args, max(args.repeat, 1))
+
+        budget = budget * args.scale
+
+        problems = []
+
+        if returncode != 0:
+            errors = [line for line in stderr.splitlines() if not line.startswith('import time:')]
+            problems.append('exited with status %d: %s' % (returncode, errors[-1] if errors else ''))
+
+        if import_ms > budget:
+            problems.append('imports took %.0f ms, over the budget of %.0f ms' % (import_ms, budget))
+
+        imported = set(module for module, _, _ in imports)
+        unwanted = [m for m in forbidden if m in imported]
+
+        if len(unwanted) > 0:
+            problems.append('imported ' + ', '.join(unwanted))
+
+        print('%-30s %7.0f ms imports %7.0f ms wall  %s' % (name, import_ms, wall * 1000,
+                                                          'OK' if len(problems) == 0 else 'FAIL'))
+
+        for problem in problems:
+            print('    ' + problem)
+
+        if args.verbose:
+            top = sorted((i for i in imports if i[2] == 0), key=lambda i: -i[1])[:10]
+
+            for module, us, _ in top:
+                print('    %7.1f ms  %s' % (us / 1000.0, module))
+
+        if len(problems) > 0:
+            failures += 1
+
+    sys.exit(1 if failures > 0 else 0)